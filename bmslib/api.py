@@ -0,0 +1,249 @@
+"""
+Lightweight local HTTP/JSON API (asyncio, no dependencies).
+
+GET /api/devices                              list of devices
+GET /api/devices/{name}                       latest sample, cell stats and meter readings
+GET /api/devices/{name}/history?column=power&seconds=300
+                                              window of the in-memory history with aggregates (min/max/mean/last)
+GET /api/stream[?device={name}]               server-sent events, one `sample` event per processed sample
+GET /metrics                                  Prometheus text format (see `bmslib.metrics`)
+
+JSON responses carry an ETag that changes with every new sample, clients can poll with If-None-Match (304).
+"""
+import asyncio
+import json
+import math
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from bmslib.metrics import metrics
+from bmslib.sampling import BmsSampler
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+SSE_QUEUE_SIZE = 16
+SSE_KEEPALIVE = 15
+
+
+def _finite(v):
+    if isinstance(v, float) and not math.isfinite(v):
+        return None
+    if isinstance(v, dict):
+        return {k: _finite(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_finite(x) for x in v]
+    return v
+
+
+def _dumps(obj) -> bytes:
+    return json.dumps(_finite(obj), separators=(',', ':')).encode('utf-8')
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+_REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error'}
+
+
+def window_aggregates(values) -> dict:
+    n = 0
+    s = 0.
+    vmin = math.inf
+    vmax = -math.inf
+    for v in values:
+        if v == v:  # skip nan
+            n += 1
+            s += v
+            if v < vmin:
+                vmin = v
+            if v > vmax:
+                vmax = v
+    if not n:
+        return dict(n=0, min=None, max=None, mean=None, last=None)
+    return dict(n=n, min=vmin, max=vmax, mean=s / n, last=values[-1])
+
+
+class ApiServer:
+
+    def __init__(self, samplers: List[BmsSampler], host='127.0.0.1', port=8088):
+        self.samplers: Dict[str, BmsSampler] = {s.bms.name: s for s in samplers}
+        self.host = host
+        self.port = port
+        self.version = 0
+        self._etag_prefix = '%x' % int(time.time())  # etags must change on restart
+        self._streams: List[tuple] = []  # (queue, device name or None)
+        self._server: Optional[asyncio.AbstractServer] = None
+        for s in samplers:
+            s.sample_listeners.append(self._on_sample)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        addrs = ', '.join('%s:%d' % sock.getsockname()[:2] for sock in self._server.sockets)
+        logger.info('API listening on %s', addrs)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # data
+
+    def _sampler(self, name: str) -> BmsSampler:
+        s = self.samplers.get(name)
+        if s is None:
+            raise HttpError(404, 'unknown device %s' % name)
+        return s
+
+    def devices(self):
+        return [dict(name=name, num_samples=s.num_samples, is_virtual=s.bms.is_virtual,
+                     timestamp=s.last_sample and s.last_sample.timestamp)
+                for name, s in self.samplers.items()]
+
+    @staticmethod
+    def device_state(s: BmsSampler):
+        cs = s.cell_stats
+        di = s.device_info
+        return dict(
+            name=s.bms.name,
+            num_samples=s.num_samples,
+            sample=s.last_sample and s.last_sample.to_fields(),
+            cells=cs and dict(voltages=list(cs.voltages), min=cs.min, max=cs.max, min_index=cs.min_index + 1,
+                              max_index=cs.max_index + 1, delta=cs.delta, mean=cs.mean, median=cs.median,
+                              stddev=cs.stddev),
+            meters={k: v['reading'] for k, v in s.get_meter_state().items()},
+            device_info=di and dict(mnf=di.mnf, model=di.model, hw_version=di.hw_version, sw_version=di.sw_version,
+                                    name=di.name, sn=di.sn),
+        )
+
+    @staticmethod
+    def device_history(s: BmsSampler, query: Dict[str, list]):
+        h = s.history
+        if h is None:
+            raise HttpError(404, 'history disabled (history_size=0)')
+        column = query.get('column', ['power'])[0]
+        try:
+            seconds = float(query.get('seconds', ['300'])[0])
+        except ValueError:
+            raise HttpError(400, 'invalid seconds')
+        n = h.count_since(time.time() - seconds)
+        try:
+            # cells and temperatures are numbered from 1, like the MQTT topics
+            if column.startswith('cell') and int(column[4:]) >= 1:
+                values = h.cell_window(int(column[4:]) - 1, n)
+            elif column.startswith('temperature') and column[11:].isdigit() and int(column[11:]) >= 1:
+                values = h.temperature_window(int(column[11:]) - 1, n)
+            else:
+                values = h.window(column, n)
+        except (KeyError, IndexError, ValueError):
+            raise HttpError(404, 'unknown column %s' % column)
+        res = dict(column=column, **window_aggregates(values))
+        if query.get('values', ['1'])[0] not in ('0', 'false'):
+            res.update(ts=h.window('timestamp', n).tolist(), values=values.tolist())
+        return res
+
+    # streaming
+
+    def _on_sample(self, sampler: BmsSampler):
+        self.version += 1
+        if not self._streams:
+            return
+        name = sampler.bms.name
+        payload = None
+        for q, device in self._streams:
+            if device is not None and device != name:
+                continue
+            if payload is None:
+                payload = b'event: sample\ndata: ' + _dumps(dict(name=name, **sampler.last_sample.to_fields())) + \
+                          b'\n\n'
+            if q.full():
+                q.get_nowait()  # slow client, drop the oldest event
+            q.put_nowait(payload)
+
+    async def _stream(self, writer: asyncio.StreamWriter, device: Optional[str]):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                     b'Connection: close\r\n\r\n')
+        q = asyncio.Queue(SSE_QUEUE_SIZE)
+        entry = (q, device)
+        self._streams.append(entry)
+        try:
+            while True:
+                try:
+                    writer.write(await asyncio.wait_for(q.get(), SSE_KEEPALIVE))
+                except asyncio.TimeoutError:
+                    writer.write(b': keep-alive\n\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._streams.remove(entry)
+
+    # http
+
+    def _route(self, path: str, query: Dict[str, list]):
+        """ :return: (etag, json body) """
+        parts = [unquote(p) for p in path.strip('/').split('/')]
+        if parts[:1] != ['api']:
+            raise HttpError(404, 'not found')
+        if parts[1:] == ['devices']:
+            return '"%s-%d"' % (self._etag_prefix, self.version), self.devices
+        if len(parts) in (3, 4) and parts[1] == 'devices':
+            s = self._sampler(parts[2])
+            etag = '"%s-%d"' % (self._etag_prefix, s.num_samples)
+            if len(parts) == 3:
+                return etag, lambda: self.device_state(s)
+            if parts[3] == 'history':
+                return etag, lambda: self.device_history(s, query)
+        raise HttpError(404, 'not found')
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, _ = lines[0].split(' ', 2)
+            headers = {k.strip().lower(): v.strip() for k, _, v in (l.partition(':') for l in lines[1:] if l)}
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+
+            try:
+                if method != 'GET':
+                    raise HttpError(405, 'method not allowed')
+                if url.path.rstrip('/') == '/api/stream':
+                    await self._stream(writer, query.get('device', [None])[0])
+                    return
+                if url.path.rstrip('/') == '/metrics':
+                    self._respond(writer, 200, metrics.prometheus_text().encode('utf-8'),
+                                  content_type='text/plain; version=0.0.4')
+                    await writer.drain()
+                    return
+                etag, body_fn = self._route(url.path, query)
+                if headers.get('if-none-match') == etag:
+                    self._respond(writer, 304, etag=etag)
+                else:
+                    self._respond(writer, 200, _dumps(body_fn()), etag=etag)
+            except HttpError as e:
+                self._respond(writer, e.status, _dumps(dict(error=str(e))))
+            except Exception as e:
+                logger.error('API error %s: %s', target, e, exc_info=True)
+                self._respond(writer, 500, _dumps(dict(error=str(e))))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _respond(writer: asyncio.StreamWriter, status: int, body: bytes = b'', etag: Optional[str] = None,
+                 content_type='application/json'):
+        head = 'HTTP/1.1 %d %s\r\nContent-Length: %d\r\nConnection: close\r\n' % (
+            status, _REASONS.get(status, ''), len(body))
+        if body:
+            head += 'Content-Type: %s\r\n' % content_type
+        if etag:
+            head += 'ETag: %s\r\nCache-Control: no-cache\r\n' % etag
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
@@ -1,6 +1,6 @@
 import math
+import operator
 import time
-from copy import copy
 from typing import List, Dict, Optional
 
 MIN_VALUE_EXPIRY = 20
@@ -32,6 +32,14 @@ class PowerMonitorSample:
 
 
 class BmsSample:
+    # fixed field schema. `_power` is the power reported by the BMS (nan if not available), see `power`
+    FIELDS = ('voltage', 'current', '_power', 'balance_current', 'charge', 'capacity', 'soc', 'cycle_capacity',
+              'num_cycles', 'temperatures', 'mos_temperature', 'switches', 'uptime', 'timestamp', 'num_samples')
+
+    __slots__ = FIELDS
+
+    _get_fields = operator.attrgetter(*FIELDS)
+
     def __init__(self, voltage, current, power=math.nan,
                  charge=math.nan, capacity=math.nan, cycle_capacity=math.nan,
                  num_cycles=math.nan, soc=math.nan,
@@ -91,8 +99,30 @@ class BmsSample:
         """
         return (self.voltage * self.current) if math.isnan(self._power) else self._power
 
+    def to_fields(self) -> Dict[str, any]:
+        """
+        All fields (including `_power`) and the computed `power`, as a new dict.
+        """
+        d = dict(zip(self.FIELDS, BmsSample._get_fields(self)))
+        d["power"] = self.power
+        return d
+
     def values(self):
-        return {**self.__dict__, "power": self.power}
+        return self.to_fields()
+
+    def __copy__(self):
+        res = BmsSample.__new__(BmsSample)
+        res.__setstate__(BmsSample._get_fields(self))
+        return res
+
+    def __getstate__(self):
+        return BmsSample._get_fields(self)
+
+    def __setstate__(self, state):
+        # keep in sync with FIELDS
+        (self.voltage, self.current, self._power, self.balance_current, self.charge, self.capacity, self.soc,
+         self.cycle_capacity, self.num_cycles, self.temperatures, self.mos_temperature, self.switches, self.uptime,
+         self.timestamp, self.num_samples) = state
 
     def __str__(self):
         # noinspection PyStringFormat
@@ -109,7 +139,7 @@ class BmsSample:
         return self.multiply_current(-1)
 
     def multiply_current(self, x):
-        res = copy(self)
+        res = self.__copy__()
         if res.current != 0:  # prevent -0 values
             res.current *= x
         if not math.isnan(res._power) and res._power != 0:
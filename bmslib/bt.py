@@ -11,6 +11,8 @@ from bleak.backends.characteristic import BleakGATTCharacteristic
 
 from . import FuturesPool
 from .bms import BmsSample, DeviceInfo
+from .connection import ConnectionManager
+from .scanner import ScannerService
 from .util import get_logger
 
 BleakDeviceNotFoundError = getattr(bleak.exc, 'BleakDeviceNotFoundError', bleak.exc.BleakError)
@@ -70,7 +72,7 @@ class BtBms:
                  _uses_pin=False):
         self.address = address
         self.name = name
-        self.keep_alive = keep_alive
+        self.connection = ConnectionManager(self, policy='always' if keep_alive else 'per_sample')
         self.verbose_log = verbose_log
         self.logger = get_logger(verbose_log)
         self._fetch_futures = FuturesPool()
@@ -85,6 +87,10 @@ class BtBms:
             from bmslib.models.dummy import BleakDummyClient
             self.client = BleakDummyClient(address, disconnected_callback=self._on_disconnect)
             self._adapter = "fake"
+        elif address.startswith('replay:'):
+            from bmslib.replay import ReplayClient
+            self.client = ReplayClient(address, disconnected_callback=self._on_disconnect)
+            self._adapter = "fake"
         else:
             kwargs = {}
             if psk:
@@ -119,6 +125,15 @@ class BtBms:
     def connect_time(self):
         return self._connect_time
 
+    @property
+    def keep_alive(self):
+        return self.connection.policy == 'always'
+
+    @property
+    def adapter(self):
+        """ bluetooth adapter (hci0, hci1, ..) or None for the default adapter """
+        return self._adapter
+
     async def start_notify(self, char_specifier, callback: Callable[[int, bytearray], None], **kwargs):
         """
         This function wraps BleakClient.start_notify, differences:
@@ -185,8 +200,12 @@ class BtBms:
         try:
             await asyncio.wait_for(self.client.connect(timeout=timeout), timeout=timeout + 1)
         except getattr(bleak.exc, 'BleakDeviceNotFoundError', bleak.exc.BleakError) as exc:
-            self.logger.error("%s, starting scanner", exc)
-            await bt_discovery(self.logger)
+            svc = ScannerService.running(self._adapter)
+            if svc is not None:
+                self.logger.error("%s, last seen: %s", exc, svc.devices.get(self.address.upper(), 'never'))
+            else:
+                self.logger.error("%s, starting scanner", exc)
+                await bt_discovery(self.logger)
             raise
 
         self._connect_time = time.time()
@@ -252,37 +271,48 @@ class BtBms:
         if BtBms.shutdown:
             raise RuntimeError("in shutdown")
 
-        import bleak
-        scanner_kw = {}
-        if self._adapter:
-            scanner_kw['adapter'] = self._adapter
-        scanner = bleak.BleakScanner(**scanner_kw)
-        self.logger.debug("starting scan")
-        await scanner.start()
+        # prefer the shared scanner, only start our own if it is not running
+        svc = ScannerService.running(self._adapter)
+        scanner = None
+        if svc is None:
+            import bleak
+            scanner_kw = {}
+            if self._adapter:
+                scanner_kw['adapter'] = self._adapter
+            scanner = bleak.BleakScanner(**scanner_kw)
+            self.logger.debug("starting scan")
+            await scanner.start()
 
         attempt = 1
-        while True:
-            try:
-                discovered = set(b.address for b in scanner.discovered_devices)
-                if self.client.address not in discovered:
-                    raise BleakDeviceNotFoundError(
-                        self.client.address, 'Device %s not discovered. Make sure it in range and is not being '
-                                             'accessed by another app. (found %s)' % (self.client.address, discovered))
-
-                self.logger.debug("connect attempt %d", attempt)
-                await self._connect_client(timeout=timeout / 2)
-                break
-            except Exception as e:
-                await self.client.disconnect()
-                if attempt < 8:
-                    self.logger.debug('retry %d after error %s', attempt, e)
-                    await asyncio.sleep(0.2 * (1.5 ** attempt))
-                    attempt += 1
-                else:
-                    await scanner.stop()
-                    raise
-
-        await scanner.stop()
+        try:
+            while True:
+                try:
+                    if svc is not None:
+                        seen = await svc.wait_for(self.client.address, timeout / 2) is not None
+                        discovered = set(e.address for e in svc.devices.values() if e.age < svc.stale_after)
+                    else:
+                        discovered = set(b.address for b in scanner.discovered_devices)
+                        seen = self.client.address in discovered
+                    if not seen:
+                        raise BleakDeviceNotFoundError(
+                            self.client.address, 'Device %s not discovered. Make sure it in range and is not being '
+                                                 'accessed by another app. (found %s)' % (
+                                                     self.client.address, discovered))
+
+                    self.logger.debug("connect attempt %d", attempt)
+                    await self._connect_client(timeout=timeout / 2)
+                    break
+                except Exception as e:
+                    await self.client.disconnect()
+                    if attempt < 8:
+                        self.logger.debug('retry %d after error %s', attempt, e)
+                        await asyncio.sleep(0.2 * (1.5 ** attempt))
+                        attempt += 1
+                    else:
+                        raise
+        finally:
+            if scanner is not None:
+                await scanner.stop()
 
     async def disconnect(self):
         self._in_disconnect = True
@@ -321,10 +351,15 @@ class BtBms:
         raise NotImplementedError()
 
     async def subscribe(self, callback: Callable[[BmsSample], None]):
-        raise NotImplemented()
+        """
+        Register a callback for samples pushed by the BMS (e.g. streamed frames or characteristic notifications).
+        The subscription survives re-connects. Models that can only be polled raise NotImplementedError.
+        :param callback: called with each new sample, possibly from a non-asyncio thread
+        """
+        raise NotImplementedError()
 
     async def subscribe_voltages(self, callback: Callable[[List[int]], None]):
-        raise NotImplemented()
+        raise NotImplementedError()
 
     async def set_switch(self, switch: str, state: bool):
         """
@@ -339,17 +374,10 @@ class BtBms:
         return f'{self.__class__.__name__}({self.client.address},{self.name})'
 
     async def __aenter__(self):
-        # print("enter")
-        if self.keep_alive and self.is_connected:
-            return
-        await self.connect()
-
-    async def __aexit__(self, *args):
-        # print("exit")
-        if self.keep_alive:
-            return
-        if self.client.is_connected:
-            await self.disconnect()
+        await self.connection.acquire()
+
+    async def __aexit__(self, exc_type=None, exc=None, tb=None):
+        await self.connection.release(exc)
 
     def __await__(self):
         return self.__aexit__().__await__()
@@ -357,7 +385,24 @@ class BtBms:
     def set_keep_alive(self, keep):
         if keep:
             self.logger.debug("BMS %s keep alive enabled", self.__str__())
-        self.keep_alive = keep
+        self.connection.configure('always' if keep else 'per_sample')
+
+    def set_connection_policy(self, policy: str, **kwargs):
+        """ See `bmslib.connection.ConnectionManager` """
+        self.connection.configure(policy, **kwargs)
+
+    def start_capture(self, path: str):
+        """ Record the BLE session to `path`, see `bmslib.replay` """
+        from bmslib.replay import CaptureRecorder, model_slug
+        self.logger.info('Capturing %s to %s', self.name, path)
+        self.client = CaptureRecorder(self.client, path, model=model_slug(type(self)), name=self.name)
+
+    def stop_capture(self):
+        """ Close the capture file (if capturing) """
+        from bmslib.replay import CaptureRecorder
+        if isinstance(self.client, CaptureRecorder):
+            self.client.close()
+            self.client = self.client.client
 
     def debug_data(self):
         return None
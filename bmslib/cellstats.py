@@ -0,0 +1,65 @@
+"""
+Cell voltage statistics, computed once per voltage fetch and shared by MQTT publishing, sinks and groups.
+"""
+import math
+from typing import Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# below this number of cells the plain python implementation is faster than numpy (conversion overhead)
+NUMPY_MIN_CELLS = 64
+
+
+class CellStats:
+    """
+    Statistics of cell voltages (mV). Indices are 0-based.
+    """
+
+    __slots__ = ('voltages', 'min', 'max', 'min_index', 'max_index', 'mean', 'median', 'stddev')
+
+    def __init__(self, voltages: Sequence[float]):
+        self.voltages = tuple(voltages)
+        n = len(self.voltages)
+        if not n:
+            self.min = self.max = self.mean = self.median = self.stddev = math.nan
+            self.min_index = self.max_index = None
+        elif np is not None and n >= NUMPY_MIN_CELLS:
+            self._compute_np()
+        else:
+            self._compute()
+
+    def _compute(self):
+        v = self.voltages
+        n = len(v)
+        self.min = min(v)
+        self.max = max(v)
+        self.min_index = v.index(self.min)
+        self.max_index = v.index(self.max)
+        self.mean = sum(v) / n
+        s = sorted(v)
+        self.median = s[n // 2] if n % 2 else (s[n // 2 - 1] + s[n // 2]) / 2
+        self.stddev = math.sqrt(sum((x - self.mean) ** 2 for x in v) / n)
+
+    def _compute_np(self):
+        a = np.asarray(self.voltages, dtype=float)
+        self.min_index = int(a.argmin())
+        self.max_index = int(a.argmax())
+        self.min = self.voltages[self.min_index]
+        self.max = self.voltages[self.max_index]
+        self.mean = float(a.mean())
+        self.median = float(np.median(a))
+        self.stddev = float(a.std())
+
+    @property
+    def delta(self):
+        return self.max - self.min
+
+    def __len__(self):
+        return len(self.voltages)
+
+    def __str__(self):
+        return 'CellStats(n=%d,min=%s@%s,max=%s@%s,mean=%.1f,std=%.1f)' % (
+            len(self), self.min, self.min_index, self.max, self.max_index, self.mean, self.stddev)
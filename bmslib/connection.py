@@ -0,0 +1,190 @@
+"""
+Per-device BLE connection management, used by `BtBms.__aenter__` / `__aexit__`.
+
+Policies:
+  * `per_sample`: connect for each sample and disconnect afterwards (default)
+  * `idle`: keep the connection between samples, disconnect after `idle_timeout` seconds without use
+  * `duty`: like `idle`, but drop the connection after `max_connected` seconds, so other clients (e.g. the phone app)
+    get a chance to connect
+  * `always`: never disconnect (`keep_alive`)
+
+Failed connects are retried with jittered exponential back-off. After `failure_threshold` consecutive failures the
+circuit opens: no connect attempts for `breaker_timeout` seconds (doubling with each trip), then a single attempt
+(half-open) decides whether to close it again. While backing off, devices that the shared scanner (`bmslib.scanner`)
+hasn't seen recently are not connected at all. A connection that fails 4x `failure_threshold` fetches in a row is
+dropped.
+"""
+import asyncio
+import random
+import time
+from typing import Optional
+
+from bmslib.metrics import metrics
+from bmslib.pwmath import EWMA
+from bmslib.scanner import ScannerService
+
+POLICIES = ('per_sample', 'idle', 'duty', 'always')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class ConnectionManager:
+
+    def __init__(self, bms, policy='per_sample', idle_timeout=30., max_connected=300., failure_threshold=5,
+                 backoff_base=1.5, backoff_max=120., breaker_timeout=30.):
+        self.bms = bms
+        self.policy = None
+        self.idle_timeout = idle_timeout
+        self.max_connected = max_connected
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_timeout = breaker_timeout
+        self.configure(policy)
+
+        self.num_connects = 0
+        self.connect_failures = 0  # consecutive
+        self.fetch_failures = 0  # consecutive
+        self.num_trips = 0
+        self.next_attempt = 0.
+        self.health = EWMA(span=20)  # success rate of connects and fetches
+        self.connect_latency = EWMA(span=10)
+
+        self._in_use = 0
+        self._t_release = 0.
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def configure(self, policy: str, **kwargs):
+        if policy not in POLICIES:
+            raise ValueError('unknown connection policy %s, choose one of %s' % (policy, POLICIES))
+        self.policy = policy
+        for k, v in kwargs.items():
+            if not hasattr(self, k):
+                raise TypeError('unknown connection option %s' % k)
+            setattr(self, k, v)
+
+    @property
+    def state(self):
+        if self.connect_failures < self.failure_threshold:
+            return 'closed'
+        return 'open' if time.time() < self.next_attempt else 'half_open'
+
+    def retry_in(self) -> float:
+        """ Seconds until the next connect attempt is allowed """
+        return max(0., self.next_attempt - time.time())
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _cancel_idle(self):
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _set_health(self, ok: bool):
+        self.health.add(1. if ok else 0.)
+        metrics.set('connection_health', self.bms.name, self.health.value)
+
+    async def acquire(self):
+        self._cancel_idle()
+        bms = self.bms
+        async with self._get_lock():
+            if bms.is_connected and self.policy == 'duty' and time.time() - bms.connect_time > self.max_connected:
+                bms.logger.info('%s connected for %.0fs, reconnect (duty policy)', bms.name,
+                                time.time() - bms.connect_time)
+                await bms.disconnect()
+
+            if bms.is_connected:
+                self._in_use += 1
+                return
+
+            wait = self.retry_in()
+            if wait > 0:
+                raise CircuitOpenError('%s: connect %s, retry in %.0fs' % (
+                    bms.name, 'circuit open' if self.state == 'open' else 'backing off', wait))
+
+            if self.connect_failures and self.state != 'half_open' and not self._recently_seen():
+                # don't block the sampler with a connect that will likely time out
+                self._connect_failed()
+                raise CircuitOpenError('%s: not seen by the scanner recently' % bms.name)
+
+            t = time.time()
+            try:
+                await bms.connect()
+            except Exception:
+                self._connect_failed()
+                raise
+            self._in_use += 1
+
+        self.connect_latency.add(time.time() - t)
+        self.num_connects += 1
+        self.connect_failures = 0
+        self.next_attempt = 0.
+        self._set_health(True)
+
+    def _connect_failed(self):
+        self.connect_failures += 1
+        self._set_health(False)
+        n = self.connect_failures
+        if n < self.failure_threshold:
+            delay = min(self.backoff_max, self.backoff_base ** n)
+        else:
+            if n == self.failure_threshold:
+                self.num_trips += 1
+                self.bms.logger.warning('%s: %d connect failures in a row, circuit open', self.bms.name, n)
+            delay = min(self.backoff_max, self.breaker_timeout * 2 ** (self.num_trips - 1))
+        self.next_attempt = time.time() + delay * random.uniform(.5, 1.)  # jitter
+
+    def _recently_seen(self) -> bool:
+        """ False if the shared scanner is running and hasn't seen the device recently """
+        svc = ScannerService.running(getattr(self.bms, 'adapter', None))
+        return svc is None or svc.lookup(self.bms.address) is not None
+
+    async def release(self, exc: Optional[BaseException] = None):
+        bms = self.bms
+        self._in_use = max(0, self._in_use - 1)
+        self._t_release = time.time()
+
+        if exc is None:
+            self.fetch_failures = 0
+            self._set_health(True)
+        elif not isinstance(exc, asyncio.CancelledError):
+            self.fetch_failures += 1
+            self._set_health(False)
+            if self.fetch_failures >= self.failure_threshold * 4 and bms.is_connected:
+                bms.logger.warning("disconnecting %s due to too many errors %d", bms, self.fetch_failures)
+                self.fetch_failures = 0
+                await self._disconnect()
+                return
+
+        if self._in_use or not bms.is_connected or self.policy == 'always':
+            return
+        if self.policy == 'per_sample' or self.idle_timeout <= 0:
+            await self._disconnect()
+        else:
+            self._idle_handle = asyncio.get_running_loop().call_later(
+                self.idle_timeout, lambda: asyncio.ensure_future(self._idle_disconnect()))
+
+    async def _disconnect(self):
+        async with self._get_lock():
+            if self.bms.is_connected:
+                await self.bms.disconnect()
+
+    async def _idle_disconnect(self):
+        self._idle_handle = None
+        if self._in_use or time.time() - self._t_release < self.idle_timeout - .01:
+            return
+        try:
+            await self._disconnect()
+        except Exception as e:
+            self.bms.logger.warning('%s idle disconnect error: %s', self.bms.name, e)
+
+    def stats(self):
+        return dict(policy=self.policy, state=self.state, health=round(self.health.value, 3),
+                    connects=self.num_connects, connect_latency=round(self.connect_latency.value, 3),
+                    connect_failures=self.connect_failures, retry_in=round(self.retry_in(), 1))
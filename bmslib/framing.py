@@ -0,0 +1,117 @@
+"""
+Reassembly of BLE notification chunks into BMS response frames.
+
+Frames are handed out as `memoryview` into a pre-allocated buffer, so the only copy is the one of the notification
+data into the buffer. A frame view is only valid until the next call of `feed()`; use `bytes(frame)` to keep it.
+"""
+from typing import Callable, Optional, Union, Iterator
+
+from bmslib.util import get_logger, to_hex_str
+
+logger = get_logger()
+
+FrameLength = Union[int, Callable[[memoryview], Optional[int]]]
+
+
+class FrameAssembler:
+    """
+    Frames are delimited by one (or more) of:
+      * `header`: frames start with these bytes. bytes before a header are discarded. Header bytes can also occur
+        inside a frame, so a new header only re-syncs after the length or `check` of the buffered frame failed.
+      * `frame_len`: a fixed frame length or a function returning the length from the buffered frame start (or None
+        if more bytes are needed)
+      * `terminator`: without `frame_len`, a frame ends where a notification ends with the terminator
+
+    `check` is an optional integrity hook (e.g. CRC), returning False for corrupted frames.
+    """
+
+    def __init__(self, header: bytes = b'', frame_len: Optional[FrameLength] = None, terminator: bytes = b'',
+                 check: Optional[Callable[[memoryview], bool]] = None, capacity=1024, name=''):
+        assert frame_len or terminator, "need frame_len or terminator"
+        self.header = bytes(header)
+        self.frame_len = frame_len
+        self.terminator = bytes(terminator)
+        self.check = check
+        self.name = name
+
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+        self.num_frames = 0
+        self.num_check_errors = 0
+        self.num_overflows = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def clear(self):
+        self._start = self._end = 0
+
+    def buffered(self) -> bytes:
+        return bytes(self._view[self._start:self._end])
+
+    def _append(self, data):
+        n = len(data)
+        if self._end + n > len(self._buf):
+            # compact: move pending bytes to the buffer start
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+            if self._end + n > len(self._buf):
+                self.num_overflows += 1
+                logger.warning('%s frame buffer overflow (%d + %d bytes), discarding %s', self.name, pending, n,
+                               to_hex_str(self._view[:pending]))
+                self.clear()
+                if n > len(self._buf):
+                    return
+        self._view[self._end:self._end + n] = data
+        self._end += n
+
+    def _sync_header(self) -> bool:
+        if not self.header:
+            return True
+        idx = self._buf.find(self.header, self._start, self._end)
+        if idx < 0:
+            # keep a possibly incomplete header at the end
+            self._start = max(self._start, self._end - len(self.header) + 1)
+            return False
+        self._start = idx
+        return True
+
+    def _next_frame_len(self) -> Optional[int]:
+        if self.frame_len is None:
+            if self._end > self._start and self._view[self._end - len(self.terminator):self._end] == self.terminator:
+                return self._end - self._start
+            return None
+        if isinstance(self.frame_len, int):
+            return self.frame_len
+        return self.frame_len(self._view[self._start:self._end])
+
+    def feed(self, data) -> Iterator[memoryview]:
+        """
+        Append a notification chunk and yield all complete frames.
+        """
+        self._append(data)
+
+        while self._sync_header():
+            n = self._next_frame_len()
+            if n is None or self._end - self._start < n:
+                break
+
+            frame = self._view[self._start:self._start + n]
+            if self.check and not self.check(frame):
+                self.num_check_errors += 1
+                logger.debug('%s frame check failed, discarding %s', self.name, to_hex_str(frame))
+                frame.release()
+                # skip this header and try to re-sync
+                self._start += 1 if self.header else n
+                continue
+
+            self._start += n
+            self.num_frames += 1
+            yield frame
+
+        if self._start == self._end:
+            self.clear()
@@ -1,8 +1,7 @@
 import asyncio
 import math
 import statistics
-from copy import copy
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Sequence
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
@@ -15,16 +14,18 @@ class BmsGroup:
         self.name = name
         self.bms_names = list()
         self.samples: Dict[str, BmsSample] = {}
-        self.voltages: Dict[str, List[int]] = {}
+        self.voltages: Dict[str, Sequence[int]] = {}
         # self.max_sample_age = 0
 
     def update(self, bms: BtBms, sample: BmsSample):
         assert bms.name in self.bms_names, "bms %s not in group %s" % (bms.name, self.bms_names)
-        self.samples[bms.name] = copy(sample)
+        # no copy needed, the sampler doesn't modify a sample after passing it to the group
+        self.samples[bms.name] = sample
 
-    def update_voltages(self, bms: BtBms, voltages: List[int]):
+    def update_voltages(self, bms: BtBms, voltages: Sequence[int]):
+        """ :param voltages: immutable sequence (CellStats.voltages), stored without copy """
         assert bms.name in self.bms_names, "bms %s not in group %s" % (bms.name, self.bms_names)
-        self.voltages[bms.name] = copy(voltages)
+        self.voltages[bms.name] = voltages
 
     def fetch(self) -> BmsSample:
         # ts_expire = time.time() - self.max_sample_age
@@ -33,7 +34,7 @@ class BmsGroup:
 
     def fetch_voltages(self):
         try:
-            return sum((self.voltages[name] for name in self.bms_names), [])
+            return [v for name in self.bms_names for v in self.voltages[name]]
         except KeyError as e:
             raise GroupNotReady(e)
 
@@ -82,6 +83,9 @@ class VirtualGroupBms:
     def set_keep_alive(self, keep):
         pass
 
+    def set_connection_policy(self, policy: str, **kwargs):
+        pass
+
     def add_member(self, bms: BtBms):
         self.group.bms_names.append(bms.name)
         self.members.append(bms)
@@ -0,0 +1,135 @@
+"""
+In-memory sample history of a single BMS.
+
+The history is a fixed-capacity columnar ring buffer. Each column is an `array` of twice the capacity and every value
+is written twice (at i and i+capacity), so the latest n values are always contiguous in memory. `window()` returns
+them as a `memoryview` without copying (zero-copy); `as_numpy()` wraps that view if NumPy is installed.
+"""
+import math
+from array import array
+from bisect import bisect_left
+from typing import Dict, Optional, Sequence
+
+from bmslib.bms import BmsSample
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NAN = math.nan
+
+
+class SampleHistory:
+    # (column name, array typecode). timestamps need double precision
+    COLUMNS = (
+        ('timestamp', 'd'),
+        ('voltage', 'd'),
+        ('current', 'd'),
+        ('power', 'd'),
+        ('soc', 'f'),
+        ('charge', 'f'),
+        ('mos_temperature', 'f'),
+    )
+
+    def __init__(self, capacity: int):
+        assert capacity > 0
+        self.capacity = capacity
+        self._cols: Dict[str, array] = {name: array(tc, [NAN]) * (2 * capacity) for name, tc in self.COLUMNS}
+        self._cells: list = []  # one column per cell
+        self._temps: list = []
+        self._head = 0  # next write index in [0, capacity)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def num_cells(self):
+        return len(self._cells)
+
+    @property
+    def num_temperatures(self):
+        return len(self._temps)
+
+    def _new_matrix(self, n: int) -> list:
+        # a changing number of cells/sensors starts a new matrix, otherwise columns would be misaligned
+        return [array('f', [NAN]) * (2 * self.capacity) for _ in range(n)]
+
+    @staticmethod
+    def _put(col: array, i: int, j: int, v):
+        col[i] = v
+        col[j] = v
+
+    def append(self, sample: BmsSample, voltages: Optional[Sequence[float]] = None):
+        """
+        O(1) append. `voltages` are the cell voltages fetched with this sample (or None).
+        """
+        i = self._head
+        j = i + self.capacity
+        put = self._put
+        cols = self._cols
+        put(cols['timestamp'], i, j, sample.timestamp)
+        put(cols['voltage'], i, j, sample.voltage)
+        put(cols['current'], i, j, sample.current)
+        put(cols['power'], i, j, sample.power)
+        put(cols['soc'], i, j, sample.soc)
+        put(cols['charge'], i, j, sample.charge)
+        put(cols['mos_temperature'], i, j, sample.mos_temperature)
+
+        if voltages:
+            if len(voltages) != len(self._cells):
+                self._cells = self._new_matrix(len(voltages))
+            for col, v in zip(self._cells, voltages):
+                put(col, i, j, v)
+        else:
+            for col in self._cells:
+                put(col, i, j, NAN)
+
+        temps = sample.temperatures
+        if temps:
+            if len(temps) != len(self._temps):
+                self._temps = self._new_matrix(len(temps))
+            for col, v in zip(self._temps, temps):
+                put(col, i, j, NAN if v is None else v)
+        else:
+            for col in self._temps:
+                put(col, i, j, NAN)
+
+        self._head = (i + 1) % self.capacity
+        if self._len < self.capacity:
+            self._len += 1
+
+    def _window(self, col: array, n: Optional[int]) -> memoryview:
+        n = self._len if n is None else min(n, self._len)
+        end = self._head + self.capacity
+        return memoryview(col)[end - n:end]
+
+    def window(self, column: str, n: Optional[int] = None) -> memoryview:
+        """
+        The latest `n` values (all if None) of a column, oldest first. The view is only valid until the next append.
+        """
+        return self._window(self._cols[column], n)
+
+    def cell_window(self, cell_index: int, n: Optional[int] = None) -> memoryview:
+        return self._window(self._cells[cell_index], n)
+
+    def temperature_window(self, index: int, n: Optional[int] = None) -> memoryview:
+        return self._window(self._temps[index], n)
+
+    def count_since(self, t: float) -> int:
+        """ Number of samples with timestamp >= t (use as `n` of the window functions) """
+        ts = self.window('timestamp')
+        return len(ts) - bisect_left(ts, t)
+
+    def as_numpy(self, column: str, n: Optional[int] = None):
+        """ Zero-copy numpy view of `window()` (read-only usage) """
+        if np is None:
+            raise ImportError("numpy not installed")
+        return np.frombuffer(self.window(column, n), dtype=self._cols[column].typecode)
+
+    def last(self) -> Dict[str, float]:
+        if not self._len:
+            return {}
+        i = (self._head - 1) % self.capacity
+        return {name: col[i] for name, col in self._cols.items()}
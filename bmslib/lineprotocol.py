@@ -0,0 +1,133 @@
+"""
+InfluxDB line protocol encoding.
+
+https://docs.influxdata.com/influxdb/v1/write_protocols/line_protocol_reference/
+"""
+import math
+import threading
+from typing import Dict, Optional, Tuple
+
+_KEY_ESCAPE = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ '})
+_MEASUREMENT_ESCAPE = str.maketrans({',': r'\,', ' ': r'\ '})
+
+_field_keys: Dict[str, str] = {}
+
+
+def escape_key(s) -> str:
+    """ Escape tag keys, tag values and field keys """
+    if isinstance(s, bytes):
+        s = s.decode('utf-8')
+    return str(s).translate(_KEY_ESCAPE)
+
+
+def line_prefix(measurement: str, tags: Dict[str, any]) -> bytes:
+    """ `measurement,tag1=v1,tag2=v2 ` with tags sorted by key (as recommended for write performance) """
+    s = measurement.translate(_MEASUREMENT_ESCAPE)
+    for k in sorted(tags.keys()):
+        v = tags[k]
+        if v is None or v == '' or v == b'':
+            continue
+        s += ',' + escape_key(k) + '=' + escape_key(v)
+    return (s + ' ').encode('utf-8')
+
+
+def format_value(v) -> Optional[str]:
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    if isinstance(v, int):
+        return '%di' % v
+    if isinstance(v, float):
+        return repr(v) if math.isfinite(v) else None
+    if isinstance(v, str):
+        return '"' + v.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    if v is None:
+        return None
+    return format_value(float(v))
+
+
+def encode_fields(fields: Dict[str, any]) -> bytes:
+    parts = []
+    for k, v in fields.items():
+        s = format_value(v)
+        if s is None:
+            continue
+        ek = _field_keys.get(k)
+        if ek is None:
+            ek = _field_keys[k] = escape_key(k)
+        parts.append(ek + '=' + s)
+    return ','.join(parts).encode('utf-8')
+
+
+class LineBuffer:
+    """
+    Thread-safe, bounded buffer of encoded lines. Two byte buffers are swapped on `take()`, so the buffer memory is
+    reused between flushes. If more than `max_points` lines are buffered, the oldest ones are dropped.
+    """
+
+    def __init__(self, max_points: int):
+        self.max_points = max_points
+        self._buf = bytearray()
+        self._spare = bytearray()
+        self._n = 0
+        self._lock = threading.Lock()
+        self.num_dropped = 0
+
+    def __len__(self):
+        return self._n
+
+    def append(self, prefix: bytes, fields: bytes, ts_ns: int):
+        with self._lock:
+            buf = self._buf
+            buf += prefix
+            buf += fields
+            buf += b' %d\n' % ts_ns
+            self._n += 1
+            if self._n > self.max_points:
+                self._drop_oldest(max(1, self.max_points // 10))
+
+    def _drop_oldest(self, n: int):
+        buf = self._buf
+        pos = 0
+        for _ in range(n):
+            pos = buf.find(b'\n', pos) + 1
+            if pos == 0:
+                pos = len(buf)
+                break
+        del buf[:pos]
+        self._n -= n
+        self.num_dropped += n
+
+    def take(self, max_lines: Optional[int] = None) -> Tuple[bytearray, int]:
+        """
+        Take the oldest `max_lines` (all if None) buffered lines. Pass the returned buffer to `recycle()` or
+        `give_back()` when done
+        """
+        with self._lock:
+            if max_lines is None or self._n <= max_lines:
+                data, n = self._buf, self._n
+                self._buf, self._spare = self._spare, bytearray()
+                self._n = 0
+                return data, n
+
+            buf = self._buf
+            pos = 0
+            for _ in range(max_lines):
+                pos = buf.find(b'\n', pos) + 1
+            data, self._spare = self._spare, bytearray()
+            data += buf[:pos]
+            del buf[:pos]
+            self._n -= max_lines
+            return data, max_lines
+
+    def recycle(self, data: bytearray):
+        data.clear()
+        self._spare = data
+
+    def give_back(self, data: bytearray, n: int):
+        """ Put lines back in front of the buffer (e.g. after a failed write) """
+        with self._lock:
+            data += self._buf
+            self._buf = data
+            self._n += n
+            if self._n > self.max_points:
+                self._drop_oldest(self._n - self.max_points)
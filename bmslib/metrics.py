@@ -0,0 +1,141 @@
+"""
+Process metrics: latency histograms per device and stage, counters and gauges.
+
+The sampler records the stages connect, fetch, voltages, temperatures, mqtt_publish, sink_publish and cycle (total),
+errors by exception type and connects per device. main records the event-loop lag.
+
+Histograms have fixed log-spaced buckets, so recording is O(log buckets) without allocations. Metrics are exported as
+Prometheus text (`prometheus_text()`, served by the API at /metrics) and as a JSON summary per device (`summary()`,
+published to the MQTT topic `{device}/diag`).
+"""
+import math
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# bucket upper bounds in seconds, 1ms .. 60s
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last is +Inf
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, v: float):
+        self.counts[bisect_left(BUCKETS, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket containing the q-quantile (max for the +Inf bucket) """
+        if not self.count:
+            return math.nan
+        rank = q * self.count
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...], extra: str = '') -> str:
+    parts = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return '{%s}' % ','.join(parts) if parts else ''
+
+
+class Registry:
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, Optional[str]], Histogram] = defaultdict(Histogram)
+        self.counters: Dict[Tuple[str, Optional[str], Optional[str]], int] = defaultdict(int)
+        self.gauges: Dict[Tuple[str, Optional[str]], float] = {}
+        self.collectors: List[Callable[[], Dict[str, float]]] = []
+        self.t_start = time.time()
+
+    def observe(self, name: str, device: Optional[str], seconds: float):
+        self.histograms[(name, device)].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, device: Optional[str]):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[(name, device)].observe(time.perf_counter() - t)
+
+    def inc(self, name: str, device: Optional[str], kind: Optional[str] = None, n=1):
+        self.counters[(name, device, kind)] += n
+
+    def set(self, name: str, device: Optional[str], value: float):
+        self.gauges[(name, device)] = value
+
+    def add_collector(self, fn: Callable[[], Dict[str, float]]):
+        """ `fn` returns gauges {name: value}, called on export """
+        self.collectors.append(fn)
+
+    def summary(self, device: Optional[str]) -> dict:
+        """ Latency quantiles, errors and counters of a device, including process-wide histograms (loop lag) """
+        lat = {name: dict(n=h.count, p50=round(h.quantile(.5), 4), p95=round(h.quantile(.95), 4),
+                          max=round(h.max, 4), mean=round(h.mean, 4))
+               for (name, dev), h in self.histograms.items() if dev in (device, None) and h.count}
+        errors = {kind: n for (name, dev, kind), n in self.counters.items() if dev == device and name == 'errors'}
+        counters = {name: n for (name, dev, kind), n in self.counters.items() if dev == device and name != 'errors'}
+        return dict(latency=lat, errors=errors, **counters)
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for name in sorted(set(k[0] for k in self.histograms)):
+            metric = 'batmon_%s_seconds' % name
+            lines.append('# TYPE %s histogram' % metric)
+            for (n, device), h in self.histograms.items():
+                if n != name:
+                    continue
+                labels = (('device', device),) if device is not None else ()
+                acc = 0
+                for le, c in zip(BUCKETS + ('+Inf',), h.counts):
+                    acc += c
+                    lines.append('%s_bucket%s %d' % (metric, _labels(labels, 'le="%s"' % le), acc))
+                lines.append('%s_sum%s %.6f' % (metric, _labels(labels), h.sum))
+                lines.append('%s_count%s %d' % (metric, _labels(labels), h.count))
+
+        for name in sorted(set(k[0] for k in self.counters)):
+            metric = 'batmon_%s_total' % name
+            lines.append('# TYPE %s counter' % metric)
+            for (n, device, kind), v in self.counters.items():
+                if n == name:
+                    labels = tuple((k, x) for k, x in (('device', device), ('type', kind)) if x is not None)
+                    lines.append('%s%s %d' % (metric, _labels(labels), v))
+
+        gauges = dict(self.gauges)
+        gauges[('uptime_seconds', None)] = time.time() - self.t_start
+        for fn in self.collectors:
+            try:
+                for k, v in fn().items():
+                    gauges[(k, None)] = v
+            except Exception:
+                pass
+        for (name, device), v in sorted(gauges.items(), key=lambda kv: kv[0][0]):
+            if isinstance(v, (int, float)) and math.isfinite(v):
+                labels = (('device', device),) if device is not None else ()
+                lines.append('batmon_%s%s %s' % (name, _labels(labels), repr(float(v))))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Registry()
@@ -1,37 +1,70 @@
 
+from importlib import import_module
+from typing import Dict, Union
+
 from bmslib.util import get_logger
 
 logger = get_logger()
 
 
+# type slug -> 'module:Class'. Modules are imported on first use, so only drivers used by the config are loaded
+BMS_MODELS: Dict[str, Union[str, type]] = dict(
+    daly='bmslib.models.daly:DalyBt',
+    jbd='bmslib.models.jbd:JbdBt',
+    jk='bmslib.models.jikong:JKBt',
+    ant='bmslib.models.ant:AntBt',
+    victron='bmslib.models.victron:SmartShuntBt',
+    group_parallel='bmslib.group:VirtualGroupBms',
+    # group_serial=bmslib.group.VirtualGroupBms, # TODO
+    supervolt='bmslib.models.supervolt:SuperVoltBt',
+    sok='bmslib.models.sok:SokBt',
+    pq='bmslib.models.pq:PowerQueenBt',
+    dummy='bmslib.models.dummy:DummyBt',
+    simulated='bmslib.models.dummy:SimulatedBt',
+)
+
+# third-party drivers register in this entry point group, e.g. in pyproject.toml:
+#   [project.entry-points."batmon.bms_models"]
+#   mybms = "mypackage.mybms:MyBmsBt"
+ENTRY_POINT_GROUP = 'batmon.bms_models'
+
+_plugins_loaded = False
+
+
+def register_bms_model(name: str, target: Union[str, type]):
+    """ Register a driver class or a lazy 'module:Class' reference for device type `name` """
+    BMS_MODELS[name] = target
+
+
+def _load_plugins():
+    global _plugins_loaded
+    _plugins_loaded = True
+    from importlib.metadata import entry_points
+    try:
+        eps = entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:  # python < 3.10
+        eps = entry_points().get(ENTRY_POINT_GROUP, [])
+    for ep in eps:
+        if ep.name in BMS_MODELS:
+            logger.warning('BMS plugin %s (%s) conflicts with a built-in type, ignored', ep.name, ep.value)
+            continue
+        logger.info('BMS plugin %s (%s)', ep.name, ep.value)
+        register_bms_model(ep.name, ep.value)
+
+
 def get_bms_model_class(name):
-    import bmslib.models.ant
-    import bmslib.models.daly
-    import bmslib.models.dummy
-    import bmslib.models.jbd
-    import bmslib.models.jikong
-    import bmslib.models.sok
-    import bmslib.models.supervolt
-    import bmslib.models.victron
-    import bmslib.models.pq
-
-    import bmslib.group
-
-    bms_registry = dict(
-        daly=bmslib.models.daly.DalyBt,
-        jbd=bmslib.models.jbd.JbdBt,
-        jk=bmslib.models.jikong.JKBt,
-        ant=bmslib.models.ant.AntBt,
-        victron=bmslib.models.victron.SmartShuntBt,
-        group_parallel=bmslib.group.VirtualGroupBms,
-        # group_serial=bmslib.group.VirtualGroupBms, # TODO
-        supervolt=bmslib.models.supervolt.SuperVoltBt,
-        sok=bmslib.models.sok.SokBt,
-        pq=bmslib.models.pq.PowerQueenBt,
-        dummy=bmslib.models.dummy.DummyBt,
-    )
-
-    return bms_registry.get(name)
+    target = BMS_MODELS.get(name)
+    if target is None and not _plugins_loaded:
+        _load_plugins()
+        target = BMS_MODELS.get(name)
+    if target is None:
+        return None
+
+    if isinstance(target, str):
+        module, _, attr = target.partition(':')
+        target = getattr(import_module(module), attr)
+        BMS_MODELS[name] = target
+    return target
 
 
 def construct_bms(dev, verbose_log, bt_discovered_devices):
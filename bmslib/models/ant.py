@@ -22,6 +22,7 @@ import crcmod as crcmod
 
 from bmslib.bms import BmsSample, DeviceInfo
 from bmslib.bt import BtBms
+from bmslib.framing import FrameAssembler
 from bmslib.util import to_hex_str
 
 crc16_modbus = crcmod.mkCrcFun(0x18005, rev=True, initCrc=0xFFFF, xorOut=0x0000)
@@ -52,6 +53,11 @@ def _ant_command(func: AntCommandFuncs, addr, value):
     return frame
 
 
+def _ant_frame_len(buf: memoryview):
+    # 7E A1 func addr addr len [data] crc crc AA 55
+    return 6 + buf[5] + 4 if len(buf) >= 6 else None
+
+
 class AntBt(BtBms):
     CHAR_UUID = '0000ffe1-0000-1000-8000-00805f9b34fb'  # Handle 0x10
     TIMEOUT = 16
@@ -62,43 +68,25 @@ class AntBt(BtBms):
 
     def __init__(self, address, **kwargs):
         super().__init__(address, _uses_pin=False, **kwargs)
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(header=b'\x7E\xA1', frame_len=_ant_frame_len, check=self._frame_crc_check,
+                                      name=self.name)
         self._switches = None
         self._last_response = None
         self._voltages = []
 
-    def _notification_handler(self, sender, data: bytes):
-
-        # MAX_RESPONSE_SIZE = 152
+    def _frame_crc_check(self, frame: memoryview):
+        crc = calc_crc16(frame[1:len(frame) - 4])
+        crc_exp = list(frame[-4:-2])
+        if crc != crc_exp:
+            self.logger.warning('CRC16 error: %s != %s (expected)', crc, crc_exp)
+            return False
+        return True
 
+    def _notification_handler(self, sender, data: bytes):
         # print("bms msg {0}: {1} {2}".format(sender, to_hex_str(data), data))
-
-        if data.startswith(b'\x7E\xA1'):
-            self._buffer.clear()
-
-        self._buffer += data
-
-        if self._buffer.endswith(b'\x55'):
-            buf = self._buffer
-            func = buf[2]
-            data_len = buf[5]
-            frame_len = 6 + data_len + 4
-
-            if len(buf) < frame_len:
-                self.logger.warning('Unexpected size: header says %d, got %d bytes', frame_len, len(buf))
-                buf.clear()
-                return
-
-            crc = calc_crc16(buf[1:1 + frame_len - 5])
-            crc_exp = list(buf[frame_len - 4:frame_len - 2])
-
-            self._last_response = buf[:]
-            self._buffer.clear()
-
-            if crc != crc_exp:
-                self.logger.warning('CRC16 error: %s != %s (expected)', crc, crc_exp)
-            else:
-                self._fetch_futures.set_result(func, self._last_response)
+        for frame in self._frames.feed(data):
+            self._last_response = bytes(frame)
+            self._fetch_futures.set_result(frame[2], self._last_response)
 
     async def connect(self, timeout=20, **kwargs):
         # await super().connect(**kwargs)
@@ -120,13 +108,13 @@ class AntBt(BtBms):
             return await self._fetch_futures.wait_for(resp_code, self.TIMEOUT)
 
     async def fetch_device_info(self) -> DeviceInfo:
-        buf: bytearray = await self._q(AntCommandFuncs.DeviceInfo, 0x026c, 0x20, resp_code=0x12)
-        hw = bytearray.decode(buf[6:6 + 16].strip(b'\0'), 'utf-8')
+        buf: bytes = await self._q(AntCommandFuncs.DeviceInfo, 0x026c, 0x20, resp_code=0x12)
+        hw = bytes.decode(buf[6:6 + 16].strip(b'\0'), 'utf-8')
         dev = DeviceInfo(
             mnf="ANT",
             model='ANT-' + hw,
             hw_version=hw,
-            sw_version=bytearray.decode(buf[22:22 + 16].strip(b'\0'), 'utf-8'),
+            sw_version=bytes.decode(buf[22:22 + 16].strip(b'\0'), 'utf-8'),
             name=None,
             sn=None,
         )
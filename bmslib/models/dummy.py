@@ -2,6 +2,7 @@
 This is code for a dummy BMS wich doesn't physically exist.
 
 """
+import asyncio
 import math
 import random
 import time
@@ -9,6 +10,8 @@ from functools import partial
 from threading import Thread
 from typing import Callable, Union
 
+import bleak.exc
+
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
 from bmslib.util import get_logger, dotdict
@@ -64,6 +67,54 @@ class DummyBt(BtBms):
         self._switches[switch] = state
 
 
+class SimulatedBt(DummyBt):
+    """
+    DummyBt with bluetooth-like timing, for load tests: random connect and notification delays, occasional fetch
+    timeouts and disconnects by the device (through `_on_disconnect`, like bleak's disconnected_callback).
+    """
+
+    def __init__(self, address, connect_delay=.8, fetch_delay=.15, timeout_rate=.005, disconnect_rate=.002,
+                 timeout=8., num_cells=16, seed=None, **kwargs):
+        super().__init__(address, **kwargs)
+        self.connect_delay = connect_delay
+        self.fetch_delay = fetch_delay
+        self.timeout_rate = timeout_rate
+        self.disconnect_rate = disconnect_rate
+        self.timeout = timeout
+        self.num_cells = num_cells
+        self._rnd = random.Random(seed)
+
+    def _delay(self, mean: float) -> float:
+        # BLE latencies are right-skewed
+        return self._rnd.lognormvariate(math.log(mean), .4) if mean > 0 else 0.
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(self._delay(self.connect_delay))
+        if self._rnd.random() < self.timeout_rate:
+            raise asyncio.TimeoutError('%s connect timeout' % self.name)
+        await super().connect(**kwargs)
+
+    async def _notification(self):
+        if self._rnd.random() < self.timeout_rate:
+            await asyncio.sleep(self.timeout)
+            raise asyncio.TimeoutError('%s timeout waiting for notification' % self.name)
+        if self._rnd.random() < self.disconnect_rate:
+            await asyncio.sleep(self._delay(self.fetch_delay))
+            self._connected = False
+            self._on_disconnect(self)
+            raise bleak.exc.BleakError('%s disconnected' % self.name)
+        await asyncio.sleep(self._delay(self.fetch_delay))
+
+    async def fetch(self) -> BmsSample:
+        await self._notification()
+        return await super().fetch()
+
+    async def fetch_voltages(self):
+        await self._notification()
+        o = int(self.I * self._cell_r * -1000)
+        return [3300 + o + (i * 7) % 20 for i in range(self.num_cells)]
+
+
 class BleakDummyClient:
     def __init__(self, address: str, disconnected_callback):
         self.address = address
@@ -100,6 +151,9 @@ class BleakDummyClient:
     async def start_notify(self, char_specifier, callback: Callable[[int, bytearray], None]):
         return await self._bms.start_notify(char_specifier, callback)
 
+    async def stop_notify(self, char_specifier):
+        pass
+
     async def write_gatt_char(self, char_specifier, data: Union[bytes, bytearray, memoryview],
                               response: bool = False, ):
         return await self._bms.write_gatt_char(char_specifier, data, response)
@@ -16,12 +16,18 @@ import asyncio
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.framing import FrameAssembler
 
 
 def _jbd_command(command: int):
     return bytes([0xDD, 0xA5, command, 0x00, 0xFF, 0xFF - (command - 1), 0x77])
 
 
+def _jbd_frame_len(buf: memoryview):
+    # DD cmd status len [data] chk chk 77
+    return buf[3] + 7 if len(buf) >= 4 else None
+
+
 class JbdBt(BtBms):
     UUID_RX = '0000ff01-0000-1000-8000-00805f9b34fb'
     UUID_TX = '0000ff02-0000-1000-8000-00805f9b34fb'
@@ -31,21 +37,17 @@ class JbdBt(BtBms):
         super().__init__(address, **kwargs)
         if kwargs.get('psk'):
             self.logger.warning('JBD usually does not use a pairing PIN')
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(header=b'\xDD', frame_len=_jbd_frame_len, check=lambda f: f[-1] == 0x77,
+                                      name=self.name)
         self._switches = None
         self._last_response = None
 
     def _notification_handler(self, sender, data):
 
         # print("bms msg {0}: {1}".format(sender, data))
-        self._buffer += data
-
-        if self._buffer.endswith(b'w'):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
-
-            # print(command, 'buffer endswith w', self._buffer)
+        for frame in self._frames.feed(data):
+            command = frame[1]
+            buf = bytes(frame)
             self._last_response = buf
             self._fetch_futures.set_result(command, buf)
 
@@ -17,12 +17,16 @@ fix connection abort:
 
 """
 import asyncio
+import functools
+import math
+import struct
 import time
 from collections import defaultdict
 from typing import List, Callable, Dict, Tuple
 
 from bmslib.bms import BmsSample, DeviceInfo
 from bmslib.bt import BtBms
+from bmslib.framing import FrameAssembler
 from bmslib.util import to_hex_str
 
 
@@ -44,8 +48,69 @@ def _jk_command(address, value: list = ()):
     return frame
 
 
+HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
 MIN_RESPONSE_SIZE = 300
-MAX_RESPONSE_SIZE = 320
+
+# JK02 cell info frame (0x02) layout: (name, offset, struct format, scale).
+# 11.x firmware (32 cell version) shifts all fields by 32 bytes, except the cell voltages
+JK02_FIELDS = (
+    ('voltage', 118, 'I', 1e-3),
+    ('current', 126, 'i', -1e-3),
+    ('temp1', 130, 'h', 1),
+    ('temp2', 132, 'h', 1),
+    ('balance_current', 138, 'h', 1e-3),
+    ('soc', 141, 'B', 1),
+    ('charge', 142, 'I', 1e-3),  # "remaining capacity"
+    ('capacity', 146, 'I', 1e-3),  # computed capacity (starts at self.capacity, which is user-defined)
+    ('num_cycles', 150, 'I', 1),
+    ('cycle_capacity', 154, 'I', 1e-3),  # total charge TODO rename cycle charge
+    ('uptime', 162, 'I', 1.),  # seconds
+)
+JK02_FIELDS_OLD = JK02_FIELDS + (
+    ('mos_temperature', 134, 'h', .1),
+)
+JK02_FIELDS_11FW = JK02_FIELDS + (
+    ('mos_temperature', 112, 'h', .1),
+    ('temp3', 224, 'h', 1),
+    ('temp4', 226, 'h', 1),
+)
+JK02_CELLS_OFFSET = 6
+
+
+@functools.lru_cache(maxsize=8)
+def jk02_layout(is_new_11fw: bool, num_cells: int) -> Tuple[struct.Struct, Tuple[str, ...], Tuple[float, ...]]:
+    """
+    Compile the field table of a firmware variant into a single struct, with pad bytes between the fields.
+    The unpacked tuple starts with `num_cells` cell voltages (mV), followed by the fields in `names`.
+    """
+    offset = 32 if is_new_11fw else 0
+    fields = [('cell', JK02_CELLS_OFFSET + i * 2, 'H', 1) for i in range(num_cells)]
+    fields += sorted(((name, off + offset, fmt, scale) for name, off, fmt, scale in
+                      (JK02_FIELDS_11FW if is_new_11fw else JK02_FIELDS_OLD)), key=lambda f: f[1])
+
+    fmt = '<'
+    pos = 0
+    for name, off, f, _ in fields:
+        assert off >= pos, "field %s overlaps" % name
+        if off > pos:
+            fmt += '%dx' % (off - pos)
+        fmt += f
+        pos = off + struct.calcsize('<' + f)
+    assert pos <= MIN_RESPONSE_SIZE
+
+    return struct.Struct(fmt), tuple(f[0] for f in fields[num_cells:]), tuple(f[3] for f in fields[num_cells:])
+
+
+def decode_jk02(buf, num_cells: int) -> Tuple[Dict[str, float], Tuple[int, ...]]:
+    """
+    Decode a 0x02 frame in one pass.
+    :return: scalar fields (scaled), cell voltages in mV
+    """
+    is_new_11fw = buf[189] in {0x0, 0x1} and buf[189 + 32] > 0  # 32 cell version
+    st, names, scales = jk02_layout(is_new_11fw, num_cells)
+    values = st.unpack_from(buf)
+    fields = {name: v * scale for name, v, scale in zip(names, values[num_cells:], scales)}
+    return fields, values[:num_cells]
 
 
 class JKBt(BtBms):
@@ -62,54 +127,34 @@ class JKBt(BtBms):
         super().__init__(address, **kwargs)
         if kwargs.get('psk'):
             self.logger.warning('JK usually does not use a pairing PIN')
-        self._buffer = bytearray()
-        self._resp_table: Dict[int, Tuple[bytearray, float]] = {}
+        self._frames = FrameAssembler(header=HEADER, frame_len=MIN_RESPONSE_SIZE, check=self._frame_crc_check,
+                                      name=self.name)
+        self._resp_table: Dict[int, Tuple[bytes, float]] = {}
         self.num_cells = None
-        self._callbacks: Dict[int, List[Callable[[bytes], None]]] = defaultdict(List)
+        self._callbacks: Dict[int, List[Callable[[bytes], None]]] = defaultdict(list)
         self.char_handle_notify = None
         self.char_handle_write = None
+        self._t_last_fetch = 0
+        self._decoded = None
 
-    def _buffer_crc_check(self):
-        crc_comp = calc_crc(self._buffer[0:MIN_RESPONSE_SIZE - 1])
-        crc_expected = self._buffer[MIN_RESPONSE_SIZE - 1]
+    def _frame_crc_check(self, frame: memoryview):
+        crc_comp = calc_crc(frame[0:MIN_RESPONSE_SIZE - 1])
+        crc_expected = frame[MIN_RESPONSE_SIZE - 1]
         if crc_comp != crc_expected:
-            self.logger.debug("crc check failed, %s != %s, %s", crc_comp, crc_expected, self._buffer)
+            self.logger.debug("crc check failed, %s != %s, %s", crc_comp, crc_expected, to_hex_str(frame))
         return crc_comp == crc_expected
 
     def _notification_handler(self, _sender, data):
-        HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
-
-        if data[0:4] == HEADER:  # and len(self._buffer)
-            self.logger.debug("header, clear buf %s", self._buffer)
-            self._buffer.clear()
-
-        self._buffer += data
-
-        self.logger.debug("bms msg(%d) (buf%d): %s\n", len(data), len(self._buffer), to_hex_str(data))
-
-        if len(self._buffer) >= MIN_RESPONSE_SIZE:
-            if len(self._buffer) > MAX_RESPONSE_SIZE:
-                self.logger.warning('buffer longer than expected %d %s', len(self._buffer), self._buffer)
+        self.logger.debug("bms msg(%d) (buf%d): %s\n", len(data), len(self._frames), to_hex_str(data))
 
-            crc_ok = self._buffer_crc_check()
+        for frame in self._frames.feed(data):
+            self._decode_msg(bytes(frame))
 
-            if not crc_ok and HEADER in self._buffer:
-                idx = self._buffer.index(HEADER)
-                self.logger.debug("crc check failed, header at %d, discarding start of %s", idx, self._buffer)
-                self._buffer = self._buffer[idx:]
-                crc_ok = self._buffer_crc_check()
-
-            if not crc_ok:
-                self.logger.error("crc check failed, discarding buffer %s", self._buffer)
-            else:
-                self._decode_msg(bytearray(self._buffer))
-            self._buffer.clear()
-
-    def _decode_msg(self, buf: bytearray):
+    def _decode_msg(self, buf: bytes):
         resp_type = buf[4]
         self.logger.debug('got response %d (len%d)', resp_type, len(buf))
         self._resp_table[resp_type] = buf, time.time()
-        self._fetch_futures.set_result(resp_type, self._buffer[:])
+        self._fetch_futures.set_result(resp_type, buf)
         callbacks = self._callbacks.get(resp_type, None)
         if callbacks:
             for cb in callbacks:
@@ -188,41 +233,39 @@ class JKBt(BtBms):
                           sn=read_str(buf, 6 + 16 + 8 + 16 + 40),
                           )
 
-    def _decode_sample(self, buf: bytearray, t_buf: float) -> BmsSample:
-        buf_set, t_set = self._resp_table[0x01]
+    def _decode_frame(self, buf: bytes):
+        # fetch() and fetch_voltages() usually decode the same frame. num_cells is part of the key, a frame can be
+        # decoded (e.g. pushed) before the settings frame sets it
+        num_cells = self.num_cells or 0
+        if self._decoded is None or self._decoded[0] is not buf or self._decoded[1] != num_cells:
+            self._decoded = buf, num_cells, *decode_jk02(buf, num_cells)
+        return self._decoded[2:]
 
-        is_new_11fw = buf[189] in {0x0, 0x1} and buf[189 + 32] > 0  # 32 cell version
-        offset = 0
-        if is_new_11fw:
-            offset = 32
-            self.logger.debug('New 11.x firmware, offset=%s', offset)
+    def _decode_sample(self, buf: bytes, t_buf: float) -> BmsSample:
+        buf_set, t_set = self._resp_table[0x01]
 
-        i16 = lambda i: int.from_bytes(buf[i:(i + 2)], byteorder='little', signed=True)
-        u32 = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=False)
-        f32u = lambda i: u32(i) * 1e-3
-        f32s = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=True) * 1e-3
+        f, _ = self._decode_frame(buf)
 
-        temp = lambda x: float('nan') if x == -2000 else (x / 10)
+        temp = lambda x: math.nan if x == -2000 else (x / 10)
 
-        temperatures = [temp(i16(130 + offset)), temp(i16(132 + offset))]
-        if is_new_11fw:
-            temperatures += [temp(i16(224 + offset)), temp(i16(226 + offset))]
+        temperatures = [temp(f['temp1']), temp(f['temp2'])]
+        if 'temp3' in f:
+            temperatures += [temp(f['temp3']), temp(f['temp4'])]
 
         return BmsSample(
-            voltage=f32u(118 + offset),
-            current=-f32s(126 + offset),
-            soc=buf[141 + offset],
+            voltage=f['voltage'],
+            current=f['current'],
+            soc=f['soc'],
 
-            cycle_capacity=f32u(154 + offset),  # total charge TODO rename cycle charge
-            capacity=f32u(146 + offset),  # computed capacity (starts at self.capacity, which is user-defined),
-            charge=f32u(142 + offset),  # "remaining capacity"
+            cycle_capacity=f['cycle_capacity'],
+            capacity=f['capacity'],
+            charge=f['charge'],
 
             temperatures=temperatures,
-            mos_temperature=i16((112 if is_new_11fw else 134) + offset) / 10,
-            balance_current=i16(138 + offset) / 1000,
+            mos_temperature=f['mos_temperature'],
+            balance_current=f['balance_current'],
 
-            # 146 charge_full (see above)
-            num_cycles=u32(150 + offset),
+            num_cycles=f['num_cycles'],
             switches=dict(
                 charge=bool(buf_set[118]),
                 discharge=bool(buf_set[122]),
@@ -230,7 +273,7 @@ class JKBt(BtBms):
             ),
             #  #buf[166 + offset]),  charge FET state
             # buf[167 + offset]), discharge FET state
-            uptime=float(u32(162 + offset)),  # seconds
+            uptime=f['uptime'],
             timestamp=t_buf,
         )
 
@@ -243,7 +286,8 @@ class JKBt(BtBms):
         * https://github.com/jblance/mpp-solar/blob/master/mppsolar/protocols/jk02.py
         """
 
-        if wait:
+        # the bms streams 0x02 frames, only wait if we already returned the latest one
+        if wait and self._resp_table.get(0x02, (None, 0))[1] <= self._t_last_fetch:
             with await self._fetch_futures.acquire_timeout(0x02, timeout=self.TIMEOUT / 2):
                 await self._fetch_futures.wait_for(0x02, self.TIMEOUT)
 
@@ -251,10 +295,16 @@ class JKBt(BtBms):
             await self._q(cmd=0x96, resp=0x01)  # query settings
 
         buf, t_buf = self._resp_table[0x02]
+        self._t_last_fetch = t_buf
         return self._decode_sample(buf, t_buf)
 
     async def subscribe(self, callback: Callable[[BmsSample], None]):
-        self._callbacks[0x02].append(lambda buf: callback(self._decode_sample(buf, t_buf=time.time())))
+        def _on_frame(buf):
+            if 0x01 not in self._resp_table:
+                return  # settings (switch states) not available, the next poll fetch queries them
+            callback(self._decode_sample(buf, t_buf=time.time()))
+
+        self._callbacks[0x02].append(_on_frame)
 
     async def fetch_voltages(self):
         """
@@ -263,9 +313,8 @@ class JKBt(BtBms):
         if self.num_cells is None:
             raise Exception("num_cells not set")
         buf, t_buf = self._resp_table[0x02]
-        voltages = [int.from_bytes(buf[(6 + i * 2):(6 + i * 2 + 2)], byteorder='little') for i in
-                    range(self.num_cells)]
-        return voltages
+        _, voltages = self._decode_frame(buf)
+        return list(voltages)
 
     async def set_switch(self, switch: str, state: bool):
         # from https://github.com/syssi/esphome-jk-bms/blob/4079c22eaa40786ffa0cabd45d0d98326a1fdd29/components/jk_bms_ble/switch/__init__.py
@@ -277,6 +326,8 @@ class JKBt(BtBms):
         await self._write(addresses[switch], [0x1 if state else 0x0, 0, 0, 0])
         await asyncio.sleep(.2)  # wait a bit before triggering settings fetch
         self._resp_table.pop(0x01, None)  # invalidate settings frame which stores switch states
+        if self._callbacks.get(0x02):
+            await self._q(cmd=0x96, resp=0x01)  # no poll fetch in push mode, re-query settings now
         # await asyncio.sleep(0.2)  # not sure if this is needed
 
     def debug_data(self):
@@ -1,9 +1,9 @@
 import json
 import asyncio
 import logging
-from request import Request
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.framing import FrameAssembler
 
 class PowerQueenBt(BtBms):
     BMS_CHARACTERISTIC_ID = '0000FFE1-0000-1000-8000-00805F9B34FB'  # Bluetooth characteristic for BMS data
@@ -26,12 +26,12 @@ class PowerQueenBt(BtBms):
         self.SOH = None
         self.dischargesCount = None
         self.dischargesAHCount = None
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(terminator=b'w', name=self.name)
 
     def _notification_handler(self, sender, data):
-        self._buffer += data
-        if self._buffer.endswith(b'w'):
-            self._buffer.clear()
+        # responses are not used, fetch() reads the characteristic
+        for _ in self._frames.feed(data):
+            pass
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
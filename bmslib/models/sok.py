@@ -25,6 +25,7 @@ import statistics
 from bmslib import FuturesPool
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.framing import FrameAssembler
 
 
 def get_str(ubit, uuid):
@@ -86,21 +87,14 @@ class SokBt(BtBms):
 
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
-        self._buffer = bytearray()
+        self._frames = FrameAssembler(terminator=b'w', name=self.name)
         self._fetch_futures = FuturesPool()
         self._switches = None
 
     def _notification_handler(self, sender, data):
         self.logger.debug("ble data frame %s", data)
-        self._buffer += data
-
-        if self._buffer.endswith(b'w'):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
-
-            # print(command, 'buffer endswith w', self._buffer)
-            self._fetch_futures.set_result(command, buf)
+        for frame in self._frames.feed(data):
+            self._fetch_futures.set_result(frame[1], bytes(frame))
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
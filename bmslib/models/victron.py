@@ -7,7 +7,7 @@ import math
 import sys
 import time
 from functools import partial
-from typing import Optional
+from typing import Optional, List, Callable
 
 from bmslib.bms import BmsSample, DeviceInfo
 from bmslib.bt import BtBms
@@ -49,12 +49,15 @@ def parse_value(data, char):
 
 class SmartShuntBt(BtBms):
     TIMEOUT = 8
+    PUSH_COALESCE = 0.1  # characteristics are notified one by one, wait for the burst to complete
 
     def __init__(self, address, **kwargs):
         super().__init__(address, _uses_pin=True, **kwargs)
         self._keep_alive_task: Optional[asyncio.Task] = None
         self._values = {}
         self._values_t = {k: 0 for k in VICTRON_CHARACTERISTICS.keys()}
+        self._push_callbacks: List[Callable[[BmsSample], None]] = []
+        self._push_handle: Optional[asyncio.TimerHandle] = None
 
     async def _keep_alive_loop(self):
         interval = 20_000
@@ -102,6 +105,24 @@ class SmartShuntBt(BtBms):
         self._values_t[key] = time.time()
         self.logger.debug('msg %s %s', key, val)
 
+        if self._push_callbacks and self._push_handle is None:
+            self._push_handle = asyncio.get_event_loop().call_later(self.PUSH_COALESCE, self._push_sample)
+
+    def _push_sample(self):
+        self._push_handle = None
+        if len(self._values) < len(VICTRON_CHARACTERISTICS):
+            return  # still subscribing
+        sample = self._make_sample()
+        for callback in self._push_callbacks:
+            callback(sample)
+
+    def _make_sample(self) -> BmsSample:
+        values = self._values
+        return BmsSample(**values, timestamp=max(v for k, v in self._values_t.items() if not math.isnan(values[k])))
+
+    async def subscribe(self, callback: Callable[[BmsSample], None]):
+        self._push_callbacks.append(callback)
+
     async def fetch(self) -> BmsSample:
 
         t_expire = time.time() - 10
@@ -112,9 +133,7 @@ class SmartShuntBt(BtBms):
                 if val != self._values.get(k):
                     self.logger.warning('value for %s expired %s, re-sub', k, t)
                     await self._subscribe(k, val)
-        values = self._values
-        sample = BmsSample(**values, timestamp=max(v for k, v in self._values_t.items() if not math.isnan(values[k])))
-        return sample
+        return self._make_sample()
 
     async def fetch_voltages(self):
         return []
@@ -1,5 +1,10 @@
 import math
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class EWMA:
     # Implement Exponential Weighted Moving Average
@@ -115,6 +120,38 @@ class Integrator:
         self._last_x = x
         self._last_y = y
 
+    def add_batch(self, x, y):
+        """
+        Integrate sequences (or numpy arrays) of x and y in one call, same as `add_linear` for each pair.
+        Vectorized if numpy is installed.
+        """
+        if np is None:
+            for xi, yi in zip(x, y):
+                self.add_linear(xi, yi)
+            return
+        x, y, dx = self._batch_arrays(x, y)
+        if dx is not None:
+            m = dx <= self.dx_max  # gaps, nan x
+            self._integrator += float(np.dot(dx[m], (y[1:][m] + y[:-1][m]))) * .5
+
+    def _batch_arrays(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if x.shape != y.shape or x.ndim != 1:
+            raise ValueError("x and y must be 1d and of the same length")
+        if not len(x):
+            return x, y, None
+        if not math.isnan(self._last_x):
+            x = np.concatenate(((self._last_x,), x))
+            y = np.concatenate(((self._last_y,), y))
+        dx = np.diff(x)
+        if (dx < 0).any():
+            i = int(np.argmax(dx < 0))
+            raise ValueError("x must be monotonic increasing (given %s, last %s)" % (x[i + 1], x[i]))
+        self._last_x = float(x[-1])
+        self._last_y = float(y[-1])
+        return x, y, dx
+
     def get(self):
         return self._integrator
 
@@ -147,6 +184,16 @@ class DiffAbsSum(Integrator):
         self._last_x = x
         self._last_y = y
 
+    def add_batch(self, x, y):
+        if np is None:
+            for xi, yi in zip(x, y):
+                self.add_diff(xi, yi)
+            return
+        x, y, dx = self._batch_arrays(x, y)
+        if dx is not None:
+            dy = np.abs(np.diff(y))
+            self._integrator += float(dy[(dx <= self.dx_max) & (dy <= self.dy_max)].sum())
+
     def __iadd__(self, other):
         assert isinstance(other, tuple)
         self.add_diff(*other)
@@ -187,6 +234,27 @@ def test_diff_abs_sum():
     assert round(i.get(), 5) == 0.2
 
 
+def test_add_batch():
+    x = [0, 1, 1, 2, 3, 5, 5.5, 6]
+    y = [1, 1, 2, 2, 3, 3, 1.2, 1.25]
+    for cls, kw in ((Integrator, {}), (DiffAbsSum, dict(dy_max=0.5))):
+        a, b = cls("a", dx_max=1, **kw), cls("b", dx_max=1, **kw)
+        for xy in zip(x, y):
+            a += xy
+        b += (x[0], y[0])
+        b.add_batch(x[1:5], y[1:5])  # continues from the last point
+        b.add_batch(x[5:], y[5:])
+        assert round(a.get(), 9) == round(b.get(), 9)
+
+    i = Integrator("test", dx_max=1)
+    i.add_batch([0, 1, 2], [1, 1, 1])
+    try:
+        i.add_batch([3, 1.5], [1, 1])
+        assert False
+    except ValueError:
+        pass
+
+
 def test_lhq():
     l = LHQ(span=2, inp_q=.1)
     l.add(0)
@@ -197,4 +265,5 @@ def test_lhq():
 if __name__ == "__main__":
     test_integrator()
     test_diff_abs_sum()
+    test_add_batch()
     test_lhq()
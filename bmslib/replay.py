@@ -0,0 +1,353 @@
+"""
+Capture and replay of BLE sessions, for debugging and reproducible benchmarks without hardware.
+
+`CaptureRecorder` wraps a bleak client and writes every connect, notification, write and read with a timestamp to a
+capture file (one JSON object per line, optionally gzipped). Enable it per device with `capture: true`.
+
+`ReplayClient` plays a capture back into any BMS model. Use `replay:<path>` as device address, with optional
+`?speed=10` (0 = no delays) and `&loop=0`. Each write of the model is matched with a recorded write (exact, else the
+longest common prefix on the same characteristic) and the notifications that followed it in the recording are sent
+with their recorded delays. A trailing stream (2 or more notifications after the last write, e.g. JK) is looped.
+
+Capture format:
+    {"format": "batmon-capture", "version": 1, "model": "jk", "address": "..", "name": ".."}
+    {"t": 0.01, "op": "connect", "services": [{"uuid": .., "characteristics": [{"uuid": .., "handle": .., ..}]}]}
+    {"t": 0.12, "op": "subscribe", "char": "0000ffe1-0000-1000-8000-00805f9b34fb"}
+    {"t": 0.23, "op": "write", "char": "0000ffe1-0000-1000-8000-00805f9b34fb", "data": "aa5590eb97.."}
+    {"t": 0.31, "op": "notify", "char": "0000ffe1-0000-1000-8000-00805f9b34fb", "data": "55aaeb9003.."}
+    {"t": 9.80, "op": "disconnect"}
+"""
+import asyncio
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Union
+from urllib.parse import parse_qs
+
+from bmslib.util import get_logger, dotdict
+
+logger = get_logger()
+
+REPLAY_PREFIX = 'replay:'
+FORMAT = 'batmon-capture'
+VERSION = 1
+
+_sessions: Dict[tuple, 'CaptureSession'] = {}
+
+
+def _char_key(char_specifier) -> Union[str, int]:
+    """ Normalize a characteristic specifier (uuid, handle or characteristic object) """
+    if isinstance(char_specifier, int):
+        return char_specifier
+    return str(getattr(char_specifier, 'uuid', char_specifier)).lower()
+
+
+def _open(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def model_slug(cls) -> Optional[str]:
+    """ Device type of a driver class (reverse lookup in `BMS_MODELS`) """
+    from bmslib.models import BMS_MODELS
+    ref = '%s:%s' % (cls.__module__, cls.__qualname__)
+    return next((name for name, target in BMS_MODELS.items() if target is cls or target == ref), None)
+
+
+class CaptureRecorder:
+    """ Proxy of a bleak client that records the session to `path` """
+
+    def __init__(self, client, path: str, model: Optional[str] = None, name: Optional[str] = None):
+        self.client = client
+        self.path = path
+        self._t0 = time.time()
+        self._t_flush = self._t0
+        self._lock = threading.Lock()  # notifications can arrive from other threads
+        self._f = _open(path, 'w')
+        self._record(dict(format=FORMAT, version=VERSION, model=model, address=client.address, name=name,
+                          time=self._t0), timestamp=False)
+
+    def __getattr__(self, item):
+        return getattr(self.client, item)
+
+    def _record(self, ev: dict, timestamp=True, flush=False):
+        if timestamp:
+            ev = dict(t=round(time.time() - self._t0, 4), **ev)
+        line = json.dumps(ev, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._f.closed:
+                return
+            self._f.write(line)
+            if flush or time.time() - self._t_flush > 5:
+                self._f.flush()
+                self._t_flush = time.time()
+
+    @staticmethod
+    def _services(client) -> list:
+        try:
+            services = client.services or []
+        except Exception:
+            return []
+        return [dict(uuid=s.uuid, handle=getattr(s, 'handle', None),
+                     characteristics=[dict(uuid=c.uuid, handle=c.handle, properties=(
+                         c.properties.split(',') if isinstance(c.properties, str) else list(c.properties)))
+                                      for c in s.characteristics])
+                for s in services]
+
+    async def connect(self, **kwargs):
+        res = await self.client.connect(**kwargs)
+        self._record(dict(op='connect', services=self._services(self.client)), flush=True)
+        return res
+
+    async def disconnect(self):
+        self._record(dict(op='disconnect'), flush=True)
+        return await self.client.disconnect()
+
+    async def start_notify(self, char_specifier, callback: Callable, **kwargs):
+        key = _char_key(char_specifier)
+
+        def _callback(sender, data):
+            self._record(dict(op='notify', char=key, data=bytes(data).hex()))
+            return callback(sender, data)
+
+        res = await self.client.start_notify(char_specifier, _callback, **kwargs)
+        self._record(dict(op='subscribe', char=key))
+        return res
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False, **kwargs):
+        self._record(dict(op='write', char=_char_key(char_specifier), data=bytes(data).hex()))
+        return await self.client.write_gatt_char(char_specifier, data, response, **kwargs)
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        data = await self.client.read_gatt_char(char_specifier, **kwargs)
+        self._record(dict(op='read', char=_char_key(char_specifier), data=bytes(data).hex()))
+        return data
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+class Segment:
+    """ A recorded write and the notifications that followed it, (delay, char, data) relative to the write """
+    __slots__ = ('char', 'data', 't', 'frames')
+
+    def __init__(self, char, data: Optional[bytes], t: float):
+        self.char = char
+        self.data = data
+        self.t = t
+        self.frames: List[tuple] = []
+
+
+class CaptureSession:
+
+    def __init__(self, header: dict, events: List[dict]):
+        self.header = header
+        self.services: list = []
+        self.reads: Dict[Union[str, int], List[bytes]] = {}
+        # notifications before the first write (sent on subscribe) go into segment 0
+        self.segments: List[Segment] = [Segment(None, None, 0.)]
+
+        for ev in events:
+            op = ev.get('op')
+            if op == 'connect':
+                if not self.services:
+                    self.services = ev.get('services') or []
+            elif op == 'subscribe':
+                if len(self.segments) == 1 and not self.segments[0].frames:
+                    self.segments[0].t = ev['t']
+            elif op == 'write':
+                self.segments.append(Segment(ev['char'], bytes.fromhex(ev['data']), ev['t']))
+            elif op == 'notify':
+                seg = self.segments[-1]
+                seg.frames.append((max(0., ev['t'] - seg.t), ev['char'], bytes.fromhex(ev['data'])))
+            elif op == 'read':
+                self.reads.setdefault(ev['char'], []).append(bytes.fromhex(ev['data']))
+
+    @classmethod
+    def load(cls, path: str) -> 'CaptureSession':
+        """ Load (cached, replayed devices can share a capture) """
+        key = (path, os.path.getmtime(path))
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = cls._load(path)
+        return session
+
+    @classmethod
+    def _load(cls, path: str) -> 'CaptureSession':
+        lines = []
+        with _open(path, 'r') as f:
+            try:
+                for l in f:
+                    if l.strip():
+                        lines.append(json.loads(l))
+            except (EOFError, ValueError, OSError, zlib.error):
+                pass  # recording not closed (incomplete gzip stream) or torn last line
+        if not lines or lines[0].get('format') != FORMAT:
+            raise ValueError('%s is not a %s file' % (path, FORMAT))
+        return cls(lines[0], [l for l in lines[1:] if 'op' in l])
+
+    def match(self, char, data: bytes, start: int) -> Optional[int]:
+        """ Index of the segment whose write matches, searching from `start` (wrapping around) """
+        n = len(self.segments) - 1
+        best, best_len = None, 0
+        for k in range(n):
+            i = 1 + (start - 1 + k) % n
+            seg = self.segments[i]
+            if seg.char != char:
+                continue
+            if seg.data == data:
+                return i
+            p = 0
+            for a, b in zip(seg.data, data):
+                if a != b:
+                    break
+                p += 1
+            if p > best_len:
+                best, best_len = i, p
+        return best
+
+    def is_stream(self, i: int) -> bool:
+        return i == len(self.segments) - 1 and len(self.segments[i].frames) >= 2
+
+
+class ReplayClient:
+    """ Stands in for `BleakClient`, plays back a capture file (address `replay:<path>[?speed=1&loop=1]`) """
+
+    def __init__(self, address: str, disconnected_callback=None):
+        path, _, qs = address[len(REPLAY_PREFIX):].partition('?')
+        opts = parse_qs(qs)
+        self.address = address
+        self.speed = float(opts.get('speed', ['1'])[0])
+        self.loop = opts.get('loop', ['1'])[0] not in ('0', 'false')
+        self.session = CaptureSession.load(path)
+        self._disconnected_callback = disconnected_callback
+        self._connected = False
+        self._callbacks: Dict[Union[str, int], Callable] = {}
+        self._cursor = 0
+        self._reads: Dict[Union[str, int], int] = {}
+        self._players: set = set()
+        self._stream: Optional[asyncio.Task] = None
+        self.num_notifications = 0
+
+        self.services = [
+            dotdict(uuid=s['uuid'], handle=s.get('handle'), characteristics=[
+                dotdict(uuid=c['uuid'], handle=c.get('handle'), properties=c.get('properties', []), descriptors=[])
+                for c in s.get('characteristics', [])])
+            for s in self.session.services]
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    async def connect(self, timeout=20, **kwargs):
+        self._connected = True
+
+    async def disconnect(self):
+        if not self._connected:
+            return
+        self._connected = False
+        self._callbacks.clear()
+        for task in list(self._players):
+            task.cancel()
+        cb = self._disconnected_callback
+        cb and cb(self)
+
+    async def pair(self, **kwargs):
+        return True
+
+    async def get_services(self):
+        return self.services
+
+    async def start_notify(self, char_specifier, callback: Callable, **kwargs):
+        first = not self._callbacks
+        self._callbacks[_char_key(char_specifier)] = callback
+        if first and self.session.segments[0].frames:
+            self._play(0)
+
+    async def stop_notify(self, char_specifier):
+        self._callbacks.pop(_char_key(char_specifier), None)
+
+    async def write_gatt_char(self, char_specifier, data, response: bool = False, **kwargs):
+        if not self._connected:
+            raise RuntimeError('%s not connected' % self.address)
+        i = self.session.match(_char_key(char_specifier), bytes(data), self._cursor + 1)
+        if i is None:
+            logger.debug('replay %s: no recorded write matches %s', self.address, bytes(data).hex())
+            return
+        self._cursor = i
+        if self._stream is not None:
+            self._stream.cancel()
+        self._play(i)
+
+    async def read_gatt_char(self, char_specifier, **kwargs) -> bytearray:
+        key = _char_key(char_specifier)
+        values = self.session.reads.get(key)
+        if not values:
+            raise RuntimeError('replay %s: no recorded reads of %s' % (self.address, key))
+        i = self._reads.get(key, 0)
+        self._reads[key] = i + 1
+        return bytearray(values[i % len(values)])
+
+    def _play(self, i: int):
+        task = asyncio.get_running_loop().create_task(self._player(i))
+        self._players.add(task)
+        task.add_done_callback(self._players.discard)
+
+    async def _player(self, i: int):
+        seg = self.session.segments[i]
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        offset = 0.
+        while True:
+            for dt, char, data in seg.frames:
+                if self.speed > 0:
+                    delay = t0 + (dt + offset) / self.speed - loop.time()
+                    await asyncio.sleep(max(0., delay))
+                else:
+                    await asyncio.sleep(0)
+                self._notify(char, data)
+
+            if not (self.loop and self.session.is_stream(i)):
+                return
+            # repeat the stream, keeping the average frame interval
+            self._stream = asyncio.current_task()
+            span = seg.frames[-1][0] - seg.frames[0][0]
+            offset += span + span / (len(seg.frames) - 1)
+
+    def _notify(self, char, data: bytes):
+        cb = self._callbacks.get(char)
+        if cb is None:
+            if len(self._callbacks) != 1:
+                return
+            cb = next(iter(self._callbacks.values()))
+        sender = next((c for s in self.services for c in s.characteristics if c.uuid == char or c.handle == char),
+                      char)
+        self.num_notifications += 1
+        try:
+            cb(sender, bytearray(data))
+        except Exception as e:
+            logger.warning('replay %s: notification callback error: %s', self.address, e, exc_info=True)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.disconnect()
+
+
+def open_replay(path: str, name: Optional[str] = None, speed=1., loop=True, **kwargs):
+    """ Construct the BMS model recorded in capture `path`, connected to a `ReplayClient` """
+    from bmslib.models import get_bms_model_class
+    session = CaptureSession.load(path)
+    model = session.header.get('model')
+    bms_class = model and get_bms_model_class(model)
+    if bms_class is None:
+        raise ValueError('unknown model %s in capture %s' % (model, path))
+    address = '%s%s?speed=%s&loop=%d' % (REPLAY_PREFIX, path, speed, loop)
+    return bms_class(address, name=name or session.header.get('name') or 'replay', **kwargs)
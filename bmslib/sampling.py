@@ -1,4 +1,5 @@
 import asyncio
+import json
 import math
 import random
 import re
@@ -6,7 +7,7 @@ import sys
 import time
 from collections import defaultdict
 from copy import copy
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Callable
 
 import paho.mqtt.client
 
@@ -14,11 +15,20 @@ import bmslib.bt
 from bmslib.algorithm import create_algorithm, BatterySwitches
 from bmslib.bms import DeviceInfo, BmsSample, MIN_VALUE_EXPIRY
 from bmslib.cache.mem import mem_cache_deco
+from bmslib.cellstats import CellStats
+from bmslib.connection import CircuitOpenError
 from bmslib.group import BmsGroup, GroupNotReady
+from bmslib.history import SampleHistory
+from bmslib.metrics import metrics
 from bmslib.pwmath import Integrator, DiffAbsSum, LHQ
 from bmslib.util import get_logger
 from mqtt_util import publish_sample, publish_cell_voltages, publish_temperatures, publish_hass_discovery, \
-    subscribe_switches, mqtt_single_out, round_to_n
+    subscribe_switches, mqtt_single_out, round_to_n, publish_sample_json, publish_cell_voltages_json, publish_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 logger = get_logger(verbose=False)
 
@@ -59,7 +69,7 @@ class BmsSampleSink:
     def publish_sample(self, bms_name: str, sample: BmsSample):
         raise NotImplementedError()
 
-    def publish_voltages(self, bms_name: str, voltages: List[int]):
+    def publish_voltages(self, bms_name: str, voltages: List[int], stats: Optional[CellStats] = None):
         raise NotImplementedError()
 
     def publish_meters(self, bms_name: str, readings: Dict[str, float]):
@@ -72,6 +82,8 @@ class BmsSampler:
     Also updates meters.
     """
 
+    PUSH_TIMEOUT = 10
+
     def __init__(self, bms: bmslib.bt.BtBms,
                  mqtt_client: paho.mqtt.client.Client,
                  dt_max_seconds,
@@ -83,7 +95,9 @@ class BmsSampler:
                  algorithms: Optional[list] = None,
                  current_calibration_factor=1.0,
                  over_power=None,
-                 bms_group: Optional[BmsGroup] = None
+                 bms_group: Optional[BmsGroup] = None,
+                 history_size=0,
+                 json_state=False,
                  ):
 
         self.bms = bms
@@ -91,6 +105,9 @@ class BmsSampler:
         self.mqtt_client = mqtt_client
         self.invert_current = invert_current
         self.expire_after_seconds = expire_after_seconds
+        if expire_after_seconds:
+            # re-publish unchanged values in time before HA expires them
+            publish_cache.set_device_ttl(self.mqtt_topic_prefix, expire_after_seconds / 2)
         self.device_info: Optional[DeviceInfo] = None
         self.num_samples = 0
         self.bms_group = bms_group  # group, virtual, parent
@@ -98,8 +115,10 @@ class BmsSampler:
         self.over_power = over_power or math.nan
 
         self.sinks = sinks or []
+        self.json_state = json_state  # publish a single JSON document per device instead of a topic per field
 
         self.downsampler = Downsampler()
+        self.history: Optional[SampleHistory] = SampleHistory(history_size) if history_size else None
 
         self.period_pub = PeriodicBoolSignal(period=publish_period or 0)
         self.period_discov = PeriodicBoolSignal(60 * 5)
@@ -112,7 +131,17 @@ class BmsSampler:
         self._t_last_power_jump = 0
 
         self._num_errors = 0
-        self._time_next_retry = 0
+
+        self._process_lock = asyncio.Lock()
+        self._log_data = False
+        self.cell_stats: Optional[CellStats] = None
+        self.last_sample: Optional[BmsSample] = None
+        self.sample_listeners: List[Callable[['BmsSampler'], None]] = []  # called after each processed sample
+
+        self._push_queue: Optional[asyncio.Queue] = None
+        self._push_task: Optional[asyncio.Task] = None
+        self._last_push_sample: Optional[BmsSample] = None
+        self._t_last_push = 0
 
         self.algorithm = None
         if algorithms:
@@ -144,25 +173,117 @@ class BmsSampler:
         temp_smooth = getattr(bms, 'TEMPERATURE_SMOOTH', 10)
         self._lhq_temp = defaultdict(lambda: LHQ(span=temp_smooth, inp_q=temp_step)) if temp_step else None
 
+    async def enable_push(self) -> bool:
+        """
+        Subscribe to samples pushed by the BMS. Pushed samples are processed as they arrive, the scheduled ticks
+        then only keep the connection alive (and fall back to polling if no samples arrive for PUSH_TIMEOUT).
+        Needs keep_alive.
+        :return: False if the BMS doesn't support push
+        """
+        loop = asyncio.get_running_loop()
+
+        def on_sample(sample: BmsSample):
+            # dummy devices call this from another thread
+            loop.call_soon_threadsafe(self._enqueue_push, sample)
+
+        try:
+            await self.bms.subscribe(on_sample)
+        except NotImplementedError:
+            return False
+
+        self._push_queue = asyncio.Queue(maxsize=4)
+        self._push_task = asyncio.create_task(self._push_loop())
+        return True
+
+    def stop(self):
+        """ Stop processing pushed samples """
+        if self._push_task is not None:
+            self._push_task.cancel()
+            self._push_task = None
+
+    def _enqueue_push(self, sample: BmsSample):
+        if self._push_queue.full():
+            # can't keep up with the BMS, drop the oldest sample
+            self._push_queue.get_nowait()
+        self._push_queue.put_nowait(sample)
+
+    async def _push_loop(self):
+        while True:
+            sample = await self._push_queue.get()
+            try:
+                await self._process_sample(sample)
+                self._last_push_sample = sample
+                self._t_last_push = time.time()
+            except SampleExpiredError as e:
+                logger.warning("%s: expired: %s", self.bms.name, e)
+            except GroupNotReady:
+                pass
+            except Exception as ex:
+                logger.error('%s error processing pushed sample: %s', self.bms.name, str(ex) or str(type(ex)),
+                             exc_info=1)
+
+    def _push_fresh(self):
+        return self._push_queue is not None and (time.time() - self._t_last_push) < self.PUSH_TIMEOUT
+
     def get_meter_state(self):
         return {meter.name: dict(reading=meter.get()) for meter in self.meters}
 
+    def _update_meters(self, t_hour, current, power, soc, charge):
+        # current and power after invert_current. the charge/discharge meters use the BMS sign, discharging P>0
+        bms_power = -power if self.invert_current else power
+        self.power_integrator_charge += (t_hour, abs(min(0, bms_power)) * 1e-3)  # kWh
+        self.power_integrator_discharge += (t_hour, abs(max(0, bms_power)) * 1e-3)  # kWh
+
+        self.current_integrator += (t_hour, current)  # Ah
+        self.power_integrator += (t_hour, power * 1e-3)  # kWh
+
+        self.cycle_integrator += (t_hour, soc * (0.01 / 2))  # SoC 100->0 is a half cycle
+        self.charge_integrator += (t_hour, charge)  # Ah
+
+    def backfill_meters(self, timestamps, current, power, soc, charge):
+        """
+        Integrate historic samples into the meters in one batch, e.g. to rebuild the meters from the local store.
+        Values as published (after invert_current), timestamps in seconds and increasing. Call before sampling starts.
+        """
+        if np is None:
+            nan = lambda v: math.nan if v is None else v
+            for row in zip(timestamps, current, power, soc, charge):
+                self._update_meters(row[0] * (1 / 3600), *map(nan, row[1:]))
+            return
+
+        t_hour = np.asarray(timestamps, dtype=float) * (1 / 3600)
+        current, power, soc, charge = (np.asarray(a, dtype=float) for a in (current, power, soc, charge))
+        bms_power = -power if self.invert_current else power
+        self.power_integrator_charge.add_batch(t_hour, np.maximum(-bms_power, 0) * 1e-3)
+        self.power_integrator_discharge.add_batch(t_hour, np.maximum(bms_power, 0) * 1e-3)
+        self.current_integrator.add_batch(t_hour, current)
+        self.power_integrator.add_batch(t_hour, power * 1e-3)
+        self.cycle_integrator.add_batch(t_hour, soc * (0.01 / 2))
+        self.charge_integrator.add_batch(t_hour, charge)
+
     async def __call__(self):
         self._num_errors += 1
         t_now = time.time()
+        name = self.bms.name
 
         try:
-            s = await self._sample_inner()
+            with metrics.timer('cycle', name):
+                s = await self._sample_inner()
             if s:
                 self._num_errors = 0
             return s
         except bmslib.bt.BleakDeviceNotFoundError:
-            t_wait = min(1.5 ** self._num_errors, 120)
-            logger.error("%s device not found, retry in %d seconds", self.bms, t_wait)
-            self._time_next_retry = time.time() + t_wait
+            metrics.inc('errors', name, 'BleakDeviceNotFoundError')
+            logger.error("%s device not found, retry in %d seconds", self.bms, self.bms.connection.retry_in())
+            return None
+
+        except CircuitOpenError as e:
+            metrics.inc('errors', name, 'CircuitOpenError')
+            logger.warning("%s", e)
             return None
 
         except SampleExpiredError as e:
+            metrics.inc('errors', name, 'SampleExpiredError')
             logger.warning("%s: expired: %s", self.bms.name, e)
             return None
 
@@ -174,6 +295,7 @@ class BmsSampler:
             return None
 
         except Exception as ex:
+            metrics.inc('errors', name, type(ex).__name__)
             logger.error('%s error (#%d): %s', self.bms.name, self._num_errors, str(ex) or str(type(ex)), exc_info=1)
             dd = self.bms.debug_data()
             dd and logger.info("%s bms debug data: %s", self.bms.name, dd)
@@ -186,17 +308,13 @@ class BmsSampler:
                 logger.warning('%s disconnect because no data has been flowing for some time', bms.name)
                 await bms.disconnect()
 
-            if bms.is_connected and self._num_errors > 20:
-                logger.warning("disconnecting %s due to too many errors %d", bms, self._num_errors)
-                await bms.disconnect()
-                self._num_errors = 0
-
             raise
 
     @mem_cache_deco(ttl=30)
     async def _fetch_temperatures_cached(self):
         try:
-            return await self.bms.fetch_temperatures()
+            with metrics.timer('temperatures', self.bms.name):
+                return await self.bms.fetch_temperatures()
         except:
             return None
 
@@ -207,7 +325,6 @@ class BmsSampler:
 
     async def _sample_inner(self):
         bms = self.bms
-        mqtt_client = self.mqtt_client
 
         was_connected = bms.is_connected
 
@@ -216,9 +333,9 @@ class BmsSampler:
 
         t_conn = time.time()
 
-        if not was_connected and t_conn < self._time_next_retry:
-            logger.debug('retry in %.0f sec', self._time_next_retry - t_conn)
-            await asyncio.sleep(4)
+        if not was_connected and not bms.is_virtual and bms.connection.retry_in() > 0:
+            # return right away, don't hold the sampling slot
+            logger.debug('retry in %.0f sec', bms.connection.retry_in())
             return None
 
         if not was_connected and not bms.is_virtual:
@@ -227,6 +344,9 @@ class BmsSampler:
         async with bms:
             if not was_connected:
                 logger.info('connected bms %s!', bms)
+                if not bms.is_virtual:
+                    metrics.inc('connects', bms.name)
+                    metrics.observe('connect', bms.name, time.time() - t_conn)
 
             if self.device_info is None and self.num_samples == 0:
                 # try to fetch device info first. if bms.fetch() fails we might have at least some details
@@ -234,185 +354,223 @@ class BmsSampler:
 
             t_fetch = time.time()
 
+            if self._push_fresh():
+                # samples are pushed by the BMS, this tick only keeps the connection alive
+                return self._last_push_sample
+
             sample = await bms.fetch()
+            metrics.observe('fetch', bms.name, time.time() - t_fetch)
+            await self._process_sample(sample)
 
-            t_now = time.time()
-            t_hour = t_now * (1 / 3600)
+        t_disc = time.time()
+        dt_conn = t_fetch - t_conn
+        dt_fetch = t_disc - t_fetch
+        dt_max = max(dt_conn, dt_fetch)
+        if bms.verbose_log or (  # or dt_max > 1
+                dt_max > 0.01 and random.random() < (0.05 if sample.num_samples < 1e3 else 0.01)
+                and not bms.is_virtual and self._log_data):
+            logger.info('%s times: connect=%.2fs fetch=%.2fs', bms, dt_conn, dt_fetch)
 
-            if sample.timestamp < t_now - max(self.expire_after_seconds, MIN_VALUE_EXPIRY):
-                raise SampleExpiredError("sample %s expired" % sample.timestamp)
-                # logger.warning('%s expired sample', bms.name)
-                # return
+        return sample
 
-            sample.num_samples = self.num_samples
+    async def _process_sample(self, sample: BmsSample):
+        """
+        Update meters and publish a sample (polled or pushed) to sinks, groups and MQTT.
+        """
+        async with self._process_lock:
+            await self._process_sample_locked(sample)
 
-            if self.current_calibration_factor and self.current_calibration_factor != 1:
-                sample = sample.multiply_current(self.current_calibration_factor)
+    async def _process_sample_locked(self, sample: BmsSample):
+        bms = self.bms
+        mqtt_client = self.mqtt_client
+
+        t_now = time.time()
+        t_hour = t_now * (1 / 3600)
+
+        if sample.timestamp < t_now - max(self.expire_after_seconds, MIN_VALUE_EXPIRY):
+            raise SampleExpiredError("sample %s expired" % sample.timestamp)
+            # logger.warning('%s expired sample', bms.name)
+            # return
 
-            # discharging P>0
-            self.power_integrator_charge += (t_hour, abs(min(0, sample.power)) * 1e-3)  # kWh
-            self.power_integrator_discharge += (t_hour, abs(max(0, sample.power)) * 1e-3)  # kWh
+        sample.num_samples = self.num_samples
 
-            # self.power_stats.add(sample.power)
+        if self.current_calibration_factor and self.current_calibration_factor != 1:
+            sample = sample.multiply_current(self.current_calibration_factor)
 
-            if (self.sinks or self.bms_group) and not sample.temperatures:
-                sample.temperatures = await self._fetch_temperatures_cached()
+        # self.power_stats.add(sample.power)
 
-            sample.temperatures = self._filter_temperatures(sample.temperatures)
+        if (self.sinks or self.bms_group) and not sample.temperatures:
+            sample.temperatures = await self._fetch_temperatures_cached()
 
-            if not math.isnan(sample.mos_temperature) and self._lhq_temp is not None:
-                sample.mos_temperature = self._lhq_temp['mos'].add(sample.mos_temperature)
+        sample.temperatures = self._filter_temperatures(sample.temperatures)
 
-            if self.bms_group:
-                # update before invert current
-                self.bms_group.update(bms, sample)
+        if not math.isnan(sample.mos_temperature) and self._lhq_temp is not None:
+            sample.mos_temperature = self._lhq_temp['mos'].add(sample.mos_temperature)
 
-            if self.invert_current:
-                sample = sample.invert_current()
+        if self.bms_group:
+            # update before invert current
+            self.bms_group.update(bms, sample)
 
-            self.current_integrator += (t_hour, sample.current)  # Ah
-            self.power_integrator += (t_hour, sample.power * 1e-3)  # kWh
+        if self.invert_current:
+            sample = sample.invert_current()
 
-            self.cycle_integrator += (t_hour, sample.soc * (0.01 / 2))  # SoC 100->0 is a half cycle
-            self.charge_integrator += (t_hour, sample.charge)  # Ah
+        self._update_meters(t_hour, sample.current, sample.power, sample.soc, sample.charge)
 
-            if self.algorithm:
-                res = self.algorithm.update(sample)
-                if res or self.bms.verbose_log:
-                    logger.info('Algo State=%s (bms=%s) -> %s ', self.algorithm.state,
-                                BatterySwitches(**sample.switches), res)
+        if self.algorithm:
+            res = self.algorithm.update(sample)
+            if res or self.bms.verbose_log:
+                logger.info('Algo State=%s (bms=%s) -> %s ', self.algorithm.state,
+                            BatterySwitches(**sample.switches), res)
 
-                if res:
-                    from bmslib.store import store_algorithm_state
-                    state = self.algorithm.state
-                    if state:
-                        store_algorithm_state(bms.name, algorithm_name=self.algorithm.name, state=state.__dict__)
+            if res:
+                from bmslib.store import store_algorithm_state
+                state = self.algorithm.state
+                if state:
+                    store_algorithm_state(bms.name, algorithm_name=self.algorithm.name, state=state.__dict__)
 
-                if res and res.switches:
-                    for swk in sample.switches.keys():
-                        if res.switches[swk] is not None:
-                            logger.info('%s algo set %s switch -> %s', bms.name, swk, res.switches[swk])
-                            await self.bms.set_switch('charge', res.switches[swk])
+            if res and res.switches:
+                for swk in sample.switches.keys():
+                    if res.switches[swk] is not None:
+                        logger.info('%s algo set %s switch -> %s', bms.name, swk, res.switches[swk])
+                        await self.bms.set_switch('charge', res.switches[swk])
 
-            if self.num_samples == 0 and sample.switches and mqtt_client:
-                logger.info("%s subscribing for %s switch change", bms.name, sample.switches)
-                subscribe_switches(mqtt_client, device_topic=self.mqtt_topic_prefix, bms=bms,
-                                   switches=sample.switches.keys())
+        if self.num_samples == 0 and sample.switches and mqtt_client:
+            logger.info("%s subscribing for %s switch change", bms.name, sample.switches)
+            subscribe_switches(mqtt_client, device_topic=self.mqtt_topic_prefix, bms=bms,
+                               switches=sample.switches.keys())
 
+        with metrics.timer('sink_publish', bms.name):
             for sink in self.sinks:
                 try:
                     sink.publish_sample(bms.name, sample)
                 except:
                     logger.error(sys.exc_info(), exc_info=True)
 
-            self.downsampler += sample
+        self.downsampler += sample
+        history_sample = sample
 
-            log_data = (t_now - self._last_time_log) >= (60 if self.num_samples < 1000 else 300) or bms.verbose_log
-            if log_data:
-                self._last_time_log = t_now
+        log_data = (t_now - self._last_time_log) >= (60 if self.num_samples < 1000 else 300) or bms.verbose_log
+        if log_data:
+            self._last_time_log = t_now
+        self._log_data = log_data
 
-            voltages = []
+        voltages = []
+        cell_stats = None
 
-            async def cached_fetch_voltages():
-                nonlocal voltages
-                if voltages:
-                    return voltages
+        async def cached_fetch_voltages():
+            nonlocal voltages, cell_stats
+            if voltages:
+                return voltages
 
-                # TODO fetch_voltages at t_fetch interval and down-sampling?
-                try:
+            # TODO fetch_voltages at t_fetch interval and down-sampling?
+            try:
+                with metrics.timer('voltages', bms.name):
                     voltages = await bms.fetch_voltages()
+                # computed once per fetch, shared by mqtt, sinks and group
+                cell_stats = CellStats(voltages) if voltages else None
+                self.cell_stats = cell_stats
 
-                    if self.bms_group:
-                        self.bms_group.update_voltages(bms, voltages)
-                except:
-                    logger.error("%s error fetching voltage", bms.name, exc_info=1)
-                    voltages = None
+                if self.bms_group:
+                    self.bms_group.update_voltages(bms, cell_stats.voltages if cell_stats else ())
+            except:
+                logger.error("%s error fetching voltage", bms.name, exc_info=1)
+                voltages = None
 
-                return voltages
+            return voltages
 
-            if self.sinks:
-                voltages = await cached_fetch_voltages()
+        if self.sinks:
+            voltages = await cached_fetch_voltages()
+            with metrics.timer('sink_publish', bms.name):
                 for sink in self.sinks:
-                    sink.publish_voltages(bms.name, voltages)
-
-            # z_score = self.power_stats.z_score(sample.power)
-            # if abs(z_score) > 12:
-            #    logger.info('%s Power z_score %.1f (avg=%.0f std=%.2f last=%.0f)', bms.name, z_score, self.power_stats.avg.value, self.power_stats.stddev, sample.power)
-
-            PWR_CHG_REG = 120  # regularisation to suppress changes when power is low
-            PWR_CHG_HOLD = 4
-            power_chg = (sample.power - self._last_power) / (abs(self._last_power) + PWR_CHG_REG)
-            if not bms.is_virtual and abs(power_chg) > 0.15 and abs(sample.power) > abs(self._last_power):
-                if bms.verbose_log or (
-                        not self.period_pub and (t_now - self._t_last_power_jump) > PWR_CHG_HOLD):
-                    logger.info('%s Power jump %.0f %% (prev=%.0f last=%.0f, REG=%.0f)', bms.name, power_chg * 100,
-                                self._last_power, sample.power, PWR_CHG_REG)
-                self._t_last_power_jump = t_now
-            self._last_power = sample.power
-
-            if self.period_discov or self.period_pub or \
-                    (t_now - self._t_last_power_jump) < PWR_CHG_HOLD or abs(sample.power) > self.over_power:
-                self._t_pub = t_now
-
-                sample = self.downsampler.pop()
-
-                publish_sample(mqtt_client, device_topic=self.mqtt_topic_prefix, sample=sample)
-                log_data and logger.info('%s: %s', bms.name, sample)
-
-                voltages = await cached_fetch_voltages()
-                publish_cell_voltages(mqtt_client, device_topic=self.mqtt_topic_prefix, voltages=voltages)
-
-                # temperatures = None
-                if self.period_30s or self.period_discov:
-                    if not sample.temperatures:
-                        sample.temperatures = await self._fetch_temperatures_cached()
-                        sample.temperatures = self._filter_temperatures(sample.temperatures)
-                    publish_temperatures(mqtt_client, device_topic=self.mqtt_topic_prefix,
-                                         temperatures=sample.temperatures)
-
-                if log_data and (voltages or sample.temperatures) and not bms.is_virtual:
-                    logger.info('%s volt=[%s] temp=%s', bms.name, ','.join(map(str, voltages)),
-                                sample.temperatures)
-
-            if self.period_discov or self.period_30s:
-                self.publish_meters()
-
-            # publish home assistant discovery every 60 samples
-            if self.period_discov:
-                logger.info("Sending HA discovery for %s (num_samples=%d)", bms.name, self.num_samples)
-                if self.device_info is None:
-                    await self._try_fetch_device_info()
-                publish_hass_discovery(
-                    mqtt_client, device_topic=self.mqtt_topic_prefix,
-                    expire_after_seconds=self.expire_after_seconds,
-                    sample=sample,
-                    num_cells=len(voltages) if voltages else 0,
-                    temperatures=sample.temperatures,
-                    device_info=self.device_info,
-                )
-
-                # publish sample again after discovery
-                if self.period_pub.period > 2:
-                    await asyncio.sleep(1)
-                    publish_sample(mqtt_client, device_topic=self.mqtt_topic_prefix, sample=sample)
-
+                    sink.publish_voltages(bms.name, voltages, stats=cell_stats)
+
+        # z_score = self.power_stats.z_score(sample.power)
+        # if abs(z_score) > 12:
+        #    logger.info('%s Power z_score %.1f (avg=%.0f std=%.2f last=%.0f)', bms.name, z_score, self.power_stats.avg.value, self.power_stats.stddev, sample.power)
+
+        PWR_CHG_REG = 120  # regularisation to suppress changes when power is low
+        PWR_CHG_HOLD = 4
+        power_chg = (sample.power - self._last_power) / (abs(self._last_power) + PWR_CHG_REG)
+        if not bms.is_virtual and abs(power_chg) > 0.15 and abs(sample.power) > abs(self._last_power):
+            if bms.verbose_log or (
+                    not self.period_pub and (t_now - self._t_last_power_jump) > PWR_CHG_HOLD):
+                logger.info('%s Power jump %.0f %% (prev=%.0f last=%.0f, REG=%.0f)', bms.name, power_chg * 100,
+                            self._last_power, sample.power, PWR_CHG_REG)
+            self._t_last_power_jump = t_now
+        self._last_power = sample.power
+
+        if self.period_discov or self.period_pub or \
+                (t_now - self._t_last_power_jump) < PWR_CHG_HOLD or abs(sample.power) > self.over_power:
+            self._t_pub = t_now
+
+            sample = self.downsampler.pop()
+
+            self._publish_sample(sample)
+            log_data and logger.info('%s: %s', bms.name, sample)
+
+            voltages = await cached_fetch_voltages()
+            (publish_cell_voltages_json if self.json_state else publish_cell_voltages)(
+                mqtt_client, device_topic=self.mqtt_topic_prefix, voltages=voltages, stats=cell_stats)
+
+            # temperatures = None
+            if self.period_30s or self.period_discov:
+                if not sample.temperatures:
+                    sample.temperatures = await self._fetch_temperatures_cached()
+                    sample.temperatures = self._filter_temperatures(sample.temperatures)
+                publish_temperatures(mqtt_client, device_topic=self.mqtt_topic_prefix,
+                                     temperatures=sample.temperatures)
+
+            if log_data and (voltages or sample.temperatures) and not bms.is_virtual:
+                logger.info('%s volt=[%s] temp=%s', bms.name, ','.join(map(str, voltages)),
+                            sample.temperatures)
+
+        if self.period_discov or self.period_30s:
+            self.publish_meters()
+
+        if self.period_discov and mqtt_client:
+            mqtt_single_out(mqtt_client, f"{self.mqtt_topic_prefix}/diag", json.dumps(metrics.summary(bms.name)))
+
+        # publish home assistant discovery every 60 samples
+        if self.period_discov:
+            logger.info("Sending HA discovery for %s (num_samples=%d)", bms.name, self.num_samples)
+            if self.device_info is None:
+                await self._try_fetch_device_info()
+            publish_hass_discovery(
+                mqtt_client, device_topic=self.mqtt_topic_prefix,
+                expire_after_seconds=self.expire_after_seconds,
+                sample=sample,
+                num_cells=len(voltages) if voltages else 0,
+                temperatures=sample.temperatures,
+                device_info=self.device_info,
+                json_state=self.json_state,
+            )
+
+            # publish sample again after discovery
+            if self.period_pub.period > 2:
+                await asyncio.sleep(1)
+                self._publish_sample(sample)
+
+        if self.history is not None:
+            self.history.append(history_sample, cell_stats.voltages if cell_stats else None)
+
+        self.last_sample = history_sample
         self.num_samples += 1
-        t_disc = time.time()
-        self._t_wd_reset = sample.timestamp or t_disc
+        self._t_wd_reset = sample.timestamp or time.time()
+
+        for listener in self.sample_listeners:
+            try:
+                listener(self)
+            except:
+                logger.error(sys.exc_info(), exc_info=True)
 
         self.period_pub.set_time(t_now)
         self.period_30s.set_time(t_now)
         self.period_discov.set_time(t_now)
 
-        dt_conn = t_fetch - t_conn
-        dt_fetch = t_disc - t_fetch
-        dt_max = max(dt_conn, dt_fetch)
-        if bms.verbose_log or (  # or dt_max > 1
-                dt_max > 0.01 and random.random() < (0.05 if sample.num_samples < 1e3 else 0.01)
-                and not bms.is_virtual and log_data):
-            logger.info('%s times: connect=%.2fs fetch=%.2fs', bms, dt_conn, dt_fetch)
-
-        return sample
+    def _publish_sample(self, sample: BmsSample):
+        with metrics.timer('mqtt_publish', self.bms.name):
+            (publish_sample_json if self.json_state else publish_sample)(
+                self.mqtt_client, device_topic=self.mqtt_topic_prefix, sample=sample)
 
     def publish_meters(self):
         device_topic = self.mqtt_topic_prefix
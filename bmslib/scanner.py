@@ -0,0 +1,160 @@
+"""
+Shared, long-lived bluetooth scanner per adapter.
+
+Each service runs one `BleakScanner` in the background and keeps a cache of seen devices (address, name, RSSI, last
+seen). Device construction, `BtBms._connect_with_scanner` and the connection manager consult the cache instead of
+starting their own scans, which take seconds and interfere with each other on BlueZ.
+"""
+import asyncio
+import re
+import time
+from typing import Dict, List, Optional
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+# MAC address (Linux) or CoreBluetooth UUID (macOS)
+_ADDRESS_RE = re.compile(r'^([0-9A-F]{2}[:-]){5}[0-9A-F]{2}$|^[0-9A-F]{8}(-[0-9A-F]{4}){3}-[0-9A-F]{12}$', re.I)
+
+
+def is_address(s: str) -> bool:
+    return bool(_ADDRESS_RE.match(s.strip()))
+
+
+def needs_discovery(dev: dict) -> bool:
+    """ Whether `construct_bms` needs discovered devices for this config (address is a name or there is no alias) """
+    return not is_address(dev['address']) or not dev.get('alias')
+
+
+class DeviceEntry:
+    __slots__ = ('address', 'name', 'rssi', 'last_seen', 'device')
+
+    def __init__(self, address: str, name: Optional[str], rssi, last_seen: float, device):
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+        self.last_seen = last_seen
+        self.device = device  # BLEDevice
+
+    @property
+    def age(self):
+        return time.time() - self.last_seen
+
+    def __repr__(self):
+        return 'DeviceEntry(%s,%s,rssi=%s,age=%.0fs)' % (self.address, self.name, self.rssi, self.age)
+
+
+class ScannerService:
+    _services: Dict[Optional[str], 'ScannerService'] = {}
+
+    def __init__(self, adapter: Optional[str] = None, stale_after=120.):
+        self.adapter = adapter
+        self.stale_after = stale_after
+        self.devices: Dict[str, DeviceEntry] = {}
+        self._scanner = None
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+
+    @classmethod
+    def get(cls, adapter: Optional[str] = None, create=True) -> Optional['ScannerService']:
+        svc = cls._services.get(adapter)
+        if svc is None and create:
+            svc = cls._services[adapter] = cls(adapter)
+        return svc
+
+    @classmethod
+    def running(cls, adapter: Optional[str] = None) -> Optional['ScannerService']:
+        """ The running service of `adapter` or None """
+        svc = cls._services.get(adapter)
+        return svc if svc is not None and svc.is_running else None
+
+    @property
+    def is_running(self):
+        return self._scanner is not None
+
+    async def start(self):
+        if self._scanner is not None:
+            return
+        from bleak import BleakScanner
+        kwargs = dict(adapter=self.adapter) if self.adapter else {}
+        scanner = BleakScanner(detection_callback=self._on_detect, **kwargs)
+        await scanner.start()
+        self._scanner = scanner
+        logger.info('Scanner started (adapter %s)', self.adapter or 'default')
+
+    async def stop(self):
+        if self._scanner is not None:
+            scanner, self._scanner = self._scanner, None
+            await scanner.stop()
+
+    @classmethod
+    async def stop_all(cls):
+        for svc in cls._services.values():
+            try:
+                await svc.stop()
+            except Exception as e:
+                logger.warning('error stopping scanner %s: %s', svc.adapter, e)
+
+    def _on_detect(self, device, adv=None):
+        rssi = getattr(adv, 'rssi', None) if adv is not None else getattr(device, 'rssi', None)
+        name = (adv and getattr(adv, 'local_name', None)) or device.name
+        key = device.address.upper()
+        entry = self.devices.get(key)
+        if entry is None:
+            self.devices[key] = entry = DeviceEntry(device.address, name, rssi, time.time(), device)
+        else:
+            entry.name = name or entry.name
+            entry.rssi = rssi
+            entry.last_seen = time.time()
+            entry.device = device
+
+        waiters = self._waiters.pop(key, None)
+        for fut in waiters or ():
+            if not fut.done():
+                fut.set_result(entry)
+
+    def lookup(self, address: str, max_age: Optional[float] = None) -> Optional[DeviceEntry]:
+        """ Cached device seen within `max_age` seconds (default `stale_after`) """
+        entry = self.devices.get(address.upper())
+        if entry is not None and entry.age <= (self.stale_after if max_age is None else max_age):
+            return entry
+        return None
+
+    def find_by_name(self, name: str) -> Optional[DeviceEntry]:
+        name = name.strip()
+        return next((e for e in self.devices.values() if (e.name or '').strip() == name), None)
+
+    async def wait_for(self, address: str, timeout: float) -> Optional[DeviceEntry]:
+        """ Wait until `address` is seen (returns immediately if seen recently) """
+        entry = self.lookup(address)
+        if entry is not None:
+            return entry
+        address = address.upper()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(address, []).append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(address)
+            if waiters and fut in waiters:
+                waiters.remove(fut)
+
+    async def discover(self, timeout: float, wanted=()) -> List[DeviceEntry]:
+        """
+        Wait for devices (at most `timeout` seconds, less if all `wanted` addresses or names are seen) and log them.
+        """
+        t_end = time.time() + timeout
+        wanted = set(w for w in wanted if w)
+        while time.time() < t_end:
+            if wanted and all(self.lookup(w) or self.find_by_name(w) for w in wanted):
+                break
+            await asyncio.sleep(.25)
+
+        devices = list(self.devices.values())
+        if not devices:
+            logger.info(' - no devices found - ')
+        for d in devices:
+            logger.info("BT %s %26s rssi=%s", d.address, d.name, d.rssi)
+        return devices
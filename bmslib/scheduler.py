@@ -0,0 +1,341 @@
+"""
+Deadline based sampling scheduler.
+
+Each sampler gets its own tick schedule on the monotonic clock. Ticks are planned at fixed deadlines (t0 + k*period),
+so the time spent connecting and fetching does not add to the period (drift compensation). If a device falls behind
+by more than its jitter budget, missed ticks are skipped instead of firing them in a burst.
+
+The period of each device adapts to how fast its BMS actually answers: a device that needs longer than its target
+period to connect and fetch is sampled less often, so in serial mode it can't starve the other devices.
+
+Exclusive samplers (real bluetooth devices) run within an AdapterPool, which bounds concurrent sampling and
+connections. There is either one pool for all devices or one per bluetooth adapter.
+"""
+import asyncio
+import math
+import time
+import traceback
+from typing import Callable, Optional, List, Dict
+
+from bmslib.pwmath import EWMA
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+
+class DeviceSchedule:
+    """
+    Tick schedule of a single sampler. All times are seconds of the monotonic clock.
+    """
+
+    # the adapted period has this much headroom above the measured sampling duration
+    ADAPT_HEADROOM = 1.2
+
+    def __init__(self, name: str, period: float, jitter_budget: Optional[float] = None,
+                 max_period: Optional[float] = None):
+        self.name = name
+        self.target_period = period
+        self.period = period
+        self.jitter_budget = period * .25 if jitter_budget is None else jitter_budget
+        self.max_period = max(period, max_period or max(30., period * 10))
+        # number of devices sharing a sampling slot with this one (serial mode). a device is not allowed to occupy
+        # the slot for more than its fair share of time
+        self.fair_share = 1.
+        self.deadline = math.nan
+
+        self.duration = EWMA(span=8)
+        self.achieved_period = EWMA(span=20)
+
+        self.num_ticks = 0
+        self.num_late = 0
+        self.num_skipped = 0
+        self.num_errors_row = 0
+
+        self._t_last_start = math.nan
+
+    def delay(self, now: float) -> float:
+        if math.isnan(self.deadline):
+            self.deadline = now
+        return max(0., self.deadline - now)
+
+    def tick_start(self, now: float):
+        if not math.isnan(self._t_last_start):
+            self.achieved_period.add(now - self._t_last_start)
+        self._t_last_start = now
+        if now - self.deadline > self.jitter_budget:
+            self.num_late += 1
+
+    def tick_done(self, now: float, success: Optional[bool]):
+        """
+        :param now:
+        :param success: True on success, False on error and None if the sampler returned nothing (e.g. waiting)
+        """
+        self.num_ticks += 1
+        self.duration.add(now - self._t_last_start)
+
+        if success:
+            self.num_errors_row = 0
+        elif success is not None:
+            self.num_errors_row += 1
+
+        period = max(self.target_period, self.duration.value * self.ADAPT_HEADROOM * self.fair_share)
+        if self.num_errors_row:
+            # back off failing devices, so they don't occupy the adapter
+            period *= 1.5 ** min(self.num_errors_row, 10)
+        self.period = min(period, self.max_period)
+
+        self.deadline += self.period
+        behind = now - self.deadline
+        if behind > self.jitter_budget:
+            # we are late, skip missed ticks and re-align to the grid
+            n = math.ceil(behind / self.period)
+            self.deadline += n * self.period
+            self.num_skipped += n
+
+    def stats(self) -> Dict[str, float]:
+        return dict(
+            target=self.target_period,
+            period=round(self.period, 3),
+            achieved=round(self.achieved_period.value, 3),
+            duration=round(self.duration.value, 3),
+            ticks=self.num_ticks,
+            late=self.num_late,
+            skipped=self.num_skipped,
+        )
+
+    def __str__(self):
+        s = self.stats()
+        return '%s(target=%.2fs achieved=%.2fs dur=%.2fs late=%d skip=%d)' % (
+            self.name, s['target'], s['achieved'], s['duration'], s['late'], s['skipped'])
+
+
+class AdapterPool:
+    """
+    Limits sampling of the devices on one bluetooth adapter (hci0, hci1, ..):
+      * `concurrency`: max number of devices sampled at the same time
+      * `max_connections`: max number of devices connected at the same time (connection slots). If all slots are taken,
+        the least recently used idle device is disconnected to free a slot (only relevant with keep_alive)
+    """
+
+    def __init__(self, name: str, concurrency: Optional[int] = None, max_connections: Optional[int] = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_connections = max_connections
+        self.num_members = 0
+        self._sem = asyncio.Semaphore(concurrency) if concurrency else None
+        self._connected: Dict[str, tuple] = {}  # name -> (bms, t_last_used)
+        self._busy = set()
+        self._slot_freed = asyncio.Condition()
+
+    def __str__(self):
+        return 'AdapterPool(%s,conc=%s,conn=%s)' % (self.name, self.concurrency or '*', self.max_connections or '*')
+
+    async def _acquire_connection(self, name: str, bms):
+        if not self.max_connections or bms is None or bms.is_connected:
+            self._busy.add(name)
+            return
+
+        while True:
+            self._connected = {n: c for n, c in self._connected.items() if c[0].is_connected}
+            # devices being sampled right now hold a slot, they might be about to connect
+            holders = (set(self._connected.keys()) | self._busy) - {name}
+            if len(holders) < self.max_connections:
+                self._busy.add(name)
+                return
+
+            idle = sorted((c[1], n) for n, c in self._connected.items() if n != name and n not in self._busy)
+            if idle:
+                victim = self._connected.pop(idle[0][1])[0]
+                logger.info('%s: all %d connection slots taken, disconnect idle %s', self, self.max_connections,
+                            victim.name)
+                try:
+                    await victim.disconnect()
+                except Exception as e:
+                    logger.warning('%s: error disconnecting %s: %s', self, victim.name, e)
+                continue
+
+            async with self._slot_freed:
+                try:
+                    await asyncio.wait_for(self._slot_freed.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release(self, name: str, bms):
+        self._busy.discard(name)
+        if bms is not None and bms.is_connected:
+            self._connected[name] = bms, time.monotonic()
+        else:
+            self._connected.pop(name, None)
+        async with self._slot_freed:
+            self._slot_freed.notify_all()
+
+    async def run(self, name: str, bms, fn: Callable, schedule: 'DeviceSchedule'):
+        if self._sem:
+            async with self._sem:
+                return await self._run_slot(name, bms, fn, schedule)
+        return await self._run_slot(name, bms, fn, schedule)
+
+    async def _run_slot(self, name: str, bms, fn: Callable, schedule: 'DeviceSchedule'):
+        await self._acquire_connection(name, bms)
+        try:
+            # tick starts when the sampler got its slot, so the period adapts to the BMS response time only
+            schedule.tick_start(time.monotonic())
+            return await fn()
+        finally:
+            await self._release(name, bms)
+
+
+class SampleScheduler:
+    """
+    Runs sampler callables (async functions returning a truthy value on success) on deadline ticks.
+
+    :param period: target sampling period in seconds
+    :param concurrency: max number of samplers running at the same time. 1 samples serially, None is unbounded.
+    :param per_adapter: apply `concurrency` and `max_connections` to each bluetooth adapter individually, so
+            independent adapters sample in parallel
+    :param max_connections: max number of connected devices (per adapter)
+    :param max_errors: stop the scheduler after this many consecutive errors of a device (0 = never)
+    :param restart_on_errors: instead of stopping, restart all sample loops when a device exceeds `max_errors`
+            (concurrent sampling)
+    """
+
+    STATS_LOG_INTERVAL = 60 * 5
+
+    def __init__(self, period: float, concurrency: Optional[int] = 1, max_errors=0,
+                 jitter_budget: Optional[float] = None, per_adapter=False, max_connections: Optional[int] = None,
+                 restart_on_errors=False):
+        self.period = period
+        self.concurrency = concurrency
+        self.per_adapter = per_adapter
+        self.max_connections = max_connections
+        self.max_errors = max_errors
+        self.restart_on_errors = restart_on_errors
+        self.jitter_budget = jitter_budget
+        self.schedules: Dict[str, DeviceSchedule] = {}
+        self.pools: Dict[str, AdapterPool] = {}
+        self._tasks: List[tuple] = []
+
+    def _get_pool(self, adapter: Optional[str]) -> AdapterPool:
+        key = (adapter or 'default') if self.per_adapter else '*'
+        if key not in self.pools:
+            self.pools[key] = AdapterPool(key, concurrency=self.concurrency, max_connections=self.max_connections)
+        return self.pools[key]
+
+    def add(self, fn: Callable, name: Optional[str] = None, exclusive=True, period: Optional[float] = None,
+            adapter: Optional[str] = None, bms=None):
+        """
+        :param fn: the sampler
+        :param name:
+        :param exclusive: whether the callable is subject to the adapter limits (False for virtual devices)
+        :param period: override the target period of this device
+        :param adapter: bluetooth adapter of the device (hci0, hci1, ..)
+        :param bms: the BtBms, needed for connection slot management
+        """
+        name = name or str(fn)
+        assert name not in self.schedules, "duplicate name %s" % name
+        schedule = DeviceSchedule(name, period=period or self.period, jitter_budget=self.jitter_budget)
+        self.schedules[name] = schedule
+
+        pool = self._get_pool(adapter) if exclusive else None
+        self._tasks.append((fn, schedule, pool, bms))
+
+        if pool:
+            pool.num_members += 1
+            if pool.concurrency:
+                for _, sch, p, _ in self._tasks:
+                    if p is pool:
+                        sch.fair_share = max(1., pool.num_members / pool.concurrency)
+
+        return schedule
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: s.stats() for name, s in self.schedules.items()}
+
+    async def _call(self, fn, schedule: DeviceSchedule, pool: Optional[AdapterPool], bms):
+        if pool:
+            return await pool.run(schedule.name, bms, fn, schedule)
+        schedule.tick_start(time.monotonic())
+        return await fn()
+
+    async def _device_loop(self, fn, schedule: DeviceSchedule, pool, bms, is_shutdown: Callable[[], bool]):
+        while not is_shutdown():
+            await asyncio.sleep(schedule.delay(time.monotonic()))
+            if is_shutdown():
+                break
+
+            try:
+                success = True if await self._call(fn, schedule, pool, bms) else None
+            except Exception as e:
+                success = False
+                logger.error('Error (num %d, max %d) reading %s: %s', schedule.num_errors_row + 1, self.max_errors,
+                             schedule.name, e)
+                logger.error('Stack: %s', traceback.format_exc())
+            schedule.tick_done(time.monotonic(), success=success)
+
+            if self.max_errors and schedule.num_errors_row > self.max_errors:
+                logger.warning('too many errors, abort')
+                break
+
+        logger.info("sample loop %s ends", schedule.name)
+
+    async def _log_stats_loop(self, is_shutdown: Callable[[], bool]):
+        while not is_shutdown():
+            await asyncio.sleep(self.STATS_LOG_INTERVAL)
+            for s in self.schedules.values():
+                if s.num_ticks:
+                    logger.info('schedule %s', s)
+
+    async def run(self, is_shutdown: Callable[[], bool]):
+        """
+        Run all sample loops until `is_shutdown()` returns True or a device exceeds `max_errors` (unless
+        `restart_on_errors`).
+        """
+        for pool in self.pools.values():
+            logger.info('%s: %d devices', pool, pool.num_members)
+
+        stats_task = asyncio.create_task(self._log_stats_loop(is_shutdown))
+
+        # this outer while loop recovers from a cancelled task. this happens when a device disconnects (bleak bug?)
+        while not is_shutdown():
+            loops = [asyncio.create_task(self._device_loop(fn, schedule, pool, bms, is_shutdown))
+                     for fn, schedule, pool, bms in self._tasks]
+            if not loops:
+                break
+            done, pending = await asyncio.wait(loops, return_when='FIRST_COMPLETED')
+
+            logger.debug('Done= %s, Pending=%s', done, pending)
+            for task in loops:
+                task.done() or task.cancel()
+
+            if any(not t.cancelled() and t.exception() is None for t in done) and not is_shutdown():
+                # a loop ended regularly, due to too many errors
+                if not self.restart_on_errors:
+                    break
+                for _, schedule, _, _ in self._tasks:
+                    if self.max_errors and schedule.num_errors_row > self.max_errors:
+                        logger.warning('restarting sample loops after too many errors of %s', schedule.name)
+                        schedule.num_errors_row = 0
+
+        stats_task.cancel()
+
+
+def create_scheduler(period: float, concurrent=False, adapter_concurrency: Optional[int] = None,
+                     adapter_connections: Optional[int] = None, max_errors=0) -> SampleScheduler:
+    """
+    Scheduler for the sampling mode of the config: serial (default), `concurrent_sampling` or `adapter_concurrency`.
+    Serial sampling stops after `max_errors` (so the watchdog restarts the add-on), the concurrent modes restart the
+    sample loops instead.
+    """
+    if adapter_concurrency:
+        return SampleScheduler(period=period, concurrency=int(adapter_concurrency), per_adapter=True,
+                               max_connections=adapter_connections, max_errors=max_errors, restart_on_errors=True)
+    return SampleScheduler(period=period, concurrency=None if concurrent else 1, max_connections=adapter_connections,
+                           max_errors=max_errors, restart_on_errors=concurrent)
+
+
+def add_sampler(scheduler: SampleScheduler, sampler):
+    """ Add a `BmsSampler`, virtual devices (groups) are not subject to adapter limits """
+    bms = sampler.bms
+    is_virtual = bms.is_virtual
+    return scheduler.add(sampler, name=bms.name, exclusive=not is_virtual, adapter=None if is_virtual else bms.adapter,
+                         bms=None if is_virtual else bms)
@@ -1,19 +1,22 @@
 import base64
-import datetime
 import hashlib
-import math
 import os
-import queue
 import random
-import statistics
+import re
 import sys
+import threading
 import time
 import zlib
-from typing import List, Dict
+from array import array
+from typing import List, Dict, Optional
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.cellstats import CellStats
+from bmslib.lineprotocol import LineBuffer, line_prefix, encode_fields
+from bmslib.pwmath import EWMA
 from bmslib.sampling import BmsSampleSink
+from bmslib.spool import Spool
 from bmslib.util import get_logger, sid_generator
 from mqtt_util import remove_none_values, remove_equal_values
 
@@ -36,7 +39,22 @@ def flatten(dictionary, parent_key='', separator='_'):
 
 
 class InfluxDBSink(BmsSampleSink):
-    def __init__(self, flush_interval=2, **kwargs):
+    """
+    Points are encoded to line protocol into a buffer and written by a background thread, so HTTP requests never
+    block the sampling loop.
+
+    :param flush_interval: max latency in seconds of a queued point
+    :param batch_size: flush early when this many points are queued, also the max number of points per write request
+    :param max_retry_delay: failed writes are retried with exponential back-off, up to this delay
+    :param queue_size: if the queue is full (InfluxDB unreachable for a long time), the oldest points are dropped
+    :param spool: batches that fail to write are appended to an on-disk spool (instead of being retried from memory)
+        and replayed once the server is reachable again
+    :param spool_max_mb: max disk usage of the spool, the oldest segments are dropped
+    :param replay_rate: max points/s replayed from the spool, so a backlog doesn't overload the server
+    """
+
+    def __init__(self, flush_interval=2, batch_size=5_000, max_retry_delay=120, queue_size=200_000,
+                 spool=False, spool_max_mb=256, replay_rate=5_000, **kwargs):
         import influxdb
         self.influxdb_client = influxdb.InfluxDBClient(**kwargs)
 
@@ -56,20 +74,63 @@ class InfluxDBSink(BmsSampleSink):
         self.influxdb_client._session.request_ = self.influxdb_client._session.request
         self.influxdb_client._session.request = _request_gzip
 
-        self.Q = queue.Queue(200_000)
+        self.lines = LineBuffer(queue_size)
         self.db = kwargs.get('database')
         self.time_last_flush = 0
         self._last_volt: Dict[str, List[int]] = {}
         self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_retry_delay = max_retry_delay
         self.silent = False
 
         self._prev_fields = {}
+        self._prefixes: Dict[tuple, bytes] = {}
+
+        self._num_retries = 0
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+
+        self.num_written = 0
+        self.num_write_errors = 0
+        self.write_latency = EWMA(span=20)
+
+        self.spool: Optional[Spool] = None
+        self.replay_rate = replay_rate
+        self.num_replayed = 0
+        if spool:
+            from bmslib.store import store_file
+            self.spool = Spool(store_file('spool/influxdb_%s' % re.sub(r'[^\w.-]', '_', self.db or 'default')),
+                               max_bytes=int(spool_max_mb * 1e6))
 
         if not kwargs.get('verify_ssl', False):
             import urllib3
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-    def publish_voltages(self, bms_name, voltages: List[int], short=False):
+        self._flush_thread = threading.Thread(target=self._flush_loop, name='influxdb_flush', daemon=True)
+        self._flush_thread.start()
+
+    def _prefix(self, measurement: str, bms_name, cell_index=None, tags: Optional[dict] = None) -> bytes:
+        key = (measurement, bms_name, cell_index, tags and tuple(tags.items()))
+        p = self._prefixes.get(key)
+        if p is None:
+            t = dict(device=bms_name)
+            if cell_index is not None:
+                t['cell_index'] = cell_index
+            if tags:
+                t.update(tags)
+            p = self._prefixes[key] = line_prefix(measurement, t)
+        return p
+
+    def _put(self, prefix: bytes, fields: dict, ts_ns: int):
+        fb = encode_fields(fields)
+        if not fb:
+            return
+        dropped = self.lines.num_dropped
+        self.lines.append(prefix, fb, ts_ns)
+        if self.lines.num_dropped != dropped and not self.silent:
+            logger.warning('influxdb queue full, dropped %d points so far', self.lines.num_dropped)
+
+    def publish_voltages(self, bms_name, voltages: List[int], stats: Optional[CellStats] = None, short=False):
         if not voltages:
             return
 
@@ -79,24 +140,21 @@ class InfluxDBSink(BmsSampleSink):
         last_volt = self._last_volt[bms_name]
 
         pub_anyway = random.random() < (1/100)
+        ts = time.time_ns()
 
         fields = {(f"voltage_cell%03i" % i): int(voltages[i]) for i in range(len(voltages)) if
                   voltages[i] != last_volt[i] or pub_anyway}
 
         if not short:
-            fields["voltage_cell_max"] = int(max(voltages))
-            fields["voltage_cell_min"] = int(min(voltages))
-            fields["voltage_cell_mean"] = float(statistics.mean(voltages))
-            fields["voltage_cell_median"] = float(statistics.median(voltages))
+            if stats is None:
+                stats = CellStats(voltages)
+            fields["voltage_cell_max"] = int(stats.max)
+            fields["voltage_cell_min"] = int(stats.min)
+            fields["voltage_cell_mean"] = float(stats.mean)
+            fields["voltage_cell_median"] = float(stats.median)
 
         if fields:
-            point = {
-                "measurement": 'batmon',
-                "time": datetime.datetime.utcnow(),
-                "fields": fields,
-                "tags": dict(device=bms_name)
-            }
-            self.Q.put(point)
+            self._put(self._prefix('batmon', bms_name), fields, ts)
 
         for i in range(len(voltages)):
             if voltages[i] == last_volt[i] and not pub_anyway:
@@ -104,18 +162,12 @@ class InfluxDBSink(BmsSampleSink):
             last_volt[i] = voltages[i]
 
             if not short:
-                point = {
-                    "measurement": 'cells',
-                    "time": datetime.datetime.utcnow(),
-                    "fields": dict(voltage=int(round(voltages[i]))),
-                    "tags": dict(device=bms_name, cell_index=i),
-                }
-                self.Q.put(point)
+                self._put(self._prefix('cells', bms_name, cell_index=i), dict(voltage=int(round(voltages[i]))), ts)
 
         self._maybe_flush()
 
     def publish_sample(self, bms_name, sample: BmsSample, tags=None):
-        fields = flatten({**sample.values(), "timestamp": None})
+        fields = flatten({**sample.to_fields(), "timestamp": None})
         remove_none_values(fields)
         for k, v in fields.items():
             if isinstance(v, int):
@@ -129,46 +181,184 @@ class InfluxDBSink(BmsSampleSink):
 
         if not fields:
             return
-        point = {
-            "measurement": 'batmon',
-            "time": int(math.ceil(sample.timestamp * 1e3)),
-            "fields": fields,
-            "tags": dict(device=bms_name)
-        }
-        if tags:
-            point['tags'].update(tags)
-        self.Q.put(point)
+        self._put(self._prefix('batmon', bms_name, tags=tags), fields, int(sample.timestamp * 1e9))
         self._maybe_flush()
 
     def publish_meters(self, bms_name, readings: Dict[str, float]):
-        now = datetime.datetime.utcnow()
-        point = {
-            "measurement": 'batmon',
-            "time": now,
-            "fields": {(f"meter_%s" % name): round(value, 5) for name, value in readings.items()},
-            "tags": dict(device=bms_name)
-        }
-        self.Q.put(point)
-
-    def flush(self):
-        batch = []
-        while not self.Q.empty() and len(batch) < 20_000:
-            batch.append(self.Q.get())
-        # self.influxdb_client.write_points(batch, time_precision='ms')
-        if batch:
+        fields = {(f"meter_%s" % name): round(value, 5) for name, value in readings.items()}
+        self._put(self._prefix('batmon', bms_name), fields, time.time_ns())
+
+    def _write(self, data: bytearray) -> bool:
+        self.influxdb_client.request(url="write", method='POST', params=dict(db=self.db, precision='n'),
+                                     data=data, expected_response_code=204,
+                                     headers={'Content-Type': 'application/octet-stream'})
+        return True
+
+    def _flush_batch(self) -> bool:
+        """ Write up to `batch_size` buffered points. :return: False if the write failed """
+        with self._write_lock:
+            data, n = self.lines.take(self.batch_size)
+            if not n:
+                self.lines.recycle(data)
+                return True
+
+            t0 = time.time()
             try:
-                res = self.influxdb_client.write_points(batch, time_precision='ms')
+                res = self._write(data)
             except:
                 res = False
                 not self.silent and logger.error(sys.exc_info(), exc_info=True)
-            if not res and not self.silent:
-                logger.error('Failed to write points to influxdb')
             self.time_last_flush = time.time()
 
+            if not res:
+                self.num_write_errors += 1
+                if not self._spool_batch(data, n):
+                    self.lines.give_back(data, n)
+                if not self.silent:
+                    logger.error('Failed to write %d points to influxdb (retry #%d)', n, self._num_retries)
+                return False
+
+            self.lines.recycle(data)
+            self.write_latency.add(self.time_last_flush - t0)
+            self.num_written += n
+            return True
+
+    def _spool_batch(self, data: bytearray, n: int) -> bool:
+        if self.spool is None:
+            return False
+        try:
+            self.spool.append(data, n)
+        except OSError as e:
+            logger.error('Failed to spool %d points: %s', n, e)
+            return False
+        self.lines.recycle(data)
+        return True
+
+    def _replay(self, max_time: float) -> bool:
+        """ Write spooled batches, at most `replay_rate` points/s. :return: False if a write failed """
+        t_end = time.time() + max_time
+        while time.time() < t_end:
+            with self._write_lock:
+                rec = self.spool.peek()
+                if rec is None:
+                    return True
+                data, n = rec
+                try:
+                    self._write(data)
+                except:
+                    self.num_write_errors += 1
+                    not self.silent and logger.error('Failed to replay %d spooled points: %s', n, sys.exc_info()[1])
+                    return False
+                self.spool.ack()
+                self.num_replayed += n
+            time.sleep(n / self.replay_rate)
+        return True
+
+    def _flush_all(self) -> bool:
+        while len(self.lines):
+            if not self._flush_batch():
+                return False
+        return True
+
+    def flush(self):
+        """ Write all queued points now (blocking). If a write fails, the remaining points are spooled (if enabled) """
+        if not self._flush_all():
+            with self._write_lock:
+                data, n = self.lines.take()
+                if not n:
+                    self.lines.recycle(data)
+                elif self._spool_batch(data, n):
+                    logger.info('Spooled %d points', n)
+                else:
+                    self.lines.give_back(data, n)
+                    logger.error('Failed to flush, %d points not written', n)
+        if self.spool is not None:
+            with self._write_lock:
+                self.spool.close()
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                if self._flush_all() and (not self.spool or self._replay(self.flush_interval)):
+                    self._num_retries = 0
+                else:
+                    self._num_retries += 1
+                    time.sleep(min(self.max_retry_delay, self.flush_interval * 2 ** self._num_retries))
+            except:
+                logger.error(sys.exc_info(), exc_info=True)
+
     def _maybe_flush(self):
-        now = time.time()
-        if now - self.time_last_flush > self.flush_interval:
-            self.flush()
+        if len(self.lines) >= self.batch_size:
+            self._wake.set()
+
+    def stats(self):
+        s = dict(queue=len(self.lines), written=self.num_written, dropped=self.lines.num_dropped,
+                 errors=self.num_write_errors, latency=round(self.write_latency.value, 3))
+        if self.spool is not None:
+            s.update(spooled_bytes=self.spool.num_bytes, replayed=self.num_replayed)
+        return s
+
+
+class LocalStoreSink(BmsSampleSink):
+    """
+    Writes samples to the embedded time-series store (`bmslib.tsdb`), for offline history. Rows are buffered and
+    committed by a background thread every `flush_interval` seconds, which also rolls up and applies retention.
+    """
+
+    def __init__(self, path: str, retention: Optional[Dict[str, float]] = None, flush_interval=10.):
+        from bmslib.tsdb import TimeSeriesStore
+        self.store = TimeSeriesStore(path, retention=retention)
+        self.flush_interval = flush_interval
+        self._rows: List[tuple] = []
+        self._pending: Dict[str, list] = {}  # sample row waiting for the cell voltages
+        self._lock = threading.Lock()
+        self._flush_thread = threading.Thread(target=self._flush_loop, name='local_store_flush', daemon=True)
+        self._flush_thread.start()
+
+    def _add_row(self, row: list):
+        with self._lock:
+            self._rows.append(tuple(row))
+
+    def publish_sample(self, bms_name, sample: BmsSample):
+        prev = self._pending.pop(bms_name, None)
+        if prev:
+            self._add_row(prev)
+        temps = [t for t in (sample.temperatures or ()) if t is not None]
+        self._pending[bms_name] = [
+            self.store.device_id(bms_name), int(sample.timestamp),
+            sample.voltage, sample.current, sample.power, sample.soc, sample.charge,
+            (sum(temps) / len(temps)) if temps else None, sample.mos_temperature,
+            None, None, None]
+
+    def publish_voltages(self, bms_name, voltages: List[int], stats: Optional[CellStats] = None):
+        row = self._pending.pop(bms_name, None)
+        if row is None:
+            return
+        if voltages:
+            if stats is None:
+                stats = CellStats(voltages)
+            row[-3:] = stats.min, stats.max, array('H', (int(v) for v in voltages)).tobytes()
+        self._add_row(row)
+
+    def publish_meters(self, bms_name, readings: Dict[str, float]):
+        pass
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if rows:
+            self.store.insert(rows)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                self.store.maintain()
+            except:
+                logger.error(sys.exc_info(), exc_info=True)
 
 
 def hash_urlsafe(s: str):
@@ -228,9 +418,9 @@ class TelemetrySink(InfluxDBSink):
         except:
             pass
 
-    def publish_voltages(self, bms_name, voltages: List[int], short=True):
+    def publish_voltages(self, bms_name, voltages: List[int], stats: Optional[CellStats] = None, short=True):
         # tags_ = dict(uid=self.uid, did=self.did)
-        super().publish_voltages(self.addrh_by_name[bms_name], voltages, short=short)
+        super().publish_voltages(self.addrh_by_name[bms_name], voltages, stats=stats, short=short)
 
     def publish_meters(self, bms_name, readings: Dict[str, float]):
         raise NotImplementedError()
@@ -0,0 +1,150 @@
+"""
+Durable, append-only on-disk spool of write batches (e.g. InfluxDB line protocol).
+
+Records are appended to segment files (`<seq>.seg`) in a directory. Each record is `len(u32) n(u32) crc32(u32) data`,
+n being the number of points in data. The writer fsyncs at most every `fsync_interval` seconds (SD cards!) and
+starts a new segment when the current one exceeds `segment_size`. Fully consumed segments are deleted.
+
+Delivery is at-least-once: the read position is not persisted, so after a restart the oldest segment is replayed from
+the start. This is fine for InfluxDB, which overwrites points with the same series and timestamp.
+"""
+import os
+import struct
+import time
+import zlib
+from typing import Optional, Tuple, List
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+_HEADER = struct.Struct('<III')
+
+
+class Spool:
+
+    def __init__(self, directory: str, segment_size=4 << 20, max_bytes=256 << 20, fsync_interval=2.):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments: List[int] = sorted(int(fn[:-4]) for fn in os.listdir(directory) if fn.endswith('.seg'))
+        self._bytes = sum(os.path.getsize(self._path(s)) for s in self._segments)
+
+        self._wfh = None
+        self._wseq = None
+        self._t_fsync = 0
+
+        self._rseq = None
+        self._rfh = None
+        self._rpos = 0
+        self._peeked: Optional[Tuple[int, int]] = None  # (next read pos, num points)
+
+        self.num_dropped_segments = 0
+
+        if self._segments:
+            logger.info('spool %s: %d segments (%.1f MB) to replay', directory, len(self._segments),
+                        self._bytes / 1e6)
+
+    def _path(self, seq: int):
+        return os.path.join(self.directory, '%010d.seg' % seq)
+
+    def __bool__(self):
+        return bool(self._segments)
+
+    @property
+    def num_bytes(self):
+        return self._bytes
+
+    def _open_writer(self):
+        # always start a new segment, the tail of the previous one might be torn
+        self._wseq = (self._segments[-1] + 1) if self._segments else 1
+        self._segments.append(self._wseq)
+        self._wfh = open(self._path(self._wseq), 'ab')
+
+    def _close_writer(self):
+        if self._wfh:
+            self._wfh.flush()
+            os.fsync(self._wfh.fileno())
+            self._wfh.close()
+            self._wfh = None
+            self._wseq = None
+
+    def append(self, data: bytes, n: int):
+        if self._wfh is None or self._wfh.tell() >= self.segment_size:
+            self._close_writer()
+            self._open_writer()
+            self._enforce_limit()
+
+        self._wfh.write(_HEADER.pack(len(data), n, zlib.crc32(data)))
+        self._wfh.write(data)
+        self._bytes += _HEADER.size + len(data)
+
+        now = time.time()
+        if now - self._t_fsync >= self.fsync_interval:
+            self._wfh.flush()
+            os.fsync(self._wfh.fileno())
+            self._t_fsync = now
+
+    def _enforce_limit(self):
+        while self._bytes > self.max_bytes and len(self._segments) > 1:
+            seq = self._segments[0]
+            logger.warning('spool %s exceeds %.0f MB, dropping oldest segment %s', self.directory,
+                           self.max_bytes / 1e6, seq)
+            self._remove_segment(seq)
+            self.num_dropped_segments += 1
+
+    def _remove_segment(self, seq: int):
+        if seq == self._rseq:
+            self._rfh.close()
+            self._rfh, self._rseq, self._rpos, self._peeked = None, None, 0, None
+        path = self._path(seq)
+        try:
+            self._bytes -= os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self._segments.remove(seq)
+
+    def peek(self) -> Optional[Tuple[bytes, int]]:
+        """
+        :return: the oldest record (data, num points) or None. Call `ack()` after the record has been delivered.
+        """
+        while self._segments:
+            seq = self._segments[0]
+            if seq == self._wseq:
+                # make records of the segment being written readable
+                self._wfh.flush()
+            if self._rseq != seq:
+                self._rfh = open(self._path(seq), 'rb')
+                self._rseq, self._rpos = seq, 0
+
+            self._rfh.seek(self._rpos)
+            header = self._rfh.read(_HEADER.size)
+            if len(header) == _HEADER.size:
+                size, n, crc = _HEADER.unpack(header)
+                data = self._rfh.read(size)
+                if len(data) == size and zlib.crc32(data) == crc:
+                    self._peeked = (self._rpos + _HEADER.size + size, n)
+                    return data, n
+                logger.warning('spool segment %s corrupt at %d, skipping the rest', seq, self._rpos)
+            elif header and seq != self._wseq:
+                logger.warning('spool segment %s truncated at %d', seq, self._rpos)
+
+            if seq == self._wseq:
+                return None  # all read, keep the current segment for writing
+            self._remove_segment(seq)
+        return None
+
+    def ack(self):
+        assert self._peeked, "nothing peeked"
+        self._rpos = self._peeked[0]
+        self._peeked = None
+
+    def close(self):
+        self._close_writer()
+        if self._rfh:
+            self._rfh.close()
+            self._rfh = None
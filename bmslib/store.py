@@ -1,9 +1,13 @@
 import json
 import os
 import re
+import struct
+import time
+import zlib
 from os import access, R_OK
 from os.path import isfile
 from threading import Lock
+from typing import Dict
 
 from bmslib.cache import random_str
 from bmslib.util import dotdict, get_logger
@@ -17,6 +21,7 @@ def is_readable(file):
 
 root_dir = '/data/' if is_readable('/data/options.json') else ''
 bms_meter_states_fn = root_dir + 'bms_meter_states.json'
+bms_meter_journal_fn = root_dir + 'bms_meter_states.journal'
 
 lock = Lock()
 
@@ -26,9 +31,19 @@ def store_file(fn):
 
 
 def load_meter_states():
+    """
+    The meter states snapshot with the meter journal replayed on top.
+    :raises FileNotFoundError: if there is neither a snapshot nor a journal
+    """
     with lock:
-        with open(bms_meter_states_fn) as f:
-            meter_states = json.load(f)
+        try:
+            with open(bms_meter_states_fn) as f:
+                meter_states = json.load(f)
+        except FileNotFoundError:
+            if not isfile(bms_meter_journal_fn):
+                raise
+            meter_states = {}
+        _replay_journal(bms_meter_journal_fn, meter_states)
         return meter_states
 
 
@@ -37,9 +52,123 @@ def store_meter_states(meter_states):
         s = f'.{random_str(6)}.tmp'
         with open(bms_meter_states_fn + s, 'w') as f:
             json.dump(meter_states, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
         os.replace(bms_meter_states_fn + s, bms_meter_states_fn)
 
 
+_RECORD = struct.Struct('<II')  # len, crc32
+
+
+def _replay_journal(fn, meter_states: dict) -> int:
+    """
+    Apply the journal records to `meter_states`, stops at the first torn or corrupt record.
+    :return: file offset after the last valid record
+    """
+    try:
+        with open(fn, 'rb') as f:
+            buf = f.read()
+    except FileNotFoundError:
+        return 0
+    pos, n = 0, 0
+    while pos + _RECORD.size <= len(buf):
+        size, crc = _RECORD.unpack_from(buf, pos)
+        data = buf[pos + _RECORD.size:pos + _RECORD.size + size]
+        if len(data) != size or zlib.crc32(data) != crc:
+            break
+        meter_states.update(json.loads(data))
+        pos += _RECORD.size + size
+        n += 1
+    if pos != len(buf):
+        logger.warning('meter journal %s: ignoring %d bytes after %d valid records', fn, len(buf) - pos, n)
+    return pos
+
+
+class MeterJournal:
+    """
+    Append-only journal of meter states with checksummed records (`len(u32) crc32(u32) json`).
+    Updates are coalesced per device: every `sync_interval` seconds the latest state of each updated device is
+    appended as one record and fsynced, so a power cut loses at most `sync_interval` seconds of metering. Shorter
+    intervals write more (SD cards!), 0 writes a record per update.
+    `maintain()` compacts the journal into the meter states snapshot when it grows beyond `compact_bytes` or is older
+    than `compact_interval`.
+
+    Compaction writes the latest state of every device, so a crash between writing the snapshot and truncating the
+    journal is harmless: replaying the journal yields the same states again.
+    """
+
+    def __init__(self, meter_states: Dict[str, dict], path=None, sync_interval=30., compact_bytes=1 << 20,
+                 compact_interval=3600.):
+        self.path = path = path or bms_meter_journal_fn
+        self.sync_interval = sync_interval
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+        self.states = dict(meter_states)
+        self._pending: Dict[str, dict] = {}
+        self._lock = Lock()
+
+        valid = _replay_journal(path, self.states)
+        self._fh = open(path, 'ab')
+        if self._fh.tell() != valid:
+            self._fh.truncate(valid)  # torn tail, append after the last valid record
+        self._bytes = valid
+        self._t_sync = time.time()
+        self._t_compact = time.time()
+        self.num_bytes_written = 0
+
+    def append(self, bms_name: str, state: dict):
+        with self._lock:
+            self.states[bms_name] = state
+            self._pending[bms_name] = state
+            if time.time() - self._t_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._t_sync = time.time()
+        if not self._pending or self._fh.closed:
+            return
+        recs = []
+        for name, state in self._pending.items():
+            data = json.dumps({name: state}, separators=(',', ':')).encode()
+            recs.append(_RECORD.pack(len(data), zlib.crc32(data)) + data)
+        data = b''.join(recs)
+        self._pending.clear()
+        self._fh.write(data)
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._bytes += len(data)
+        self.num_bytes_written += len(data)
+
+    def maintain(self):
+        """ Write pending records if due, compact if due """
+        with self._lock:
+            if self._bytes >= self.compact_bytes or ((self._bytes or self._pending) and
+                                                     time.time() - self._t_compact >= self.compact_interval):
+                self._compact()
+            elif time.time() - self._t_sync >= self.sync_interval:
+                self._sync()
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        store_meter_states(self.states)
+        self._pending.clear()
+        self._fh.truncate(0)
+        self._fh.seek(0)
+        os.fsync(self._fh.fileno())
+        self._bytes = 0
+        self._t_sync = self._t_compact = time.time()
+        if isfile(bms_meter_states_fn):
+            self.num_bytes_written += os.path.getsize(bms_meter_states_fn)
+
+    def close(self):
+        with self._lock:
+            self._compact()
+            self._fh.close()
+
+
 def store_algorithm_state(bms_name, algorithm_name, state=None):
     fn = root_dir + 'bat_state_' + re.sub(r'[^\w_. -]', '_', bms_name) + '.json'
     with lock:
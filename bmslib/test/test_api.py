@@ -0,0 +1,57 @@
+import asyncio
+import json
+import time
+
+from bmslib.api import ApiServer
+from bmslib.bms import BmsSample
+from bmslib.models.jikong import JKBt
+from bmslib.sampling import BmsSampler
+
+
+async def _get(port, path, headers=''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET %s HTTP/1.1\r\nHost: x\r\n%s\r\n' % (path, headers)).encode())
+    res = await reader.read()
+    writer.close()
+    head, _, body = res.partition(b'\r\n\r\n')
+    head = head.decode().split('\r\n')
+    hdrs = dict(l.split(': ', 1) for l in head[1:])
+    return int(head[0].split(' ')[1]), hdrs, body and json.loads(body)
+
+
+def test_api():
+    async def run():
+        sampler = BmsSampler(JKBt('test_jk', name='jk'), mqtt_client=None, dt_max_seconds=600,
+                             expire_after_seconds=0, history_size=10)
+        api = ApiServer([sampler], host='127.0.0.1', port=0)
+        await api.start()
+        port = api._server.sockets[0].getsockname()[1]
+
+        status, _, body = await _get(port, '/api/devices/jk')
+        assert status == 200 and body['sample'] is None and body['meters']['total_energy'] == 0
+
+        for i in range(3):
+            sample = BmsSample(voltage=13 + i, current=2, charge=50, capacity=100, timestamp=time.time() - 3 + i)
+            sampler.history.append(sample, [3300 + i, 3400])
+            sampler.last_sample = sample
+            sampler.num_samples += 1
+            for listener in sampler.sample_listeners:
+                listener(sampler)
+
+        status, hdrs, body = await _get(port, '/api/devices/jk')
+        assert status == 200 and body['sample']['voltage'] == 15
+        status, _, _ = await _get(port, '/api/devices/jk', 'If-None-Match: %s\r\n' % hdrs['ETag'])
+        assert status == 304
+
+        status, _, body = await _get(port, '/api/devices/jk/history?column=voltage&seconds=60')
+        assert body['n'] == 3 and body['min'] == 13 and body['mean'] == 14 and body['values'] == [13, 14, 15]
+
+        status, _, body = await _get(port, '/api/devices/jk/history?column=cell1&seconds=60')
+        assert body['values'] == [3300, 3301, 3302]  # numbered from 1, like the MQTT topics
+        assert (await _get(port, '/api/devices/jk/history?column=cell0'))[0] == 404
+
+        assert (await _get(port, '/api/devices/nope'))[0] == 404
+        assert (await _get(port, '/api/devices/jk/history?column=nope'))[0] == 404
+        await api.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,20 @@
+import copy
+import pickle
+
+from bmslib.bms import BmsSample
+
+
+def test_sample_fields_and_copy():
+    s = BmsSample(12.2, 2, charge=33, capacity=100, switches=dict(charge=True))
+    assert not hasattr(s, '__dict__')
+    f = s.to_fields()
+    assert set(f.keys()) == set(BmsSample.FIELDS) | {'power'}
+    assert f['power'] == 12.2 * 2
+
+    c = copy.copy(s)
+    c.current = 5
+    assert s.current == 2 and c.voltage == 12.2
+    assert s.invert_current().current == -2 and s.current == 2
+
+    p = pickle.loads(pickle.dumps(s))
+    assert (p.voltage, p.charge, p.switches) == (12.2, 33, dict(charge=True))
@@ -0,0 +1,14 @@
+import statistics
+
+from bmslib.cellstats import CellStats
+
+
+def test_cell_stats():
+    v = [3301, 3310, 3295, 3310, 3300, 3295]
+    s = CellStats(v)
+    assert (s.min, s.min_index, s.max, s.max_index, s.delta) == (3295, 2, 3310, 1, 15)
+    assert s.mean == statistics.mean(v)
+    assert s.median == statistics.median(v)
+    assert abs(s.stddev - statistics.pstdev(v)) < 1e-9
+    assert CellStats([3300]).median == 3300
+    assert len(CellStats([])) == 0
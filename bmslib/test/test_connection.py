@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from bmslib.connection import ConnectionManager, CircuitOpenError
+from bmslib.util import get_logger
+
+
+class FakeBms:
+    def __init__(self, fail=0):
+        self.name = 'fake'
+        self.logger = get_logger()
+        self.is_connected = False
+        self.connect_time = 0
+        self.fail = fail
+        self.num_connects = 0
+
+    async def connect(self):
+        if self.fail:
+            self.fail -= 1
+            raise TimeoutError('no device')
+        self.is_connected = True
+        self.connect_time = time.time()
+        self.num_connects += 1
+
+    async def disconnect(self):
+        self.is_connected = False
+
+
+def test_policies():
+    async def run():
+        bms = FakeBms()
+        cm = ConnectionManager(bms, policy='per_sample')
+        await cm.acquire()
+        await cm.release()
+        assert not bms.is_connected
+
+        cm.configure('idle', idle_timeout=.05)
+        for _ in range(3):
+            await cm.acquire()
+            await cm.release()
+        assert bms.is_connected and bms.num_connects == 2
+        await asyncio.sleep(.1)
+        assert not bms.is_connected
+
+        cm.configure('duty', max_connected=0)
+        await cm.acquire()
+        await cm.release()
+        await cm.acquire()  # connected for longer than max_connected
+        assert bms.num_connects == 4
+
+    asyncio.run(run())
+
+
+def test_backoff_and_circuit_breaker():
+    async def run():
+        bms = FakeBms(fail=3)
+        cm = ConnectionManager(bms, failure_threshold=3, breaker_timeout=60)
+        for i in range(3):
+            try:
+                await cm.acquire()
+            except TimeoutError:
+                pass
+            assert cm.retry_in() > 0
+            try:
+                await cm.acquire()
+                assert False
+            except CircuitOpenError:
+                pass
+            cm.next_attempt = 0  # skip the wait
+        assert cm.connect_failures == 3 and cm.num_trips == 1
+
+        await cm.acquire()  # half-open attempt succeeds
+        assert cm.state == 'closed' and cm.stats()['connects'] == 1
+        await cm.release(exc=RuntimeError())
+        assert cm.fetch_failures == 1
+
+    asyncio.run(run())
+
+
+def test_sampler_backoff_returns_immediately():
+    from bmslib.models.dummy import DummyBt
+    from bmslib.sampling import BmsSampler
+
+    async def run():
+        sampler = BmsSampler(DummyBt('dummy1', name='dummy'), mqtt_client=None, dt_max_seconds=600,
+                             expire_after_seconds=0)
+        sampler.bms.connection.next_attempt = time.time() + 60
+        t = time.time()
+        assert await sampler() is None and time.time() - t < .5  # doesn't hold the sampling slot
+
+        async def circuit_open():
+            raise CircuitOpenError('dummy: not seen by the scanner recently')
+
+        sampler._sample_inner = circuit_open
+        assert await sampler() is None
+
+    asyncio.run(run())
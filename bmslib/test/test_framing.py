@@ -0,0 +1,62 @@
+from bmslib.framing import FrameAssembler
+from bmslib.models.ant import AntBt
+from bmslib.models.dummy import JKDummy
+from bmslib.models.jbd import JbdBt
+from bmslib.models.jikong import JKBt, HEADER as JK_HEADER, MIN_RESPONSE_SIZE
+
+ANT_STATUS = bytes.fromhex(
+    '7ea11100007e05010208020000000000000001004201000000000000000000000000d40dd50dd50dd50dd50dd40dd50dd50dd8ffd8ff1c'
+    '001d00110b0000640064000102000000e1f50500e1f505a532000000000000ff97010000000000d50d0200d40d01000100d40df8ff8200'
+    '0000ab02f2fa100000003a6500001f000000fa62000011c3aa55')
+
+
+def _chunks(buf, n=20):
+    return [buf[i:i + n] for i in range(0, len(buf), n)]
+
+
+def test_jk_frames_split_and_resync():
+    jk = JKBt('test_jk', name='jk')
+    frames = []
+    fa = FrameAssembler(header=JK_HEADER, frame_len=MIN_RESPONSE_SIZE, check=jk._frame_crc_check, capacity=512)
+    msgs = [JKDummy.DEVICE_INFO] + JKDummy().MSGS
+    # frames may carry trailing bytes, which are discarded
+    stream = b'\x01\x02garbage' + b''.join(msgs)
+    for chunk in _chunks(stream, 128):
+        frames += [bytes(f) for f in fa.feed(chunk)]
+    assert len(frames) == len(msgs)
+    assert all(f.startswith(JK_HEADER) and len(f) == MIN_RESPONSE_SIZE for f in frames)
+    assert fa.num_check_errors == 0
+
+
+def test_terminator_and_crc_hook():
+    fa = FrameAssembler(terminator=b'w')
+    assert list(fa.feed(b'\xdd\x03\x00')) == []
+    assert [bytes(f) for f in fa.feed(b'\x01w')] == [b'\xdd\x03\x00\x01w']
+    assert len(fa) == 0
+
+    ant = AntBt('00:00:00:00:00:00', name='ant')
+    corrupt = bytearray(ANT_STATUS)
+    corrupt[20] ^= 0xff
+    for chunk in _chunks(bytes(corrupt) + ANT_STATUS):
+        ant._notification_handler(None, chunk)
+    assert ant._frames.num_check_errors == 1
+    assert ant._last_response == ANT_STATUS
+
+
+def test_header_byte_inside_frame():
+    jbd = JbdBt('test_jbd', name='jbd')
+    # cell voltages frame, 3549 mV = 0x0ddd
+    data = b''.join(v.to_bytes(2, 'big') for v in [3300] + [3549] * 19)
+    payload = bytes([0x04, 0x00, len(data)]) + data
+    crc = (0x10000 - sum(payload[1:])) & 0xffff
+    frame = b'\xdd' + payload + crc.to_bytes(2, 'big') + b'\x77'
+    chunks = [frame[:21], frame[21:41], frame[41:]]
+    assert chunks[1][0] == 0xdd and chunks[2][0] == 0xdd  # a chunk boundary on the low byte of a cell voltage
+    frames = [bytes(f) for c in chunks for f in jbd._frames.feed(c)]
+    assert frames == [frame]
+
+    # a truncated frame followed by a complete one re-syncs on the failed check
+    fa = FrameAssembler(header=b'\xdd', frame_len=lambda b: b[3] + 7 if len(b) >= 4 else None,
+                        check=lambda f: f[-1] == 0x77)
+    frames = [bytes(f) for c in [b'\xdd\x03\x00\x1b\x05'] + chunks for f in fa.feed(c)]
+    assert frames == [frame]
@@ -0,0 +1,20 @@
+from bmslib.bms import BmsSample
+from bmslib.history import SampleHistory
+
+
+def test_history_ring_window():
+    h = SampleHistory(capacity=4)
+    for i in range(6):
+        h.append(BmsSample(12 + i, 1, timestamp=1000 + i, temperatures=[20, 21]), voltages=[3300 + i, 3310 + i])
+
+    assert len(h) == 4
+    assert list(h.window('timestamp')) == [1002, 1003, 1004, 1005]
+    assert list(h.window('voltage', 2)) == [16, 17]
+    assert list(h.cell_window(1)) == [3312, 3313, 3314, 3315]
+    assert h.count_since(1004) == 2
+    assert h.last()['voltage'] == 17
+
+    h.append(BmsSample(20, 1, timestamp=1006))  # no voltages, no temperatures
+    w = h.cell_window(0, 1)
+    assert w[0] != w[0]  # nan
+    assert h.num_temperatures == 2
@@ -0,0 +1,25 @@
+from bmslib.models.dummy import JKDummy
+from bmslib.models.jikong import JKBt, decode_jk02
+
+
+def _cell_frame(is_new_11x):
+    return next(bytes(m) for m in JKDummy(is_new_11x=is_new_11x).MSGS if m[4] == 0x02)
+
+
+def test_decode_jk02():
+    for is_new_11x in (False, True):
+        buf = _cell_frame(is_new_11x)
+        fields, cells = decode_jk02(buf, 8)
+        offset = 32 if is_new_11x else 0
+        assert list(cells) == [int.from_bytes(buf[6 + i * 2:8 + i * 2], 'little') for i in range(8)]
+        assert fields['voltage'] == int.from_bytes(buf[118 + offset:122 + offset], 'little') * 1e-3
+        assert fields['soc'] == buf[141 + offset]
+        assert ('temp3' in fields) == is_new_11x
+
+
+def test_decode_cache_num_cells():
+    jk = JKBt('test_jk', name='jk')
+    buf = _cell_frame(False)
+    assert list(jk._decode_frame(buf)[1]) == []  # decoded before num_cells is known
+    jk.num_cells = 8
+    assert len(jk._decode_frame(buf)[1]) == 8
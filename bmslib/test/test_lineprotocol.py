@@ -0,0 +1,42 @@
+from bmslib.lineprotocol import LineBuffer, line_prefix, encode_fields
+
+
+def test_encode_line():
+    prefix = line_prefix('batmon', dict(device='my bms,1', uid=None, cell_index=3))
+    assert prefix == b'batmon,cell_index=3,device=my\\ bms\\,1 '
+    assert encode_fields(dict(voltage=13.2, n=3, on=True, nan=float('nan'), s='a"b')) == \
+           b'voltage=13.2,n=3i,on=true,s="a\\"b"'
+
+
+def test_line_buffer_bounded():
+    lb = LineBuffer(max_points=10)
+    for i in range(12):
+        lb.append(b'm ', b'x=%di' % i, i)
+    assert len(lb) <= 10 and lb.num_dropped >= 2
+    data, n = lb.take()
+    assert data.count(b'\n') == n and data.endswith(b'm x=11i 11\n')
+
+    lb.append(b'm ', b'x=12i', 12)
+    lb.give_back(data, n)  # failed write
+    data2, n2 = lb.take()
+    assert n2 == 10 and data2.startswith(b'm x=3i 3\n') and data2.endswith(b'x=12i 12\n')
+
+
+def test_line_buffer_take_batch():
+    lb = LineBuffer(max_points=100)
+    for i in range(25):
+        lb.append(b'm ', b'x=%di' % i, i)
+    batches = []
+    while len(lb):
+        data, n = lb.take(10)
+        assert data.count(b'\n') == n
+        batches.append(bytes(data))
+        lb.recycle(data)
+    assert [b.count(b'\n') for b in batches] == [10, 10, 5]
+    assert batches[1].startswith(b'm x=10i 10\n') and batches[2].endswith(b'm x=24i 24\n')
+
+    lb.append(b'm ', b'x=0i', 0)
+    data, n = lb.take(10)
+    lb.append(b'm ', b'x=1i', 1)
+    lb.give_back(data, n)  # failed write
+    assert lb.take(10)[0] == b'm x=0i 0\nm x=1i 1\n'
@@ -0,0 +1,24 @@
+from bmslib.metrics import Registry
+
+
+def test_histogram_and_export():
+    reg = Registry()
+    for v in (.002, .003, .02, .2, 3.):
+        reg.observe('fetch', 'jk', v)
+    reg.observe('loop_lag', None, .001)
+    reg.inc('errors', 'jk', 'TimeoutError')
+    reg.inc('connects', 'jk', n=2)
+    reg.add_collector(lambda: dict(influxdb_queue=12))
+
+    h = reg.histograms[('fetch', 'jk')]
+    assert h.count == 5 and h.quantile(.5) == .025 and h.quantile(1) == 3.
+
+    s = reg.summary('jk')
+    assert s['latency']['fetch']['n'] == 5 and s['latency']['loop_lag']['n'] == 1
+    assert s['errors'] == {'TimeoutError': 1} and s['connects'] == 2
+
+    text = reg.prometheus_text()
+    assert 'batmon_fetch_seconds_bucket{device="jk",le="0.005"} 2\n' in text
+    assert 'batmon_fetch_seconds_bucket{device="jk",le="+Inf"} 5\n' in text
+    assert 'batmon_errors_total{device="jk",type="TimeoutError"} 1\n' in text
+    assert 'batmon_loop_lag_seconds_count 1\n' in text and 'batmon_influxdb_queue 12.0\n' in text
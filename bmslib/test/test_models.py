@@ -0,0 +1,14 @@
+from bmslib.models import get_bms_model_class, register_bms_model, BMS_MODELS
+
+
+def test_lazy_registry():
+    assert isinstance(BMS_MODELS['jbd'], str) or BMS_MODELS['jbd'].__name__ == 'JbdBt'
+    assert get_bms_model_class('jbd').__name__ == 'JbdBt'
+    assert BMS_MODELS['jbd'] is get_bms_model_class('jbd')  # resolved once
+    assert get_bms_model_class('no_such_bms') is None
+
+    register_bms_model('my_dummy', 'bmslib.models.dummy:DummyBt')
+    try:
+        assert get_bms_model_class('my_dummy') is get_bms_model_class('dummy')
+    finally:
+        del BMS_MODELS['my_dummy']
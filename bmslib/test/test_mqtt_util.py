@@ -0,0 +1,58 @@
+import json
+
+import mqtt_util
+from bmslib.bms import BmsSample
+
+
+def test_json_state():
+    class _Client:
+        def __init__(self):
+            self.msgs = {}
+
+        def publish(self, topic, data, retain=False):
+            self.msgs[topic] = data
+            return type('Info', (), dict(rc=0))()
+
+    c = _Client()
+    s = BmsSample(12.2, 2, charge=33, capacity=100, switches=dict(charge=True))
+    mqtt_util.publish_sample_json(c, 'json_dev', s)
+    mqtt_util.publish_cell_voltages_json(c, 'json_dev', [3300, 3310, 3305])
+    mqtt_util.publish_hass_discovery(c, 'json_dev', 60, s, num_cells=3, temperatures=[], json_state=True)
+
+    state = json.loads(c.msgs['json_dev/state'])
+    assert state['voltage'] == 12.2 and state['switches'] == dict(charge='ON')
+    assert json.loads(c.msgs['json_dev/cell_voltages'])['max_index'] == 2
+    d = json.loads(c.msgs['homeassistant/sensor/json_dev/_cell_voltages_2/config'])
+    assert d['state_topic'] == 'json_dev/cell_voltages' and d['value_template'] == '{{ value_json.cells[1] }}'
+
+
+def test_publish_dedupe_cache():
+    c = mqtt_util.PublishDedupeCache(max_size=3, ttl=10)
+    c.set_deadband('soc/current', rel=1e-3)
+    c.set_device_ttl('fast', 2)
+
+    assert c.check('dev/soc/current', '12.22', 0)
+    c.published('dev/soc/current', '12.22', 0)
+    assert not c.check('dev/soc/current', '12.22', 1)
+    assert not c.check('dev/soc/current', '12.23', 1)  # within deadband
+    assert c.check('dev/soc/current', '12.5', 1)
+    assert c.check('dev/soc/current', '12.22', 10)  # ttl
+
+    c.published('fast/x', 1, 0)
+    assert not c.check('fast/x', 1, 1.9) and c.check('fast/x', 1, 2)
+
+    for i in range(5):
+        c.published('dev/cell_voltages/%d' % i, 3.3, 0)
+    assert len(c) == 3 and c.evictions == 4
+    assert c.stats()['hits'] == 3
+
+
+def test_default_deadbands():
+    c = mqtt_util.publish_cache
+    for topic, a, b, dup in (('dev/soc/total_voltage', 53.12, 53.13, False),  # one unit of the last digit is published
+                             ('dev/soc/total_voltage', 53.12, 53.120000001, True),
+                             ('dev/cell_voltages/3', 3.312, 3.313, False),  # 1 mV
+                             ('dev/cell_voltages/3', 3.313, 3.312 + 0.001, True)):
+        c.published(topic, a, 0)
+        assert c.is_duplicate(topic, b, 1) == dup, (topic, a, b)
+    c._entries.clear()
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from bmslib.bms import DeviceInfo
+from bmslib.models.dummy import JKDummy
+from bmslib.models.jikong import JKBt
+from bmslib.sampling import BmsSampler, BmsSampleSink
+
+
+class RecordingSink(BmsSampleSink):
+    def __init__(self):
+        self.samples = []
+
+    def publish_sample(self, bms_name, sample):
+        self.samples.append(sample)
+
+    def publish_voltages(self, bms_name, voltages, stats=None):
+        pass
+
+    def publish_meters(self, bms_name, readings):
+        pass
+
+
+def test_push_sampling():
+    settings, cells = JKDummy().MSGS
+
+    async def run():
+        # a connected JK, 0x02 frames are fed by the test instead of the BMS streaming them
+        bms = JKBt('test_jk', name='jk')
+        bms.set_connection_policy('always')
+        bms.client._connected = True
+        bms._notification_handler(None, settings)
+        bms.num_cells = 8
+
+        sink = RecordingSink()
+        sampler = BmsSampler(bms, mqtt_client=None, dt_max_seconds=600, expire_after_seconds=0, sinks=[sink])
+        sampler.device_info = DeviceInfo('JK', 'test', None, None, 'jk')
+        sampler.PUSH_TIMEOUT = .3
+
+        num_fetches = 0
+        fetch = bms.fetch
+
+        async def counting_fetch():
+            nonlocal num_fetches
+            num_fetches += 1
+            return await fetch()
+
+        bms.fetch = counting_fetch
+
+        bms._notification_handler(None, cells)
+        assert await sampler() is not None and num_fetches == 1  # polled
+        assert await sampler.enable_push()
+
+        # pushed 0x02 frames reach the sinks and meters
+        for _ in range(3):
+            await asyncio.sleep(.02)
+            bms._notification_handler(None, cells)
+        await asyncio.sleep(.02)
+        assert len(sink.samples) == 4 and sampler.num_samples == 4
+        assert sampler.get_meter_state()['total_charge']['reading'] != 0
+
+        # the scheduled tick only keeps the connection alive while pushes are fresh
+        assert await sampler() is sink.samples[-1] and num_fetches == 1
+
+        # a full queue drops the oldest samples
+        pushed = [sink.samples[-1].__copy__() for _ in range(6)]
+        for s in pushed:
+            s.timestamp = time.time()
+            sampler._enqueue_push(s)
+        assert sampler._push_queue.qsize() == 4
+        await asyncio.sleep(.05)
+        assert len(sink.samples) == 8 and sink.samples[-4:] == pushed[2:]
+
+        # no pushes for PUSH_TIMEOUT: polling takes over
+        await asyncio.sleep(.35)
+        assert await sampler() is not None and num_fetches == 2
+
+        task = sampler._push_task
+        sampler.stop()
+        await asyncio.sleep(0)
+        assert task.cancelled()
+
+    asyncio.run(run())
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import tempfile
+
+from bmslib.models.jbd import JbdBt
+from bmslib.replay import CaptureRecorder, CaptureSession, open_replay
+
+
+def test_capture_replay():
+    async def run(fn):
+        bms = JbdBt('test_jbd', name='jbd1')
+        bms.start_capture(fn)
+        async with bms:
+            recorded = await bms.fetch()
+        bms.stop_capture()
+        assert not isinstance(bms.client, CaptureRecorder)
+
+        replayed = open_replay(fn, speed=0)
+        assert replayed.name == 'jbd1'
+        for _ in range(3):
+            async with replayed:
+                sample = await replayed.fetch()
+            assert sample.voltage == recorded.voltage and sample.current == recorded.current
+            assert sample.soc == recorded.soc
+        assert replayed.client.num_notifications == 3
+        async with replayed.client as client:
+            assert client is replayed.client and client.is_connected
+
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(run(os.path.join(d, 'jbd.jsonl.gz')))
+
+
+def test_match():
+    events = [dict(t=0., op='connect', services=[]),
+              dict(t=.1, op='write', char='rx', data='dda50300fffd77'),
+              dict(t=.2, op='notify', char='tx', data='dd03'),
+              dict(t=.3, op='write', char='rx', data='dda50400fffc77'),
+              dict(t=.4, op='notify', char='tx', data='dd04'),
+              dict(t=.5, op='notify', char='tx', data='dd04'), ]
+    s = CaptureSession(dict(format='batmon-capture'), events)
+    assert len(s.segments) == 3 and abs(s.segments[2].frames[1][0] - .2) < 1e-9
+    assert s.match('rx', bytes.fromhex('dda50400fffc77'), 1) == 2
+    assert s.match('rx', bytes.fromhex('dda50300fffd77'), 2) == 1  # wraps around
+    assert s.match('rx', bytes.fromhex('dda504ffffff'), 1) == 2  # longest common prefix
+    assert s.match('other', bytes.fromhex('dda50300fffd77'), 1) is None
+    assert s.is_stream(2) and not s.is_stream(1)
@@ -0,0 +1,32 @@
+import asyncio
+from types import SimpleNamespace
+
+from bmslib.scanner import ScannerService, needs_discovery
+
+
+def test_device_cache():
+    async def run():
+        svc = ScannerService(stale_after=60)
+        dev = SimpleNamespace(address='C8:47:8C:00:00:01', name=None)
+        waiter = asyncio.ensure_future(svc.wait_for('c8:47:8c:00:00:01', timeout=1))
+        await asyncio.sleep(0)
+        svc._on_detect(dev, SimpleNamespace(rssi=-70, local_name='JK_B2A24S'))
+        entry = await waiter
+        assert entry.name == 'JK_B2A24S' and entry.rssi == -70
+
+        svc._on_detect(dev, SimpleNamespace(rssi=-60, local_name=None))
+        assert svc.lookup('C8:47:8C:00:00:01').rssi == -60 and svc.find_by_name('JK_B2A24S') is entry
+        assert await svc.wait_for('00:00:00:00:00:00', timeout=.01) is None
+
+        entry.last_seen -= 100
+        assert svc.lookup(entry.address) is None
+        assert [d.address for d in await svc.discover(1, wanted=['JK_B2A24S'])] == [entry.address]
+
+    asyncio.run(run())
+
+
+def test_needs_discovery():
+    assert not needs_discovery(dict(address='C8:47:8C:E4:54:0E', alias='jk'))
+    assert not needs_discovery(dict(address='1B5E1C9B-9E0A-4D7E-A9B6-1B76A4B4F2F1', alias='jk'))
+    assert needs_discovery(dict(address='C8:47:8C:E4:54:0E'))
+    assert needs_discovery(dict(address='JK_B2A24S', alias='jk'))
@@ -0,0 +1,217 @@
+import asyncio
+import time
+
+import bleak.exc
+
+from bmslib.models.dummy import SimulatedBt
+from bmslib.scheduler import DeviceSchedule, SampleScheduler, create_scheduler
+
+
+def test_deadline_drift_compensation():
+    s = DeviceSchedule("dev", period=1.0)
+    assert s.delay(100.) == 0
+
+    # fetch takes 0.3s, the next tick is still at t0 + period
+    s.tick_start(100.)
+    s.tick_done(100.3, success=True)
+    assert s.deadline == 101.
+    assert round(s.delay(100.3), 6) == 0.7
+
+
+def test_skip_missed_ticks():
+    s = DeviceSchedule("dev", period=1.0, jitter_budget=.25)
+    s.delay(0.)
+    s.tick_start(0.)
+    s.tick_done(0.1, success=True)
+    s.tick_start(1.)
+    s.tick_done(4.5, success=True)  # stalled
+    assert s.num_skipped > 0
+    assert s.deadline > 4.5
+    assert s.deadline - 4.5 <= s.period
+
+
+def test_adapt_period_to_slow_device():
+    s = DeviceSchedule("slow", period=1.0)
+    t = 0.
+    s.delay(t)
+    for _ in range(20):
+        s.tick_start(t)
+        t += 3.
+        s.tick_done(t, success=True)
+    assert s.period >= 3.
+    assert s.period <= s.max_period
+
+
+def test_error_backoff():
+    s = DeviceSchedule("dev", period=1.0)
+    s.delay(0.)
+    s.tick_start(0.)
+    s.tick_done(0.01, success=False)
+    assert s.period > 1.0
+    s.tick_start(s.deadline)
+    s.tick_done(s.deadline + 0.01, success=None)  # no data, no error
+    assert s.num_errors_row == 1
+    s.tick_start(s.deadline)
+    s.tick_done(s.deadline + 0.01, success=True)
+    assert s.num_errors_row == 0
+    assert s.period == 1.0
+
+
+def test_serial_slow_device_does_not_stall_others():
+    shutdown = False
+    counts = dict(fast=0, slow=0)
+
+    async def fast():
+        counts['fast'] += 1
+        await asyncio.sleep(0.001)
+        return True
+
+    async def slow():
+        counts['slow'] += 1
+        await asyncio.sleep(0.2)
+        return True
+
+    async def run():
+        nonlocal shutdown
+        sched = SampleScheduler(period=0.05, concurrency=1)
+        sched.add(fast, name='fast')
+        sched.add(slow, name='slow')
+        task = asyncio.create_task(sched.run(is_shutdown=lambda: shutdown))
+        await asyncio.sleep(1.)
+        shutdown = True
+        await task
+        return sched
+
+    t0 = time.time()
+    sched = asyncio.run(run())
+    assert time.time() - t0 < 2
+    assert sched.schedules['slow'].period > 0.2
+    assert counts['fast'] > 2 * counts['slow']
+
+
+class _FakeBms:
+    def __init__(self, name):
+        self.name = name
+        self.is_connected = False
+
+    async def disconnect(self):
+        self.is_connected = False
+
+
+def test_adapters_sample_in_parallel():
+    shutdown = False
+    running = dict(hci0=0, hci1=0)
+    max_running = dict(hci0=0, hci1=0)
+
+    def sampler(adapter):
+        async def fn():
+            running[adapter] += 1
+            max_running[adapter] = max(max_running[adapter], running[adapter])
+            await asyncio.sleep(0.02)
+            running[adapter] -= 1
+            return True
+
+        return fn
+
+    async def run():
+        nonlocal shutdown
+        sched = SampleScheduler(period=0.01, concurrency=1, per_adapter=True)
+        for i in range(3):
+            sched.add(sampler('hci0'), name='a%d' % i, adapter='hci0')
+            sched.add(sampler('hci1'), name='b%d' % i, adapter='hci1')
+        task = asyncio.create_task(sched.run(is_shutdown=lambda: shutdown))
+        await asyncio.sleep(.3)
+        shutdown = True
+        await task
+        return sched
+
+    sched = asyncio.run(run())
+    assert set(sched.pools.keys()) == {'hci0', 'hci1'}
+    assert max_running == dict(hci0=1, hci1=1)
+    assert all(s.num_ticks > 0 for s in sched.schedules.values())
+
+
+def test_connection_slots_evict_idle():
+    shutdown = False
+    devices = [_FakeBms('d%d' % i) for i in range(3)]
+    max_connected = 0
+
+    def sampler(bms):
+        async def fn():
+            nonlocal max_connected
+            bms.is_connected = True  # keep alive
+            max_connected = max(max_connected, sum(d.is_connected for d in devices))
+            await asyncio.sleep(0.005)
+            return True
+
+        return fn
+
+    async def run():
+        nonlocal shutdown
+        sched = SampleScheduler(period=0.01, concurrency=None, max_connections=2)
+        for bms in devices:
+            sched.add(sampler(bms), name=bms.name, bms=bms)
+        task = asyncio.create_task(sched.run(is_shutdown=lambda: shutdown))
+        await asyncio.sleep(.3)
+        shutdown = True
+        await task
+
+    asyncio.run(run())
+    assert max_connected <= 2
+
+
+def test_simulated_devices_concurrent():
+    async def run():
+        scheduler = create_scheduler(.1, concurrent=True)
+        devices = [SimulatedBt('sim%d' % i, name='sim%d' % i, connect_delay=.01, fetch_delay=.01, timeout_rate=0,
+                               disconnect_rate=0, seed=i) for i in range(20)]
+        for bms in devices:
+            async def sample(bms=bms):
+                async with bms:
+                    return await bms.fetch()
+
+            scheduler.add(sample, name=bms.name, adapter=bms.adapter, bms=bms)
+        t_end = time.monotonic() + .5
+        await scheduler.run(is_shutdown=lambda: time.monotonic() > t_end)
+
+        # the device drops the connection while we wait for a notification
+        bms = SimulatedBt('sim', name='sim', connect_delay=0, fetch_delay=.01, timeout_rate=0, disconnect_rate=1)
+        await bms.connect()
+        try:
+            await bms.fetch()
+            assert False
+        except bleak.exc.BleakError:
+            assert not bms.is_connected
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    # serially, 20 devices with ~30ms each would only get 1-2 ticks
+    assert all(s['ticks'] >= 3 for s in stats.values()), stats
+
+
+def test_max_errors():
+    async def run(concurrent):
+        scheduler = create_scheduler(.01, concurrent=concurrent, max_errors=2)
+        num_ok = 0
+
+        async def ok():
+            nonlocal num_ok
+            num_ok += 1
+            return True
+
+        async def fail():
+            raise Exception('fail')
+
+        scheduler.add(ok, name='ok', exclusive=False)
+        scheduler.add(fail, name='fail', exclusive=False)
+        t_end = time.monotonic() + .5
+        await scheduler.run(is_shutdown=lambda: time.monotonic() > t_end)
+        return time.monotonic() < t_end, num_ok
+
+    # serial: stop (and let the watchdog restart the add-on)
+    stopped, _ = asyncio.run(run(concurrent=False))
+    assert stopped
+
+    # concurrent: restart the loops, as the healthy device keeps sampling
+    stopped, num_ok = asyncio.run(run(concurrent=True))
+    assert not stopped and num_ok > 20
@@ -0,0 +1,107 @@
+import sys
+import tempfile
+import time
+import types
+
+from bmslib.sinks import InfluxDBSink
+from bmslib.spool import Spool
+
+
+class _InfluxDBClient:
+    def __init__(self, **kwargs):
+        self._session = types.SimpleNamespace(request=None)
+
+
+def _sink(write, **kwargs) -> InfluxDBSink:
+    """ InfluxDBSink with a stub `influxdb` module (it is an optional dependency) and `write` as the HTTP write """
+    stub = types.ModuleType('influxdb')
+    stub.InfluxDBClient = _InfluxDBClient
+    mod = sys.modules.get('influxdb')
+    sys.modules['influxdb'] = stub
+    try:
+        sink = InfluxDBSink(database='test', verify_ssl=True, **kwargs)
+    finally:
+        if mod is None:
+            del sys.modules['influxdb']
+        else:
+            sys.modules['influxdb'] = mod
+    sink._write = write
+    sink.silent = True
+    return sink
+
+
+def _wait(cond, timeout=2.):
+    t_end = time.time() + timeout
+    while not cond() and time.time() < t_end:
+        time.sleep(.01)
+    return cond()
+
+
+def test_influxdb_batch_wakeup():
+    batches = []
+
+    def write(data):
+        batches.append(data.count(b'\n'))
+        return True
+
+    sink = _sink(write, flush_interval=3600, batch_size=10)
+    sink.publish_voltages('bms', [3300 + i for i in range(8)])  # 1 + 8 points, below the batch size
+    time.sleep(.05)
+    assert not batches and sink.stats()['queue'] == 9
+
+    sink.publish_voltages('bms', [3200 + i for i in range(8)])
+    assert _wait(lambda: sink.num_written == 18)
+    assert batches == [10, 8]
+    s = sink.stats()
+    assert s['queue'] == 0 and s['written'] == 18 and s['errors'] == 0 and s['dropped'] == 0
+
+
+def test_influxdb_retry_backoff():
+    attempts = []
+
+    def write(data):
+        attempts.append((time.monotonic(), bytes(data)))
+        if len(attempts) <= 3:
+            raise ConnectionError('unreachable')
+        return True
+
+    sink = _sink(write, flush_interval=.05, max_retry_delay=.3)
+    sink.publish_meters('bms', dict(charge=1.5, energy=2.))
+    assert _wait(lambda: sink.num_written == 1, timeout=5)
+
+    # the failed batch is given back and retried unchanged
+    assert len(attempts) == 4 and len({data for _, data in attempts}) == 1
+    gaps = [t1 - t0 for (t0, _), (t1, _) in zip(attempts, attempts[1:])]
+    assert .1 <= gaps[0] < gaps[1] < gaps[2] < .3 + .15, gaps  # .1, .2, .4 capped to .3
+    s = sink.stats()
+    assert s['errors'] == 3 and s['written'] == 1 and s['queue'] == 0
+    assert _wait(lambda: sink._num_retries == 0)
+
+
+def test_influxdb_shutdown_flush():
+    def write(data):
+        return False
+
+    # without a spool the points stay queued (and are logged)
+    sink = _sink(write, flush_interval=3600, batch_size=5)
+    for i in range(12):
+        sink.publish_meters('bms', dict(charge=float(i)))
+    sink.flush()
+    assert sink.stats()['queue'] == 12 and sink.stats()['errors'] == 1
+
+    # with a spool, the failed batch and the remaining points are spooled
+    with tempfile.TemporaryDirectory() as d:
+        sink = _sink(write, flush_interval=3600, batch_size=5)
+        sink.spool = Spool(d)
+        for i in range(12):
+            sink.publish_meters('bms', dict(charge=float(i)))
+        sink.flush()
+        assert sink.stats()['queue'] == 0
+
+        sp = Spool(d)
+        recs = []
+        while (rec := sp.peek()) is not None:
+            recs.append(rec)
+            sp.ack()
+        sp.close()
+        assert [n for _, n in recs] == [5, 7] and b''.join(data for data, _ in recs).count(b'\n') == 12
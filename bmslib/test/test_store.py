@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+from bmslib import store
+
+
+def _state(x):
+    return dict(total_energy=dict(reading=x), total_charge=dict(reading=x * 20))
+
+
+def test_meter_journal_recovery():
+    fns = store.bms_meter_states_fn, store.bms_meter_journal_fn
+    with tempfile.TemporaryDirectory() as d:
+        store.bms_meter_states_fn = os.path.join(d, 'bms_meter_states.json')
+        store.bms_meter_journal_fn = os.path.join(d, 'bms_meter_states.journal')
+        try:
+            store.store_meter_states(dict(bms1=_state(1.), bms2=_state(5.)))
+
+            j = store.MeterJournal(store.load_meter_states(), sync_interval=0)
+            for i in range(10):
+                j.append('bms1', _state(1. + i / 10))
+            j.append('bms3', _state(7.))
+
+            # power cut: no compaction, a torn record at the end
+            with open(store.bms_meter_journal_fn, 'ab') as fh:
+                fh.write(b'\x30\x00\x00\x00\x01\x02')
+            states = store.load_meter_states()
+            assert states == dict(bms1=_state(1.9), bms2=_state(5.), bms3=_state(7.))
+
+            # reopen truncates the torn tail, new records are readable
+            j = store.MeterJournal(states, sync_interval=0, compact_bytes=200)
+            j.append('bms2', _state(6.))
+            assert store.load_meter_states()['bms2'] == _state(6.)
+
+            j.maintain()  # compact
+            assert os.path.getsize(store.bms_meter_journal_fn) == 0
+            assert store.load_meter_states() == dict(bms1=_state(1.9), bms2=_state(6.), bms3=_state(7.))
+            j.close()
+        finally:
+            store.bms_meter_states_fn, store.bms_meter_journal_fn = fns
+
+
+def test_meter_journal_coalesce():
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, 'j')
+        j = store.MeterJournal({}, path=fn, sync_interval=60)
+        for i in range(100):
+            j.append('bms%d' % (i % 2), _state(i))
+        assert os.path.getsize(fn) == 0  # not due yet
+        j._t_sync -= 60
+        j.maintain()
+        states = {}
+        store._replay_journal(fn, states)
+        assert states == dict(bms0=_state(98), bms1=_state(99)) and j.num_bytes_written == os.path.getsize(fn)
+        assert os.path.getsize(fn) < 300  # one record per device
+        j._fh.close()
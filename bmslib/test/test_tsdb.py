@@ -0,0 +1,68 @@
+import os
+import tempfile
+from array import array
+
+from bmslib.tsdb import TimeSeriesStore, METRICS, DAY
+
+
+def _row(did, ts, v, cells=None):
+    return (did, ts, v, v / 10, v * v / 10) + (None,) * (len(METRICS) - 3) + (cells,)
+
+
+def test_rollup_and_retention():
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, 'ts.sqlite')
+        st = TimeSeriesStore(fn, rollup_lag=0)
+        did = st.device_id('bms1')
+        t0 = 1_700_000_000 - 1_700_000_000 % 3600
+        st.insert([_row(did, t0 + i, 10. + (i % 60) / 10, array('H', [3300, 3310]).tobytes()) for i in range(7200)])
+        st.rollup(now=t0 + 7200)
+
+        r = st.query('bms1', t0, t0 + 120, tier='1min', columns=('voltage', 'voltage_min', 'voltage_max', 'n'))
+        assert r['ts'] == [t0, t0 + 60] and r['n'] == [60, 60]
+        assert abs(r['voltage'][0] - 12.95) < 1e-9 and r['voltage_min'][0] == 10 and r['voltage_max'][0] == 15.9
+
+        r = st.query('bms1', t0, t0 + 7200, tier='1h', columns=('voltage', 'voltage_max', 'n'))
+        assert r['n'] == [3600, 3600] and abs(r['voltage'][1] - 12.95) < 1e-9 and r['voltage_max'][1] == 15.9
+
+        r = st.query('bms1', t0, t0 + 2, tier='raw', columns=('voltage', 'cells'))
+        assert list(r['cells'][0]) == [3300, 3310]
+        st.close()
+
+        # reopen: continues rolling up after the last bucket
+        st = TimeSeriesStore(fn, rollup_lag=0, retention=dict(raw=DAY))
+        assert st.devices() == ['bms1']
+        st.insert([_row(did, t0 + 7200 + i, 20.) for i in range(60)])
+        st.rollup(now=t0 + 7260)
+        assert st.query('bms1', t0, t0 + 7300, tier='1min', columns=('n',))['n'][-1] == 60
+        assert st.pick_tier(t0, t0 + 7200, max_points=100, now=t0 + 7300) == 'r15min'
+
+        st.apply_retention(now=t0 + DAY + 3600)
+        assert len(st.query('bms1', t0, t0 + 8000, tier='raw')['ts']) == 3600 + 60
+        assert len(st.query('bms1', t0, t0 + 8000, tier='1min')['ts']) == 121
+
+
+def test_backfill_meters():
+    from bmslib.models.dummy import DummyBt
+    from bmslib.sampling import BmsSampler
+
+    with tempfile.TemporaryDirectory() as d:
+        st = TimeSeriesStore(os.path.join(d, 'ts.sqlite'), rollup_lag=0)
+        did = st.device_id('bms1')
+        t0 = 1_700_000_000 - 1_700_000_000 % 3600
+        st.insert([_row(did, t0 + i, 100.) for i in range(7200)])  # 10 A, 1 kW
+        st.rollup(now=t0 + 3600)  # the 2nd hour is still raw
+
+        h = st.query_history('bms1', end=t0 + 7200, columns=('current', 'power', 'soc', 'charge'))
+        assert len(h['ts']) == 60 + 3600 and h['ts'] == sorted(h['ts'])
+
+        sampler = BmsSampler(DummyBt('dummy1', name='bms1'), mqtt_client=None, dt_max_seconds=600,
+                             expire_after_seconds=0, invert_current=True)
+        sampler.backfill_meters(h['ts'], h['current'], h['power'], h['soc'], h['charge'])
+        m = {k: v['reading'] for k, v in sampler.get_meter_state().items()}
+        hours = (h['ts'][-1] - h['ts'][0]) / 3600
+        assert abs(m['total_charge'] - 10 * hours) < 1e-6 and abs(m['total_energy'] - hours) < 1e-6
+        # inverted: positive power is charging
+        assert abs(m['total_energy_charge'] - hours) < 1e-6 and m['total_energy_discharge'] == 0
+        assert m['total_cycles'] == 0
+        st.close()
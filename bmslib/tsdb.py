@@ -0,0 +1,187 @@
+"""
+Embedded time-series store (SQLite) with downsampled retention tiers.
+
+Samples are stored in the `raw` table at 1 s resolution. Complete buckets are rolled up into the 1 min, 15 min and 1 h
+tables (avg/min/max per metric), each from the next finer tier. Every tier has its own retention, so months of data
+can be queried fast from the coarse tiers while raw data (including per-cell voltages) is kept for a few days.
+
+All database access is serialized with a lock, the connection can be shared between threads.
+"""
+import math
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Sequence
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+METRICS = ('voltage', 'current', 'power', 'soc', 'charge', 'temperature', 'mos_temperature', 'cell_min', 'cell_max')
+
+DAY = 24 * 3600
+
+# (table, resolution in seconds, default retention in seconds or 0 to keep forever)
+TIERS = (
+    ('raw', 1, 7 * DAY),
+    ('r1min', 60, 90 * DAY),
+    ('r15min', 900, 730 * DAY),
+    ('r1h', 3600, 0),
+)
+
+_COLUMNS = {*METRICS, *(m + '_min' for m in METRICS), *(m + '_max' for m in METRICS), 'n', 'cells'}
+
+TIER_NAMES = {'raw': 'raw', '1s': 'raw', '1min': 'r1min', '15min': 'r15min', '1h': 'r1h'}
+
+
+def _rollup_select(src: str, res: int):
+    if src == 'raw':
+        aggs = ['avg(%s), min(%s), max(%s)' % (m, m, m) for m in METRICS] + ['count(*)']
+    else:
+        aggs = ['sum(%s * n) / sum(CASE WHEN %s IS NULL THEN 0 ELSE n END), min(%s_min), max(%s_max)' % (m, m, m, m)
+                for m in METRICS] + ['sum(n)']
+    return 'SELECT device, ts - ts %% %d AS bucket, %s FROM %s WHERE ts >= ? AND ts < ? GROUP BY device, bucket' % (
+        res, ', '.join(aggs), src)
+
+
+class TimeSeriesStore:
+    """
+    :param retention: per-tier retention in seconds, by table name (e.g. `dict(raw=3*DAY)`), 0 keeps data forever
+    :param rollup_lag: buckets are rolled up after this many seconds, so late samples are included
+    """
+
+    def __init__(self, path: str, retention: Optional[Dict[str, float]] = None, rollup_lag=30.):
+        self.path = path
+        self.retention = {t: r for t, _, r in TIERS}
+        if retention:
+            self.retention.update(retention)
+        self.rollup_lag = rollup_lag
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables()
+
+        self._device_ids: Dict[str, int] = dict(self._db.execute('SELECT name, id FROM devices'))
+        self._rolled_until: Dict[str, int] = {}
+        for table, res, _ in TIERS[1:]:
+            last, = self._db.execute('SELECT max(ts) FROM %s' % table).fetchone()
+            self._rolled_until[table] = (last + res) if last is not None else 0
+        self._t_retention = 0
+
+    def _create_tables(self):
+        db = self._db
+        db.execute('CREATE TABLE IF NOT EXISTS devices (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS raw (device INTEGER NOT NULL, ts INTEGER NOT NULL, %s, cells BLOB, '
+                   'PRIMARY KEY (device, ts)) WITHOUT ROWID' % ', '.join(m + ' REAL' for m in METRICS))
+        cols = ', '.join('%s REAL, %s_min REAL, %s_max REAL' % (m, m, m) for m in METRICS)
+        for table, _, _ in TIERS[1:]:
+            db.execute('CREATE TABLE IF NOT EXISTS %s (device INTEGER NOT NULL, ts INTEGER NOT NULL, %s, '
+                       'n INTEGER, PRIMARY KEY (device, ts)) WITHOUT ROWID' % (table, cols))
+        db.commit()
+
+    def device_id(self, name: str) -> int:
+        did = self._device_ids.get(name)
+        if did is None:
+            with self._lock:
+                self._db.execute('INSERT OR IGNORE INTO devices (name) VALUES (?)', (name,))
+                did, = self._db.execute('SELECT id FROM devices WHERE name = ?', (name,)).fetchone()
+                self._db.commit()
+            self._device_ids[name] = did
+        return did
+
+    def devices(self) -> List[str]:
+        return list(self._device_ids.keys())
+
+    def insert(self, rows: Sequence[tuple]):
+        """
+        :param rows: (device_id, ts, *METRICS, cells) tuples, cells being `array('H')` bytes of mV or None
+        """
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO raw VALUES (%s)' % ','.join('?' * (len(METRICS) + 3)), rows)
+            self._db.commit()
+
+    def rollup(self, now: Optional[float] = None):
+        """ Aggregate complete buckets into the rollup tiers """
+        until = int((now or time.time()) - self.rollup_lag)
+        src = TIERS[0][0]
+        with self._lock:
+            for table, res, _ in TIERS[1:]:
+                until = until - until % res
+                start = self._rolled_until[table]
+                if until > start:
+                    self._db.execute('INSERT OR REPLACE INTO %s %s' % (table, _rollup_select(src, res)), (start, until))
+                    self._rolled_until[table] = until
+                src = table
+            self._db.commit()
+
+    def apply_retention(self, now: Optional[float] = None):
+        now = now or time.time()
+        with self._lock:
+            for table, res, _ in TIERS:
+                ret = self.retention.get(table)
+                if ret:
+                    self._db.execute('DELETE FROM %s WHERE ts < ?' % table, (int(now - ret),))
+            self._db.commit()
+        self._t_retention = now
+
+    def maintain(self, now: Optional[float] = None):
+        """ Rollup, and apply retention once per hour """
+        now = now or time.time()
+        self.rollup(now)
+        if now - self._t_retention > 3600:
+            self.apply_retention(now)
+
+    def pick_tier(self, start: float, end: float, max_points: int, now: Optional[float] = None) -> str:
+        """ The finest tier that returns at most `max_points` per device and covers the time range """
+        now = now or time.time()
+        for table, res, _ in TIERS:
+            ret = self.retention.get(table)
+            if (end - start) / res <= max_points and (not ret or start >= now - ret):
+                return table
+        return TIERS[-1][0]
+
+    def query(self, device: str, start: float, end: float, tier: Optional[str] = None, max_points=2000,
+              columns: Sequence[str] = METRICS) -> Dict[str, list]:
+        """
+        Columnar query. Rollup tiers also have `{metric}_min`, `{metric}_max` and `n` columns.
+        :param tier: table or tier name ('1s', '1min', ..), picked with `pick_tier` if None
+        :return: dict with `ts` and the requested columns
+        """
+        did = self._device_ids.get(device)
+        if did is None:
+            return {c: [] for c in ('ts', *columns)}
+        table = TIER_NAMES.get(tier, tier) if tier else self.pick_tier(start, end, max_points)
+        if table not in self.retention:
+            raise ValueError('unknown tier %s' % tier)
+        for c in columns:
+            if c not in _COLUMNS:
+                raise ValueError('unknown column %s' % c)
+
+        with self._lock:
+            rows = self._db.execute('SELECT ts, %s FROM %s WHERE device = ? AND ts >= ? AND ts < ? ORDER BY ts' % (
+                ', '.join(columns), table), (did, int(start), math.ceil(end))).fetchall()
+        cols = dict(ts=[r[0] for r in rows])
+        for i, c in enumerate(columns, start=1):
+            cols[c] = [r[i] for r in rows]
+        if 'cells' in cols:
+            cols['cells'] = [(array('H', b) if b is not None else None) for b in cols['cells']]
+        return cols
+
+    def query_history(self, device: str, end: Optional[float] = None,
+                      columns: Sequence[str] = METRICS) -> Dict[str, list]:
+        """
+        All data of a device up to `end` at 1 min resolution, continued with the raw samples not rolled up yet.
+        """
+        end = end or time.time()
+        cols = self.query(device, 0, end, tier='1min', columns=columns)
+        start = (cols['ts'][-1] + 60) if cols['ts'] else 0
+        for c, v in self.query(device, start, end, tier='raw', columns=columns).items():
+            cols[c] += v
+        return cols
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -15,8 +15,11 @@ import bmslib.bt
 import mqtt_util
 from bmslib.bms import MIN_VALUE_EXPIRY
 from bmslib.group import BmsGroup, VirtualGroupBms
+from bmslib.metrics import metrics
 from bmslib.models import construct_bms
 from bmslib.sampling import BmsSampler
+from bmslib.scanner import ScannerService, needs_discovery
+from bmslib.scheduler import create_scheduler, add_sampler
 from bmslib.store import load_user_config
 from bmslib.util import get_logger, exit_process
 from mqtt_util import mqtt_last_publish_time, mqtt_message_handler, mqtt_process_action_queue
@@ -27,29 +30,7 @@ user_config: Dict[str, any] = load_user_config()
 
 shutdown = False
 t_last_store = 0
-
-
-async def fetch_loop(fn, period, max_errors):
-    num_errors_row = 0
-    while not shutdown:
-        try:
-            if await fn():
-                num_errors_row = 0
-        except Exception as e:
-            num_errors_row += 1
-            logger.error('Error (num %d, max %d) reading BMS: %s', num_errors_row, max_errors, e)
-            logger.error('Stack: %s', traceback.format_exc())
-            if max_errors and num_errors_row > max_errors:
-                logger.warning('too many errors, abort')
-                break
-        await asyncio.sleep(period)
-    logger.info("fetch_loop %s ends", fn)
-
-
-def store_states(samplers: List[BmsSampler]):
-    meter_states = {s.bms.name: s.get_meter_state() for s in samplers}
-    from bmslib.store import store_meter_states
-    store_meter_states(meter_states)
+meter_journal = None
 
 
 def bg_checks(sampler_list, timeout, t_start):
@@ -69,11 +50,11 @@ def bg_checks(sampler_list, timeout, t_start):
             return False
 
     global t_last_store
-    # store persistent states (metering) every 30s
-    if now - (t_last_store or t_start) > 30:
+    # meter states are journaled per sample, fsync and compact the journal every 30s
+    if now - (t_last_store or t_start) > 30 and meter_journal:
         t_last_store = now
         try:
-            store_states(sampler_list)
+            meter_journal.maintain()
         except Exception as e:
             logger.error('Error storing states: %s', e)
 
@@ -106,7 +87,9 @@ async def background_loop(timeout: float, sampler_list: List[BmsSampler]):
         if not bg_checks(sampler_list, timeout, t_start):
             break
 
+        t = time.perf_counter()
         await asyncio.sleep(.1)
+        metrics.observe('loop_lag', None, max(0., time.perf_counter() - t - .1))
 
 
 async def main():
@@ -125,12 +108,28 @@ async def main():
         except Exception as e:
             logger.warning("Error power cycling BT: %s", e)
 
+    # one long-lived scanner per adapter, its device cache is shared by all devices on that adapter
+    devices = []
+    dev_configs = [dev for dev in user_config.get('devices', []) if dev.get('address') and
+                   not dev['address'].startswith(('#', 'test_', 'replay:')) and
+                   not dev.get('type', '').startswith(('group', 'dummy', 'simulated'))]
     try:
         if len(sys.argv) > 1 and sys.argv[1] == "skip-discovery":
             raise Exception("skip-discovery")
-        devices = await asyncio.wait_for(bmslib.bt.bt_discovery(logger), 30)
+        adapters = set(dev.get('adapter') for dev in dev_configs) or {None}
+        for adapter in adapters:
+            await ScannerService.get(adapter).start()
+        for adapter in adapters:
+            # only wait for devices that construct_bms needs to resolve, returns early when they have been seen
+            wanted = [dev['address'] for dev in dev_configs if dev.get('adapter') == adapter and needs_discovery(dev)]
+            if wanted or not dev_configs:
+                logger.info('BT Discovery:')
+                # slow or rarely advertising devices can take a while, but this returns once all wanted are seen
+                devices += await ScannerService.get(adapter).discover(30 if wanted else 5, wanted=wanted)
+            else:
+                logger.info('All devices have addresses and aliases, discovering in background')
+                asyncio.create_task(ScannerService.get(adapter).discover(5))
     except Exception as e:
-        devices = []
         logger.error('Error discovering devices: %s', e)
 
     verbose_log = user_config.get('verbose_log', False)
@@ -153,6 +152,11 @@ async def main():
         name = bms.name
         assert name not in names, "duplicate name %s" % name
 
+        if dev.get('capture') and not bms.is_virtual:
+            from bmslib.store import store_file
+            os.makedirs(store_file('capture'), exist_ok=True)
+            bms.start_capture(store_file('capture/%s-%s.jsonl.gz' % (name, time.strftime('%Y%m%d-%H%M%S'))))
+
         bms_list.append(bms)
         names.add(name)
         dev_args[name] = dev
@@ -162,8 +166,11 @@ async def main():
         **{bms.name: bms for bms in bms_list}}
     groups_by_bms: Dict[str, BmsGroup] = {}
 
+    connection_policy = user_config.get('connection_policy', None) or \
+                        ('always' if user_config.get('keep_alive', False) else 'per_sample')
     for bms in bms_list:
-        bms.set_keep_alive(user_config.get('keep_alive', False))
+        bms.set_connection_policy(connection_policy,
+                                  idle_timeout=float(user_config.get('connection_idle_timeout', 30)))
 
         if isinstance(bms, VirtualGroupBms):
             group_bms = bms
@@ -231,6 +238,19 @@ async def main():
         from bmslib.sinks import InfluxDBSink
         sinks.append(InfluxDBSink(**{k[9:]: v for k, v in user_config.items() if k.startswith('influxdb_')}))
 
+    if user_config.get('local_store', False):
+        from bmslib.sinks import LocalStoreSink
+        from bmslib.store import store_file
+        from bmslib.tsdb import DAY
+        raw_days = user_config.get('local_store_raw_days', None)
+        sinks.append(LocalStoreSink(store_file('batmon.sqlite'),
+                                    retention=raw_days and dict(raw=float(raw_days) * DAY)))
+
+    metrics.add_collector(lambda: {'mqtt_cache_' + k: v for k, v in mqtt_util.publish_cache.stats().items()})
+    for sink in sinks:
+        if hasattr(sink, 'stats'):
+            metrics.add_collector(lambda sink=sink: {'influxdb_' + k: v for k, v in sink.stats().items()})
+
     if user_config.get("telemetry"):
         try:
             from bmslib.sinks import TelemetrySink
@@ -250,17 +270,55 @@ async def main():
         current_calibration_factor=float(dev_args[bms.name].get('current_calibration', 1.0)),
         bms_group=groups_by_bms.get(bms.name),
         sinks=sinks,
+        history_size=int(user_config.get('history_size', 3600)),
+        json_state=user_config.get('mqtt_json_state', False),
     ) for bms in bms_list]
 
+    if user_config.get('local_store_backfill_meters', False):
+        from bmslib.sinks import LocalStoreSink
+        store = next((sink.store for sink in sinks if isinstance(sink, LocalStoreSink)), None)
+        for sampler in sampler_list:
+            name = sampler.bms.name
+            if store is None or name in meter_states or name not in store.devices():
+                continue
+            t0 = time.time()
+            h = store.query_history(name, columns=('current', 'power', 'soc', 'charge'))
+            sampler.backfill_meters(h['ts'], h['current'], h['power'], h['soc'], h['charge'])
+            logger.info('%s: meters backfilled from %d stored samples in %.3fs: %s', name, len(h['ts']),
+                        time.time() - t0, sampler.get_meter_state())
+
+    global meter_journal
+    from bmslib.store import MeterJournal
+    meter_journal = MeterJournal(meter_states, sync_interval=float(user_config.get('meter_sync_interval', 30)))
+    for sampler in sampler_list:
+        if sampler.bms.name not in meter_states:
+            meter_journal.append(sampler.bms.name, sampler.get_meter_state())
+        sampler.sample_listeners.append(lambda s: meter_journal.append(s.bms.name, s.get_meter_state()))
+
     # move groups to the end
     sampler_list = sorted(sampler_list, key=lambda s: bms.is_virtual)
 
+    if user_config.get('api_port', None):
+        from bmslib.api import ApiServer
+        try:
+            await ApiServer(sampler_list, host=user_config.get('api_host', '127.0.0.1'),
+                            port=int(user_config.api_port)).start()
+        except Exception as e:
+            logger.error('Failed to start API: %s', e)
+
     parallel_fetch = user_config.get('concurrent_sampling', False)
+    adapter_concurrency = user_config.get('adapter_concurrency', None)
+    adapter_connections = user_config.get('adapter_connections', None)
 
-    logger.info('Fetching %d BMS + %d virtual + %d others %s, period=%.2fs, keep_alive=%s',
+    if adapter_concurrency:
+        sampling_mode = 'concurrently per adapter (max %d)' % adapter_concurrency
+    else:
+        sampling_mode = 'concurrently' if parallel_fetch else 'serially'
+
+    logger.info('Fetching %d BMS + %d virtual + %d others %s, period=%.2fs, connection_policy=%s',
                 sum(not bms.is_virtual for bms in bms_list),
                 sum(bms.is_virtual for bms in bms_list), len(extra_tasks),
-                'concurrently' if parallel_fetch else 'serially', sample_period, user_config.get('keep_alive', False))
+                sampling_mode, sample_period, connection_policy)
 
     watchdog_en = user_config.get('watchdog', False)
     max_errors = 200 if watchdog_en else 0
@@ -274,6 +332,14 @@ async def main():
     # add another daemon thread, asyncio can dead-lock with bleak TODO bug?
     threading.Thread(target=lambda: background_thread(wd_timeout, sampler_list), daemon=True).start()
 
+    if user_config.get('push_sampling', False):
+        if connection_policy != 'always':
+            logger.warning('push_sampling needs keep_alive, ignored')
+        else:
+            for sampler in sampler_list:
+                if not sampler.bms.is_virtual and await sampler.enable_push():
+                    logger.info('%s: samples are pushed by the BMS', sampler.bms.name)
+
     tasks = sampler_list + extra_tasks
 
     # before we start the loops connect to each bms in random order
@@ -287,43 +353,25 @@ async def main():
         except:
             pass
 
-    if parallel_fetch:
-        # parallel_fetch now uses a loop for each BMS, so they don't delay each other
+    # each sampler runs on its own deadline schedule. in serial mode only one BMS is sampled at a time, but a slow
+    # device only delays the others by its own fetch duration, and its period is stretched accordingly
+    scheduler = create_scheduler(sample_period, concurrent=parallel_fetch, adapter_concurrency=adapter_concurrency,
+                                 adapter_connections=adapter_connections, max_errors=max_errors)
+    for t in tasks:
+        if isinstance(t, BmsSampler):
+            add_sampler(scheduler, t)
+        else:
+            scheduler.add(t)
 
-        # this outer while loop recovers from a cancelled task. this happens when a device disconnects (bleak bug?)
-        while not shutdown:
-            loops = [asyncio.create_task(fetch_loop(fn, period=sample_period, max_errors=max_errors)) for fn in tasks]
-            done, pending = await asyncio.wait(loops, return_when='FIRST_COMPLETED')
-
-            logger.debug('Done= %s, Pending=%s', done, pending)
-            for task in loops:
-                logger.debug('Task %s is done=%s', task, task.done())
-                task.done() or task.cancel()
-
-    else:
-        async def fn():
-            if parallel_fetch:
-                # concurrent synchronised fetch
-                # this branch is currently not reachable!
-                await asyncio.gather(*[t() for t in tasks], return_exceptions=False)
-            else:
-                random.shuffle(tasks)
-                exceptions = []
-                for t in tasks:
-                    try:
-                        await t()
-                    except Exception as ex:
-                        exceptions.append(ex)
-                if exceptions:
-                    logger.error('%d exceptions occurred fetching BMSs', len(exceptions))
-                    raise exceptions[0]
-
-        await fetch_loop(fn, period=sample_period, max_errors=max_errors)
+    await scheduler.run(is_shutdown=lambda: shutdown)
 
     logger.info('All fetch loops ended. shutdown is already %s', shutdown)
     shutdown = True
 
-    store_states(sampler_list)
+    for sampler in sampler_list:
+        sampler.stop()
+
+    meter_journal.close()
 
     for sink in sinks:
         try:
@@ -338,6 +386,10 @@ async def main():
             # await asyncio.sleep(2)
         except:
             pass
+        if not bms.is_virtual:
+            bms.stop_capture()
+
+    await ScannerService.stop_all()
 
 
 def on_exit(*args, **kwargs):
@@ -8,14 +8,16 @@ import asyncio
 import json
 import math
 import queue
-import statistics
 import time
 import traceback
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple
 
 import paho.mqtt.client as paho
 
 from bmslib.bms import BmsSample, DeviceInfo, MIN_VALUE_EXPIRY
 from bmslib.bt import BtBms
+from bmslib.cellstats import CellStats
 from bmslib.util import get_logger
 
 logger = get_logger()
@@ -114,7 +116,108 @@ def build_mqtt_hass_config_discovery(base, topic):
     return hass_config_topic, json.dumps(hass_config_data)
 
 
-_last_values = {}
+class PublishDedupeCache:
+    """
+    Suppresses publishing of unchanged values. A value is re-published after its topic's TTL even if unchanged, so it
+    doesn't expire in HA (`expire_after`).
+
+    * bounded size, least recently published topics are evicted first
+    * TTL per device (first topic level, see `set_device_ttl`)
+    * deadband: numeric changes within the deadband of a topic count as unchanged (noise)
+    """
+
+    def __init__(self, max_size=20_000, ttl=MIN_VALUE_EXPIRY / 2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple] = OrderedDict()  # topic -> (t_publish, data, float value)
+        self._device_ttl: Dict[str, float] = {}
+        self._deadbands: Dict[str, Tuple[float, float]] = {}  # topic suffix -> (relative, absolute)
+
+        self.hits = 0  # suppressed
+        self.misses = 0  # published
+        self.evictions = 0
+
+    def set_device_ttl(self, device_topic: str, ttl: float):
+        self._device_ttl[device_topic] = ttl
+
+    def set_deadband(self, topic_suffix: str, rel=0., absolute=0., significant=0):
+        """
+        Changes smaller than the threshold are suppressed (until the TTL expires).
+        :param topic_suffix: topic without the device prefix, e.g. `soc/current`. `cell_voltages/#` matches all cells
+        :param rel: relative change threshold
+        :param absolute: absolute change threshold
+        :param significant: values are published with this many significant digits, suppress changes smaller than
+            half a unit of the last digit (float noise of equal rounded values)
+        """
+        self._deadbands[topic_suffix] = (rel, absolute, significant)
+
+    def _deadband(self, topic: str) -> Optional[Tuple[float, float, int]]:
+        if not self._deadbands:
+            return None
+        i = topic.find('/')
+        suffix = topic[i + 1:]
+        db = self._deadbands.get(suffix)
+        if db is None:
+            j = suffix.rfind('/')
+            if j > 0 and suffix[j + 1:].isdigit():
+                db = self._deadbands.get(suffix[:j] + '/#')
+        return db
+
+    def is_duplicate(self, topic: str, data, now: float) -> bool:
+        e = self._entries.get(topic)
+        if e is None:
+            return False
+
+        i = topic.find('/')
+        ttl = self._device_ttl.get(topic[:i] if i > 0 else topic, self.ttl)
+        if now - e[0] >= ttl:
+            return False
+
+        if e[1] == data:
+            return True
+
+        db = self._deadband(topic)
+        if db is not None and e[2] is not None:
+            try:
+                x = float(data)
+            except (TypeError, ValueError):
+                return False
+            d = abs(x - e[2])
+            rel, absolute, significant = db
+            if significant and e[2]:
+                absolute = max(absolute, .5 * 10 ** (math.floor(math.log10(abs(e[2]))) - significant + 1))
+            return d < absolute or d < abs(e[2]) * rel
+
+        return False
+
+    def check(self, topic: str, data, now: float) -> bool:
+        """ :return: True if the value should be published """
+        if self.is_duplicate(topic, data, now):
+            self.hits += 1
+            return False
+        self.misses += 1
+        return True
+
+    def published(self, topic: str, data, now: float):
+        try:
+            x = float(data) if isinstance(data, (int, float, str)) and self._deadband(topic) else None
+        except ValueError:
+            x = None
+        entries = self._entries
+        entries[topic] = now, data, x
+        entries.move_to_end(topic)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return dict(size=len(self._entries), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+publish_cache = PublishDedupeCache()
 _last_publish_time = 0.
 
 
@@ -125,8 +228,8 @@ def mqtt_single_out(client: paho.Client, topic, data, retain=False):
     if client is None:
         return
 
-    lv = _last_values.get(topic, None)
-    if lv and lv[1] == data and (time.time() - lv[0]) < (MIN_VALUE_EXPIRY / 2):
+    now = time.time()
+    if not publish_cache.check(topic, data, now):
         logger.debug('topic %s data not changed', topic)
         return False
 
@@ -136,8 +239,7 @@ def mqtt_single_out(client: paho.Client, topic, data, retain=False):
             logger.warning('mqtt publish %s failed: %s %s', topic, mqi.rc, mqi)
         return False
 
-    now = time.time()
-    _last_values[topic] = now, data
+    publish_cache.published(topic, data, now)
     global _last_publish_time
     _last_publish_time = now
 
@@ -235,6 +337,13 @@ sample_desc = {
 }
 
 
+# values equal after rounding to the published precision are duplicates, even if their float repr differs
+for _k, _d in sample_desc.items():
+    if _d.get('precision', 0) >= 2:
+        publish_cache.set_deadband(_k, significant=_d['precision'])
+publish_cache.set_deadband('cell_voltages/#', absolute=0.0005)  # half a mV
+
+
 def publish_sample(client, device_topic, sample: BmsSample):
     for k, v in sample_desc.items():
         topic = f"{device_topic}/{k}"
@@ -249,7 +358,24 @@ def publish_sample(client, device_topic, sample: BmsSample):
             mqtt_single_out(client, topic, 'ON' if switch_state else 'OFF')
 
 
-def publish_cell_voltages(client, device_topic, voltages):
+def publish_sample_json(client, device_topic, sample: BmsSample):
+    """
+    Batched mode: publish all sample fields as a single JSON document to `{device_topic}/state`.
+    Keys are the `field` names of `sample_desc`, switch states are in `switches`.
+    """
+    state = {}
+    for k, v in sample_desc.items():
+        s = round_to_n(getattr(sample, v['field']), v.get('precision', 5))
+        if not is_none_or_nan(s):
+            state[v['field']] = float(s) if isinstance(s, str) else s  # round_to_n returns str
+
+    if sample.switches:
+        state['switches'] = {name: 'ON' if on else 'OFF' for name, on in sample.switches.items()}
+
+    mqtt_single_out(client, f"{device_topic}/state", json.dumps(state))
+
+
+def publish_cell_voltages(client, device_topic, voltages, stats: Optional[CellStats] = None):
     # "highest_voltage": parts[0] / 1000,
     # "highest_cell": parts[1],
     # "lowest_voltage": parts[2] / 1000,
@@ -263,16 +389,39 @@ def publish_cell_voltages(client, device_topic, voltages):
         mqtt_single_out(client, topic, voltages[i] / 1000)
 
     if len(voltages) > 1:
-        x = range(len(voltages))
-        high_i = max(x, key=lambda i: voltages[i])
-        low_i = min(x, key=lambda i: voltages[i])
-        mqtt_single_out(client, f"{device_topic}/cell_voltages/min", voltages[low_i] / 1000)
-        mqtt_single_out(client, f"{device_topic}/cell_voltages/min_index", low_i + 1)
-        mqtt_single_out(client, f"{device_topic}/cell_voltages/max", voltages[high_i] / 1000)
-        mqtt_single_out(client, f"{device_topic}/cell_voltages/max_index", high_i + 1)
-        mqtt_single_out(client, f"{device_topic}/cell_voltages/delta", (voltages[high_i] - voltages[low_i]) / 1000)
-        mqtt_single_out(client, f"{device_topic}/cell_voltages/average", round(sum(voltages) / len(voltages)) / 1000)
-        mqtt_single_out(client, f"{device_topic}/cell_voltages/median", statistics.median(voltages) / 1000)
+        if stats is None:
+            stats = CellStats(voltages)
+        mqtt_single_out(client, f"{device_topic}/cell_voltages/min", stats.min / 1000)
+        mqtt_single_out(client, f"{device_topic}/cell_voltages/min_index", stats.min_index + 1)
+        mqtt_single_out(client, f"{device_topic}/cell_voltages/max", stats.max / 1000)
+        mqtt_single_out(client, f"{device_topic}/cell_voltages/max_index", stats.max_index + 1)
+        mqtt_single_out(client, f"{device_topic}/cell_voltages/delta", stats.delta / 1000)
+        mqtt_single_out(client, f"{device_topic}/cell_voltages/average", round(stats.mean) / 1000)
+        mqtt_single_out(client, f"{device_topic}/cell_voltages/median", stats.median / 1000)
+
+
+def publish_cell_voltages_json(client, device_topic, voltages, stats: Optional[CellStats] = None):
+    """
+    Batched mode: publish cell voltages (V) and statistics as a single JSON document to `{device_topic}/cell_voltages`
+    """
+    if not voltages:
+        return
+
+    doc = dict(cells=[v / 1000 for v in voltages])
+    if len(voltages) > 1:
+        if stats is None:
+            stats = CellStats(voltages)
+        doc.update(
+            min=stats.min / 1000,
+            min_index=stats.min_index + 1,
+            max=stats.max / 1000,
+            max_index=stats.max_index + 1,
+            delta=stats.delta / 1000,
+            average=round(stats.mean) / 1000,
+            median=stats.median / 1000,
+        )
+
+    mqtt_single_out(client, f"{device_topic}/cell_voltages", json.dumps(doc))
 
 
 def publish_temperatures(client, device_topic, temperatures):
@@ -284,7 +433,10 @@ def publish_temperatures(client, device_topic, temperatures):
 
 def publish_hass_discovery(client, device_topic, expire_after_seconds: int, sample: BmsSample, num_cells,
                            temperatures,
-                           device_info: DeviceInfo = None):
+                           device_info: DeviceInfo = None, json_state=False):
+    """
+    :param json_state: entities read the JSON documents of `publish_sample_json` and `publish_cell_voltages_json`
+    """
     discovery_msg = {}
 
     device_json = {
@@ -296,7 +448,8 @@ def publish_hass_discovery(client, device_topic, expire_after_seconds: int, samp
         "hw_version": (device_info and device_info.hw_version) or None,
     }
 
-    def _hass_discovery(k, device_class, unit, state_class=None, icon=None, name=None, long_expiry=False):
+    def _hass_discovery(k, device_class, unit, state_class=None, icon=None, name=None, long_expiry=False,
+                        json_topic=None, json_value=None):
         dm = {
             "unique_id": f"{device_topic}__{k.replace('/', '_')}",
             "name": name or k.replace('/', ' '),
@@ -310,6 +463,9 @@ def publish_hass_discovery(client, device_topic, expire_after_seconds: int, samp
         }
         if icon:
             dm['icon'] = 'mdi:' + icon
+        if json_state and json_topic:
+            dm['state_topic'] = f"{device_topic}/{json_topic}"
+            dm['value_template'] = "{{ value_json.%s }}" % json_value
         remove_none_values(dm)
         remove_none_values(dm['device'])
         discovery_msg[f"homeassistant/sensor/{device_topic}/_{k.replace('/', '_')}/config"] = dm
@@ -317,22 +473,24 @@ def publish_hass_discovery(client, device_topic, expire_after_seconds: int, samp
     for k, d in sample_desc.items():
         if not is_none_or_nan(getattr(sample, d["field"])):
             _hass_discovery(k, d["device_class"], state_class=d["state_class"], unit=d["unit_of_measurement"],
-                            icon=d.get('icon', None), name=d["field"])
+                            icon=d.get('icon', None), name=d["field"], json_topic='state', json_value=d["field"])
 
     for i in range(0, num_cells):
         k = 'cell_voltages/%d' % (i + 1)
         n = 'Cell Volt %0*d' % (1 + int(math.log10(num_cells)), i + 1)
-        _hass_discovery(k, "voltage", name=n, unit="V")
+        _hass_discovery(k, "voltage", name=n, unit="V", json_topic='cell_voltages', json_value='cells[%d]' % i)
 
     if num_cells > 1:
         statistic_fields = ["min", "max", "average", "median", "delta"]
         for f in statistic_fields:
             k = 'cell_voltages/%s' % f
-            _hass_discovery(k, name="Cell Volt %s" % f, device_class="voltage", unit="V")
+            _hass_discovery(k, name="Cell Volt %s" % f, device_class="voltage", unit="V",
+                            json_topic='cell_voltages', json_value=f)
 
         for f in ["min_index", "max_index"]:
             k = 'cell_voltages/%s' % f
-            _hass_discovery(k, name="Cell Index %s" % f[:3], device_class=None, unit="")
+            _hass_discovery(k, name="Cell Index %s" % f[:3], device_class=None, unit="",
+                            json_topic='cell_voltages', json_value=f)
 
     for i in range(0, len(temperatures)):
         k = 'temperatures/%d' % (i + 1)
@@ -356,12 +514,17 @@ def publish_hass_discovery(client, device_topic, expire_after_seconds: int, samp
     switches = (sample.switches and sample.switches.keys())
     if switches:
         for switch_name in switches:
+            switch_state_conf = dict(state_topic=f"{device_topic}/switch/{switch_name}")
+            if json_state:
+                switch_state_conf = dict(state_topic=f"{device_topic}/state",
+                                         value_template="{{ value_json.switches.%s }}" % switch_name)
+
             discovery_msg[f"homeassistant/switch/{device_topic}/{switch_name}/config"] = {
                 "unique_id": f"{device_topic}__switch_{switch_name}",
                 "name": f"{switch_name}",
                 "device_class": 'outlet',
                 # "json_attributes_topic": f"{device_topic}/{switch_name}",
-                "state_topic": f"{device_topic}/switch/{switch_name}",
+                **switch_state_conf,
                 "expire_after": expire_after_seconds,
                 "device": device_json,
                 "command_topic": f"homeassistant/switch/{device_topic}/{switch_name}/set",
@@ -374,7 +537,7 @@ def publish_hass_discovery(client, device_topic, expire_after_seconds: int, samp
                 # "json_attributes_topic": f"{device_topic}/{switch_name}",
                 "expire_after": expire_after_seconds,
                 "device": device_json,
-                "state_topic": f"{device_topic}/switch/{switch_name}",
+                **switch_state_conf,
                 "command_topic": f"homeassistant/switch/{device_topic}/{switch_name}/set",
             }
 
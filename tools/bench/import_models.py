@@ -0,0 +1,49 @@
+"""
+Import-time benchmark of the BMS driver registry. Each measurement runs in a fresh interpreter, so module caches
+don't interfere. `lazy <type>` loads only that driver (as main does for a config with one device type), `eager` loads
+all drivers (the previous behaviour of `get_bms_model_class`).
+
+    python -m tools.bench.import_models
+"""
+import statistics
+import subprocess
+import sys
+
+SNIPPET = '''
+import time, sys
+t0 = time.perf_counter()
+%s
+import bmslib.models as m
+for name in %r:
+    m.get_bms_model_class(name)
+dt = time.perf_counter() - t0
+print(dt, len(sys.modules))
+'''
+
+
+def measure(names, pre='', repeat=5):
+    times, n_mod = [], 0
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', SNIPPET % (pre, list(names))], text=True)
+        dt, n_mod = out.split()
+        times.append(float(dt))
+    return statistics.median(times), int(n_mod)
+
+
+def main():
+    from bmslib.models import BMS_MODELS
+    names = list(BMS_MODELS.keys())
+
+    # bleak & co. are needed by every driver, this is the floor
+    dt, n_mod = measure([], pre='import bmslib.bt')
+    print('%-22s %7.1f ms  %4d modules' % ('bmslib.bt only', dt * 1e3, n_mod))
+
+    dt_all, mod_all = measure(names)
+    print('%-22s %7.1f ms  %4d modules' % ('eager (all)', dt_all * 1e3, mod_all))
+    for name in names:
+        dt, n_mod = measure([name])
+        print('%-22s %7.1f ms  %4d modules  (x%.2f)' % ('lazy ' + name, dt * 1e3, n_mod, dt_all / dt))
+
+
+if __name__ == '__main__':
+    main()
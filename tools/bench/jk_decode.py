@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of the JK 0x02 frame decoder against the previous per-field `int.from_bytes` implementation.
+
+    python -m tools.bench.jk_decode
+"""
+import time
+
+from bmslib.models.dummy import JKDummy
+from bmslib.models.jikong import decode_jk02, jk02_layout
+
+
+def legacy_decode(buf, num_cells):
+    is_new_11fw = buf[189] in {0x0, 0x1} and buf[189 + 32] > 0
+    offset = 32 if is_new_11fw else 0
+
+    i16 = lambda i: int.from_bytes(buf[i:(i + 2)], byteorder='little', signed=True)
+    u32 = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=False)
+    f32u = lambda i: u32(i) * 1e-3
+    f32s = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=True) * 1e-3
+
+    temp = lambda x: float('nan') if x == -2000 else (x / 10)
+
+    temperatures = [temp(i16(130 + offset)), temp(i16(132 + offset))]
+    if is_new_11fw:
+        temperatures += [temp(i16(224 + offset)), temp(i16(226 + offset))]
+
+    fields = dict(
+        voltage=f32u(118 + offset),
+        current=-f32s(126 + offset),
+        soc=buf[141 + offset],
+        cycle_capacity=f32u(154 + offset),
+        capacity=f32u(146 + offset),
+        charge=f32u(142 + offset),
+        temperatures=temperatures,
+        mos_temperature=i16((112 if is_new_11fw else 134) + offset) / 10,
+        balance_current=i16(138 + offset) / 1000,
+        num_cycles=u32(150 + offset),
+        uptime=float(u32(162 + offset)),
+    )
+    voltages = [int.from_bytes(buf[(6 + i * 2):(6 + i * 2 + 2)], byteorder='little') for i in range(num_cells)]
+    return fields, voltages
+
+
+def frames():
+    for is_new_11x in (False, True):
+        for msg in JKDummy(is_new_11x=is_new_11x).MSGS:
+            if msg[4] == 0x02:
+                yield ('11.x' if is_new_11x else 'old'), bytes(msg)
+
+
+def ops_per_sec(fn, buf, num_cells, duration=1.):
+    n = 0
+    t0 = time.perf_counter()
+    while True:
+        for _ in range(1000):
+            fn(buf, num_cells)
+        n += 1000
+        dt = time.perf_counter() - t0
+        if dt > duration:
+            return n / dt
+
+
+def main(num_cells=16):
+    for variant, buf in frames():
+        f_legacy, v_legacy = legacy_decode(buf, num_cells)
+        f_new, v_new = decode_jk02(buf, num_cells)
+        assert list(v_new) == v_legacy
+        for k, v in f_legacy.items():
+            if k != 'temperatures':
+                assert abs(f_new[k] - v) < 1e-9, (k, f_new[k], v)
+
+        print('%s firmware, %d cells, struct %s' % (variant, num_cells, jk02_layout.cache_info()))
+        legacy = ops_per_sec(legacy_decode, buf, num_cells)
+        new = ops_per_sec(decode_jk02, buf, num_cells)
+        print('  legacy %9.0f ops/s' % legacy)
+        print('  struct %9.0f ops/s  (x%.1f)' % (new, new / legacy))
+
+
+if __name__ == '__main__':
+    main()
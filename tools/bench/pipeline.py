@@ -0,0 +1,377 @@
+"""
+End-to-end benchmarks of the sampling pipeline, without hardware or network services. Results are printed and
+optionally written as JSON for regression tracking.
+
+    python -m tools.bench.pipeline [--quick] [--only decode,sampler] [--json bench.json]
+
+Sections:
+  decode    JK 0x02 decoder ops/s, and fetch()/s per model replayed at full speed from synthetic captures
+  sampler   per-sample cost of `BmsSampler._sample_inner` with N simulated devices, publishing to a stub MQTT broker
+  mqtt      cost of `publish_sample` / `publish_cell_voltages` per call against the stub broker, with changing and
+            repeated (deduplicated) values
+  influxdb  line protocol encoding per sample, and `InfluxDBSink` encode and flush against a stub HTTP server (the
+            sink part needs the `influxdb` package)
+  memory    RSS and traced heap growth over 1M samples (100k with `--quick`)
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import paho.mqtt.client as paho
+
+import mqtt_util
+from bmslib.bms import BmsSample
+from bmslib.cellstats import CellStats
+from bmslib.lineprotocol import LineBuffer, encode_fields, line_prefix
+from bmslib.models.dummy import DummyBt, JKDummy
+from bmslib.models.jbd import _jbd_command
+from bmslib.models.jikong import JKBt, _jk_command, decode_jk02
+from bmslib.replay import FORMAT, VERSION, open_replay
+from bmslib.sampling import BmsSampler
+from bmslib.sinks import flatten
+from tools.bench.stubs import StubHttpServer, StubMqttBroker
+
+SECTIONS = ('decode', 'sampler', 'mqtt', 'influxdb', 'memory')
+
+
+def ops_per_sec(fn, duration: float, batch=100) -> float:
+    n = 0
+    t0 = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            fn()
+        n += batch
+        dt = time.perf_counter() - t0
+        if dt > duration:
+            return n / dt
+
+
+def latency_stats(times) -> dict:
+    times = sorted(times)
+    return dict(n=len(times), mean_us=round(statistics.fmean(times) * 1e6, 2),
+                p50_us=round(times[len(times) // 2] * 1e6, 2), p95_us=round(times[int(len(times) * .95)] * 1e6, 2))
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def mqtt_client(broker: StubMqttBroker) -> paho.Client:
+    client = paho.Client(paho.CallbackAPIVersion.VERSION2)
+    client.connect(broker.host, broker.port)
+    client.loop_start()
+    return client
+
+
+def wait_drained(broker: StubMqttBroker, settle=.2, timeout=30.):
+    """ Wait until the broker stopped receiving messages """
+    t_end = time.time() + timeout
+    n = -1
+    while n != broker.num_messages and time.time() < t_end:
+        n = broker.num_messages
+        time.sleep(settle)
+
+
+def make_sample(i: int) -> BmsSample:
+    a = i % 2
+    return BmsSample(voltage=52.1 + a, current=-12.3 + a * 5, charge=180. + a * 10, capacity=280., num_cycles=12,
+                     temperatures=[21.5 + a, 22.5], mos_temperature=25. + a, switches=dict(charge=True, discharge=bool(a)),
+                     uptime=1e5 + i)
+
+
+def make_voltages(i: int, num_cells=16):
+    return [3300 + (i % 2) * 10 + c for c in range(num_cells)]
+
+
+# decode
+
+def _capture(path: str, model: str, services: list, segments: list):
+    """ Write a synthetic capture, `segments` is a list of (write char, write data, [notify (char, data)]) """
+    t = 0.
+    with open(path, 'w') as f:
+        lines = [dict(format=FORMAT, version=VERSION, model=model, name='bench'),
+                 dict(t=t, op='connect', services=services)]
+        for char, data, notifications in segments:
+            t += .1
+            lines.append(dict(t=t, op='write', char=char, data=data.hex()))
+            for n_char, n_data in notifications:
+                t += .05
+                lines.append(dict(t=t, op='notify', char=n_char, data=bytes(n_data).hex()))
+        f.write(''.join(json.dumps(l) + '\n' for l in lines))
+
+
+def synthetic_captures(directory: str):
+    """ Captures built from the dummy frames, :return: {model: path} """
+    paths = {}
+
+    char = JKBt.CHAR_UUID
+    services = [dict(uuid=JKBt.SERVICE_UUID, characteristics=[dict(uuid=char, handle=2, properties=['write', 'notify'])])]
+    for name, dummy in (('jk', JKDummy()), ('jk11', JKDummy(is_new_11x=True))):
+        settings, state = dummy.MSGS
+        paths[name] = os.path.join(directory, name + '.jsonl')
+        # jk streams state frames after the 0x96 command
+        _capture(paths[name], 'jk', services, [(char, _jk_command(0x97, []), [(char, JKDummy.DEVICE_INFO)]),
+                                                (char, _jk_command(0x96, []), [(char, settings)] + [(char, state)] * 4)])
+
+    rx, tx = '0000ff01-0000-1000-8000-00805f9b34fb', '0000ff02-0000-1000-8000-00805f9b34fb'
+    info = bytearray.fromhex('dd03001b0a50fda4b717dac000002cf300000000000016540308020b7d0b77f8e277')  # as JBDDummy
+    cells = bytes([0xdd, 0x04, 0x00, 16]) + b''.join((3300 + i).to_bytes(2, 'big') for i in range(8)) + b'\x00\x00\x77'
+    paths['jbd'] = os.path.join(directory, 'jbd.jsonl')
+    _capture(paths['jbd'], 'jbd', [], [(tx, _jbd_command(0x03), [(rx, info)]), (tx, _jbd_command(0x04), [(rx, cells)])])
+    return paths
+
+
+async def _fetch_rate(path: str, duration: float) -> dict:
+    bms = open_replay(path, speed=0)
+    bms.set_keep_alive(True)
+    n = 0
+    async with bms:
+        await bms.fetch()
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < duration:
+            await bms.fetch()
+            await bms.fetch_voltages()
+            n += 1
+        dt = time.perf_counter() - t0
+    await bms.disconnect()
+    return dict(fetch_per_sec=round(n / dt, 1), notifications=bms.client.num_notifications)
+
+
+def bench_decode(duration: float) -> dict:
+    res = {}
+    for name, msgs in (('jk02', JKDummy().MSGS), ('jk02_11x', JKDummy(is_new_11x=True).MSGS)):
+        buf = bytes(msgs[1])
+        res[name] = dict(ops_per_sec=round(ops_per_sec(lambda: decode_jk02(buf, 16), duration)))
+    with tempfile.TemporaryDirectory() as d:
+        for model, path in synthetic_captures(d).items():
+            res['replay_' + model] = asyncio.run(_fetch_rate(path, duration))
+    return res
+
+
+# sampler
+
+async def _sampler(num_devices: int, num_rounds: int, client) -> dict:
+    samplers = [BmsSampler(DummyBt('dummy%d' % i, name='bench%d' % i), client, dt_max_seconds=10,
+                           expire_after_seconds=60, publish_period=0, history_size=3600) for i in range(num_devices)]
+    for s in samplers:  # first sample publishes discovery
+        await s._sample_inner()
+    times = []
+    t0 = time.perf_counter()
+    for _ in range(num_rounds):
+        for s in samplers:
+            t = time.perf_counter()
+            await s._sample_inner()
+            times.append(time.perf_counter() - t)
+    dt = time.perf_counter() - t0
+    return dict(devices=num_devices, samples_per_sec=round(len(times) / dt, 1), **latency_stats(times))
+
+
+def bench_sampler(quick: bool) -> dict:
+    broker = StubMqttBroker()
+    client = mqtt_client(broker)
+    res = {}
+    try:
+        for n in ((1, 10) if quick else (1, 10, 100)):
+            rounds = max(10, (2_000 if quick else 20_000) // n)
+            res['devices_%d' % n] = asyncio.run(_sampler(n, rounds, client))
+        wait_drained(broker)
+        res['mqtt_messages'] = broker.num_messages
+    finally:
+        client.loop_stop()
+        broker.close()
+    return res
+
+
+# mqtt
+
+def _per_call(fn, n: int, broker: StubMqttBroker) -> dict:
+    m0 = broker.num_messages
+    times = []
+    for i in range(n):
+        t = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - t)
+    wait_drained(broker)
+    return dict(messages_per_call=round((broker.num_messages - m0) / n, 2), **latency_stats(times))
+
+
+def bench_mqtt(quick: bool) -> dict:
+    broker = StubMqttBroker()
+    client = mqtt_client(broker)
+    n = 2_000 if quick else 20_000
+    samples = [make_sample(0), make_sample(1)]
+    voltages = [make_voltages(0), make_voltages(1)]
+    stats = [CellStats(v) for v in voltages]
+    res = {}
+    try:
+        for json_state in (False, True):
+            pub_sample = mqtt_util.publish_sample_json if json_state else mqtt_util.publish_sample
+            pub_cells = mqtt_util.publish_cell_voltages_json if json_state else mqtt_util.publish_cell_voltages
+            mode = 'json' if json_state else 'topics'
+            res['publish_sample_%s' % mode] = _per_call(
+                lambda i: pub_sample(client, 'bench_%s' % mode, samples[i % 2]), n, broker)
+            res['publish_sample_%s_unchanged' % mode] = _per_call(
+                lambda i: pub_sample(client, 'bench_%s' % mode, samples[0]), n, broker)
+            res['publish_cell_voltages_%s' % mode] = _per_call(
+                lambda i: pub_cells(client, 'bench_%s' % mode, voltages[i % 2], stats[i % 2]), n, broker)
+    finally:
+        client.loop_stop()
+        broker.close()
+    return res
+
+
+# influxdb
+
+def bench_influxdb(quick: bool, duration: float) -> dict:
+    samples = [make_sample(0), make_sample(1)]
+    voltages = [make_voltages(0), make_voltages(1)]
+    prefix = line_prefix('batmon', dict(device='bench'))
+    buf = LineBuffer(10 ** 6)
+
+    def encode(i=[0]):
+        i[0] += 1
+        buf.append(prefix, encode_fields(flatten(samples[i[0] % 2].to_fields())), time.time_ns())
+        if len(buf) > 10 ** 5:
+            buf.recycle(buf.take()[0])
+
+    res = dict(lineprotocol_encode=dict(ops_per_sec=round(ops_per_sec(encode, duration))))
+
+    try:
+        from bmslib.sinks import InfluxDBSink
+        import influxdb
+    except ImportError as e:
+        res['sink'] = dict(skipped=str(e))
+        return res
+
+    stub = StubHttpServer()
+    try:
+        sink = InfluxDBSink(host=stub.host, port=stub.port, database='bench', flush_interval=3600,
+                            batch_size=10 ** 9, queue_size=10 ** 7)
+        n = 10_000 if quick else 100_000
+        times = []
+        for i in range(n):
+            t = time.perf_counter()
+            sink.publish_sample('bench', samples[i % 2])
+            sink.publish_voltages('bench', voltages[i % 2], stats=None)
+            times.append(time.perf_counter() - t)
+        res['sink_encode'] = latency_stats(times)
+
+        points = len(sink.lines)
+        t = time.perf_counter()
+        assert sink._flush_batch()
+        dt = time.perf_counter() - t
+        res['sink_flush'] = dict(points=points, seconds=round(dt, 4), points_per_sec=round(points / dt),
+                                 bytes_sent=stub.num_bytes, requests=stub.num_requests)
+    finally:
+        stub.close()
+    return res
+
+
+# memory
+
+async def _memory(num_samples: int, num_devices: int, client, trace: bool) -> dict:
+    samplers = [BmsSampler(DummyBt('dummy%d' % i, name='mem%d' % i), client, dt_max_seconds=10,
+                           expire_after_seconds=60, publish_period=0, history_size=3600) for i in range(num_devices)]
+    checkpoints = []
+    step = max(1, num_samples // 10)
+    t0 = time.perf_counter()
+    rss0 = traced0 = None
+    for i in range(num_samples // num_devices):
+        for s in samplers:
+            await s._sample_inner()
+        n = (i + 1) * num_devices
+        if n % step < num_devices:
+            rss = rss_bytes()
+            traced = tracemalloc.get_traced_memory()[0] if trace else None
+            if rss0 is None:  # first checkpoint is after warm-up (history and caches filled)
+                rss0, traced0 = rss, traced
+            checkpoints.append(dict(samples=n, rss_mb=round(rss / 1e6, 2),
+                                    traced_mb=traced and round(traced / 1e6, 2)))
+    dt = time.perf_counter() - t0
+    last = checkpoints[-1]
+    return dict(samples=num_samples, devices=num_devices, seconds=round(dt, 1),
+                rss_growth_mb=round(last['rss_mb'] - rss0 / 1e6, 2),
+                traced_growth_mb=round(last['traced_mb'] - traced0 / 1e6, 2) if trace else None,
+                checkpoints=checkpoints)
+
+
+def bench_memory(num_samples: int, trace: bool) -> dict:
+    broker = StubMqttBroker()
+    client = mqtt_client(broker)
+    if trace:
+        tracemalloc.start()
+    try:
+        return asyncio.run(_memory(num_samples, 10, client, trace))
+    finally:
+        if trace:
+            tracemalloc.stop()
+        client.loop_stop()
+        broker.close()
+
+
+def meta() -> dict:
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                      stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        rev = None
+    return dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), git_rev=rev, python=platform.python_version(),
+                platform=platform.platform(), machine=platform.machine(), cpus=os.cpu_count())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='batmon sampling pipeline benchmarks')
+    parser.add_argument('--quick', action='store_true', help='fewer iterations (smoke test)')
+    parser.add_argument('--only', default=','.join(SECTIONS), help='comma separated sections %s' % (SECTIONS,))
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--memory-samples', type=int, default=None, help='default 1M (100k with --quick)')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace heap allocations in the memory section')
+    args = parser.parse_args()
+
+    mqtt_util.disable_warnings()
+    duration = .2 if args.quick else 1.
+    sections = [s.strip() for s in args.only.split(',') if s.strip()]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error('unknown sections %s' % unknown)
+
+    results = dict(meta=meta(), quick=args.quick)
+    for section in sections:
+        t = time.perf_counter()
+        if section == 'decode':
+            res = bench_decode(duration)
+        elif section == 'sampler':
+            res = bench_sampler(args.quick)
+        elif section == 'mqtt':
+            res = bench_mqtt(args.quick)
+        elif section == 'influxdb':
+            res = bench_influxdb(args.quick, duration)
+        else:
+            res = bench_memory(args.memory_samples or (100_000 if args.quick else 1_000_000), args.tracemalloc)
+        results[section] = res
+        print('%s (%.1fs)' % (section, time.perf_counter() - t))
+        for k, v in res.items():
+            if k != 'checkpoints':
+                print('  %-32s %s' % (k, json.dumps(v)))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('results written to', args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Load test: hundreds of virtual BMS sampled like main() does (BmsSampler + SampleScheduler, MQTT to a local stub
+broker), reporting the achieved sample rate, event-loop lag, CPU and RSS for each sampling mode.
+
+    python -m tools.bench.scale [--devices 50,200,500] [--modes serial,concurrent,adapter] [--duration 30]
+                                [--mqtt topics,json] [--replay capture.jsonl.gz] [--json scale.json]
+
+Devices are `SimulatedBt` (lognormal connect and notification delays, occasional timeouts and disconnects) spread over
+`--adapters` bluetooth adapters, or replays of a capture at real-time speed (`--replay`).
+
+Bottleneck numbers per run:
+  serial_ceiling  samples/s one sampling slot can do (1 / mean connect+fetch cycle), serial mode can't exceed it
+  mqtt_ms         event-loop time spent publishing to MQTT per sample, `mqtt_share` is its share of the run time
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+import paho.mqtt.client as paho
+
+import mqtt_util
+from bmslib.bms import MIN_VALUE_EXPIRY
+from bmslib.metrics import metrics
+from bmslib.models.dummy import SimulatedBt
+from bmslib.replay import open_replay
+from bmslib.sampling import BmsSampler
+from bmslib.scheduler import add_sampler, create_scheduler
+from tools.bench.pipeline import meta, rss_bytes
+from tools.bench.stubs import StubMqttBroker
+
+MODES = ('serial', 'concurrent', 'adapter')
+
+
+def make_devices(n: int, args) -> list:
+    if args.replay:
+        return [open_replay(args.replay, name='scale%03d' % i, speed=1) for i in range(n)]
+    return [SimulatedBt('sim%03d' % i, name='scale%03d' % i, adapter='hci%d' % (i % args.adapters), seed=i,
+                        connect_delay=args.connect_delay, fetch_delay=args.fetch_delay,
+                        timeout_rate=args.timeout_rate, disconnect_rate=args.disconnect_rate)
+            for i in range(n)]
+
+
+def _hist_total(name: str):
+    count, total = 0, 0.
+    for (n, _), h in metrics.histograms.items():
+        if n == name:
+            count += h.count
+            total += h.sum
+    return count, total
+
+
+async def run_one(num_devices: int, mode: str, mqtt_mode: str, args) -> dict:
+    metrics.histograms.clear()
+    metrics.counters.clear()
+    metrics.gauges.clear()
+
+    broker = StubMqttBroker()
+    client = paho.Client(paho.CallbackAPIVersion.VERSION2)
+    client.connect(broker.host, broker.port)
+    client.loop_start()
+
+    devices = make_devices(num_devices, args)
+    period = args.period
+    samplers = []
+    for bms in devices:
+        bms.set_connection_policy(args.policy)
+        samplers.append(BmsSampler(bms, mqtt_client=client, dt_max_seconds=max(60. * 10, period * 2),
+                                   expire_after_seconds=max(MIN_VALUE_EXPIRY, int(period * 2 + .5)),
+                                   publish_period=period, history_size=3600, json_state=mqtt_mode == 'json'))
+
+    scheduler = create_scheduler(period, concurrent=mode == 'concurrent',
+                                 adapter_concurrency=args.adapter_concurrency if mode == 'adapter' else None,
+                                 adapter_connections=args.adapter_connections)
+    for s in samplers:
+        add_sampler(scheduler, s)
+
+    t_end = time.monotonic() + args.duration
+    is_shutdown = lambda: time.monotonic() > t_end
+    lags = []
+
+    async def lag_loop():
+        # same probe as main's background_loop
+        while not is_shutdown():
+            t = time.perf_counter()
+            await asyncio.sleep(.1)
+            lags.append(max(0., time.perf_counter() - t - .1))
+
+    rss0 = rss_bytes()
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    await asyncio.gather(scheduler.run(is_shutdown), lag_loop())
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+
+    for bms in devices:
+        try:
+            await bms.disconnect()
+        except Exception:
+            pass
+    samples = sum(s.num_samples for s in samplers)
+    time.sleep(.5)  # let the broker receive the last messages
+    client.loop_stop()
+    broker.close()
+
+    lags.sort()
+    n_cycles, t_cycles = _hist_total('cycle')
+    _, t_mqtt = _hist_total('mqtt_publish')
+    schedules = scheduler.schedules.values()
+    return dict(
+        devices=num_devices, mode=mode, mqtt=mqtt_mode, policy=args.policy, period=period, seconds=round(wall, 1),
+        target_rate=round(num_devices / period, 1),
+        sample_rate=round(samples / wall, 1),
+        achieved=round(samples / wall / (num_devices / period), 3),
+        errors=sum(v for (name, _, _), v in metrics.counters.items() if name == 'errors'),
+        connects=sum(v for (name, _, _), v in metrics.counters.items() if name == 'connects'),
+        late=sum(s.num_late for s in schedules),
+        skipped=sum(s.num_skipped for s in schedules),
+        loop_lag_ms=dict(p50=round(lags[len(lags) // 2] * 1e3, 2), p99=round(lags[int(len(lags) * .99)] * 1e3, 2),
+                         max=round(lags[-1] * 1e3, 2)) if lags else None,
+        cpu_percent=round(cpu / wall * 100, 1),
+        rss_mb=round(rss_bytes() / 1e6, 1),
+        rss_growth_mb=round((rss_bytes() - rss0) / 1e6, 1),
+        mqtt_messages_per_sample=round(broker.num_messages / samples, 1) if samples else None,
+        mqtt_ms=round(t_mqtt / samples * 1e3, 3) if samples else None,
+        mqtt_share=round(t_mqtt / wall, 3),
+        cycle_ms=round(t_cycles / n_cycles * 1e3, 1) if n_cycles else None,
+        serial_ceiling=round(n_cycles / t_cycles, 1) if t_cycles else None,
+        publish_cache_size=len(mqtt_util.publish_cache),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='batmon multi-device load test')
+    parser.add_argument('--devices', default='50,200,500', help='comma separated device counts')
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated sampling modes %s' % (MODES,))
+    parser.add_argument('--mqtt', default='topics', help='comma separated MQTT modes: topics, json')
+    parser.add_argument('--duration', type=float, default=30., help='seconds per run')
+    parser.add_argument('--period', type=float, default=1., help='sample_period')
+    parser.add_argument('--policy', default='per_sample', help='connection policy')
+    parser.add_argument('--adapters', type=int, default=2, help='number of simulated bluetooth adapters')
+    parser.add_argument('--adapter-concurrency', type=int, default=4, help='for the adapter mode')
+    parser.add_argument('--adapter-connections', type=int, default=None)
+    parser.add_argument('--connect-delay', type=float, default=.8, help='mean seconds')
+    parser.add_argument('--fetch-delay', type=float, default=.15, help='mean seconds per notification')
+    parser.add_argument('--timeout-rate', type=float, default=.005)
+    parser.add_argument('--disconnect-rate', type=float, default=.002)
+    parser.add_argument('--replay', help='replay this capture instead of simulated devices')
+    parser.add_argument('--log-level', default='CRITICAL')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    mqtt_util.disable_warnings()
+    logging.disable(getattr(logging, args.log_level.upper()) - 1)  # get_logger() resets logger levels
+    runs = []
+    for n in map(int, args.devices.split(',')):
+        for mode in args.modes.split(','):
+            assert mode in MODES, 'unknown mode %s' % mode
+            for mqtt_mode in args.mqtt.split(','):
+                res = asyncio.run(run_one(n, mode, mqtt_mode, args))
+                runs.append(res)
+                print('%4d devices %-10s %-6s  %7.1f/%-7.1f samples/s (%3.0f%%)  lag p99=%6.1fms  cpu=%5.1f%%  '
+                      'rss=%6.1fMB  mqtt=%.2fms/sample (%4.1f%% of time, %.0f msg)  cycle=%.0fms  errors=%d' % (
+                          n, mode, mqtt_mode, res['sample_rate'], res['target_rate'], res['achieved'] * 100,
+                          res['loop_lag_ms']['p99'] if res['loop_lag_ms'] else float('nan'), res['cpu_percent'],
+                          res['rss_mb'], res['mqtt_ms'] or 0, res['mqtt_share'] * 100,
+                          res['mqtt_messages_per_sample'] or 0, res['cycle_ms'] or 0, res['errors']), flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(meta=meta(), args=vars(args), runs=runs), f, indent=2)
+        print('results written to', args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Local stand-ins for the network services used by the pipeline benchmark: a minimal MQTT 3.1.1 broker that accepts and
+counts messages (QoS 0/1, no routing) and an HTTP server that answers InfluxDB writes with 204.
+"""
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _read_exact(sock: socket.socket, n: int) -> bytes:
+    buf = b''
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError('closed')
+        buf += chunk
+    return buf
+
+
+class _MqttHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        broker: StubMqttBroker = self.server.broker
+        sock: socket.socket = self.request
+        try:
+            while True:
+                head = _read_exact(sock, 1)[0]
+                n, mul = 0, 1
+                while True:  # remaining length, varint
+                    b = _read_exact(sock, 1)[0]
+                    n += (b & 0x7f) * mul
+                    mul *= 128
+                    if not b & 0x80:
+                        break
+                body = _read_exact(sock, n) if n else b''
+                kind = head >> 4
+                if kind == 1:  # CONNECT
+                    sock.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3:  # PUBLISH
+                    with broker.lock:
+                        broker.num_messages += 1
+                        broker.num_bytes += n
+                    if (head >> 1) & 3:  # QoS>0: ack with the packet id after the topic
+                        tl = int.from_bytes(body[:2], 'big')
+                        sock.sendall(b'\x40\x02' + body[2 + tl:4 + tl])
+                elif kind == 8:  # SUBSCRIBE
+                    num_topics = 0
+                    i = 2
+                    while i < len(body):
+                        i += 2 + int.from_bytes(body[i:i + 2], 'big') + 1
+                        num_topics += 1
+                    sock.sendall(bytes([0x90, 2 + num_topics]) + body[:2] + b'\x00' * num_topics)
+                elif kind == 12:  # PINGREQ
+                    sock.sendall(b'\xd0\x00')
+                elif kind == 14:  # DISCONNECT
+                    return
+        except (ConnectionError, OSError):
+            pass
+
+
+class StubMqttBroker:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.Lock()
+        self.num_messages = 0
+        self.num_bytes = 0
+        self._server = socketserver.ThreadingTCPServer((host, port), _MqttHandler)
+        self._server.daemon_threads = True
+        self._server.broker = self
+        self.host, self.port = self._server.server_address[:2]
+        threading.Thread(target=self._server.serve_forever, name='stub_mqtt', daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        n = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(n)
+        stub: StubHttpServer = self.server.stub
+        with stub.lock:
+            stub.num_requests += 1
+            stub.num_bytes += n
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class StubHttpServer:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_bytes = 0
+        self._server = ThreadingHTTPServer((host, port), _HttpHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self.host, self.port = self._server.server_address[:2]
+        threading.Thread(target=self._server.serve_forever, name='stub_http', daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
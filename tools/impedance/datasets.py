@@ -64,6 +64,25 @@ def batmon(tr, device="bat_caravan", cell_index=0, num_cells=1, freq="1s"):
     return points[points.i.first_valid_index():]
 
 
+def batmon_local(tr, device="bat_caravan", cell_index=0, num_cells=1, db_path='batmon.sqlite'):
+    """ Same as `batmon()` (freq=1s), from the add-on's local store (`local_store` option) instead of InfluxDB """
+    from bmslib.tsdb import TimeSeriesStore
+    from tools.impedance.data import to_utc
+    store = TimeSeriesStore(db_path)
+    t0, t1 = (to_utc(t).timestamp() for t in tr)
+    r = store.query(device, t0, t1, tier='raw', columns=('current', 'soc', 'temperature', 'cells'))
+    store.close()
+
+    points = pd.DataFrame(dict(i=r['current'], soc=r['soc'], temp0=r['temperature']),
+                          index=pd.to_datetime(r['ts'], unit='s', utc=True))
+    for ci in range(cell_index, cell_index + num_cells):
+        points.loc[:, str(ci)] = [(c[ci] if c is not None and ci < len(c) else None) for c in r['cells']]
+    points = points.asfreq('1s').ffill(limit=200)
+    assert not points.empty
+    dn = points.dropna(how="any")
+    return points.loc[dn.first_valid_index():dn.last_valid_index(), :]
+
+
 @disk_cache_deco()
 def daly22(num_cells, freq):
     """